@@ -26,7 +26,7 @@ def create_app():
     app.config.from_object(Config)
     
 
-    CORS(app, resources={r"/*": {"origins": "*"}})
+    CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=["X-Next-Cursor"])
 
 
     app.register_blueprint(topology_bp, url_prefix='/topology')
@@ -76,7 +76,12 @@ def create_app():
     return app
 
 if __name__ == '__main__':
+    # Servidor de desarrollo de Werkzeug (un solo proceso). En producción:
+    #   gunicorn -c gunicorn.conf.py wsgi:app
+    from services import migrations, timeseries
+    migrations.migrate()
+    timeseries.ensure_maintenance()
     app = create_app()
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=Config.DEBUG)
 
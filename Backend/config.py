@@ -2,8 +2,8 @@ import os
 import psycopg2
 
 class Config:
-    # Configuración general
-    DEBUG = True
+    # Configuración general (en producción el backend se sirve con gunicorn: ver gunicorn.conf.py)
+    DEBUG = os.environ.get("BACKEND_DEBUG", "0") == "1"
     TESTING = False
 
     # Base de datos PostgreSQL
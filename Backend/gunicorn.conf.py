@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+
+# Perfil de producción del backend:
+#   cd Backend && gunicorn -c gunicorn.conf.py wsgi:app
+# El estado que debe ser común a todos los workers vive en PostgreSQL (ver services/shared_state.py);
+# lo que queda en memoria son cachés por worker de datos de la base de datos.
+
+bind = f"0.0.0.0:{os.environ.get('BACKEND_PORT', '5000')}"
+
+# Las peticiones pasan casi todo el tiempo esperando a PostgreSQL, al controlador o al agente
+# Mininet: pocos procesos (uno o dos por núcleo) con muchas conexiones concurrentes cada uno.
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Importar la aplicación una vez en el maestro y compartir la memoria con los workers (fork)
+preload_app = True
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = 30
+keepalive = 5
+
+# Reciclar workers periódicamente para acotar el crecimiento de memoria
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_worker_init(worker):
+    # Hilo de mantenimiento de los agregados (retención) en cada worker: con preload_app los
+    # hilos arrancados en el maestro no sobreviven al fork; el lock consultivo de
+    # apply_retention hace que solo uno trabaje en cada ronda.
+    from services import timeseries
+    timeseries.ensure_maintenance()
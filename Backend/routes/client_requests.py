@@ -1,23 +1,50 @@
 from flask import Blueprint, jsonify, request
 from services.db import fetch_all, fetch_one
+import os
+import random
 import threading
 import time
 from datetime import datetime 
-from services.db import execute_query
+from services.db import execute_query, execute_returning
+from services.shared_state import SequenceBlock
+from services.config_cache import get_active_config
 from routes.stats import registrar_evento
+from routes.dijkstra import host_switch_dpid, multicast_graft_costs
 
 client_requests_bp = Blueprint('client_requests', __name__)
 
 
+# La posición del round robin la comparten todos los workers (secuencia en PostgreSQL), pero
+# cada worker reserva RR_BLOCK_SIZE posiciones de una vez para no abrir una conexión por
+# elección; el contador local solo se usa si la base de datos no responde.
+RR_SEQUENCE = 'balanceo_rr_seq'
+RR_BLOCK_SIZE = int(os.environ.get("RR_BLOCK_SIZE", "64"))
+rr_positions = SequenceBlock(RR_SEQUENCE, RR_BLOCK_SIZE)
 rr_lock = threading.Lock()
 rr_index = 0 
 
+# Cachés por worker de datos que viven en la base de datos (se refrescan por TTL)
 active_servers_cache = [] 
 last_cache_update = 0
 CACHE_TTL = 10 
 
-wrr_server_list = [] 
-last_wrr_list_update = 0 
+# Clientes activos por servidor ({host_name: clientes}), mantenidos de forma incremental por
+# add_active_client/remove_active_client: son la fuente de la selección, que nunca hace un COUNT.
+# Un hilo por worker los resiembra cada CLIENT_COUNTS_RESYNC segundos con un único GROUP BY
+# (fuera de las peticiones) para incorporar los clientes registrados a través de otros workers.
+# Los ajustes hechos mientras la consulta está en curso se vuelven a aplicar sobre su resultado.
+CLIENT_COUNTS_RESYNC = int(os.environ.get("CLIENT_COUNTS_RESYNC", "30"))
+client_counts_lock = threading.Lock()
+client_counts = {}
+_client_counts_state = {
+    "resync_pid": None,      # el hilo de resiembra no sobrevive al fork de los workers
+    "in_flight_deltas": None  # {host_name: delta} ajustes durante una resiembra en curso
+}
+
+LEAST_LOAD_ALGORITHMS = ('least_connections', 'weighted_least_connections', 'power_of_two_choices')
+
+# Selección por topología: un servidor admite como mucho server_weight * este número de clientes
+TOPOLOGY_CLIENTS_PER_WEIGHT = int(os.environ.get("TOPOLOGY_CLIENTS_PER_WEIGHT", "10"))
 
 def refresh_active_servers_cache():
     """
@@ -31,65 +58,235 @@ def refresh_active_servers_cache():
         last_cache_update = time.time()
     return active_servers_cache
 
-def generate_wrr_list():
+def adjust_client_count(server_name, delta):
+
+    _ensure_client_counts_resync()
+    with client_counts_lock:
+        client_counts[server_name] = max(0, client_counts.get(server_name, 0) + delta)
+        in_flight = _client_counts_state["in_flight_deltas"]
+        if in_flight is not None:
+            in_flight[server_name] = in_flight.get(server_name, 0) + delta
+
+def resync_client_counts():
     """
-    Genera la lista expandida de servidores para Weighted Round Robin.
-    Cada servidor aparece 'server_weight' veces en la lista.
+    Sustituye los contadores por los de la base de datos, conservando los ajustes locales hechos
+    mientras la consulta estaba en curso. Devuelve False si la consulta falló.
     """
-    global wrr_server_list, last_wrr_list_update
-    
-    servers_from_cache = refresh_active_servers_cache()
+    with client_counts_lock:
+        _client_counts_state["in_flight_deltas"] = {}
+    # Una sola fila: fetch_one distingue un fallo (None) de una tabla vacía ({})
+    rows = fetch_one(
+        "SELECT COALESCE(json_object_agg(servidor_asignado, clientes), '{}'::json) AS counts FROM "
+        "(SELECT servidor_asignado, COUNT(*) AS clientes FROM clientes_activos GROUP BY servidor_asignado) c;"
+    )
+    with client_counts_lock:
+        in_flight = _client_counts_state["in_flight_deltas"]
+        _client_counts_state["in_flight_deltas"] = None
+        if rows is None:
+            return False
+        counts = dict(rows['counts'])
+        for server_name, delta in in_flight.items():
+            counts[server_name] = max(0, counts.get(server_name, 0) + delta)
+        client_counts.clear()
+        client_counts.update(counts)
+    return True
 
-    if time.time() - last_wrr_list_update > CACHE_TTL or \
-       len(servers_from_cache) != len(active_servers_cache) or \
-       any(server not in servers_from_cache for server in active_servers_cache): 
-        
-        print("Generando la lista de servidores WRR...")
-        new_wrr_list = []
-        for server in servers_from_cache:
-            for _ in range(server['server_weight']):
-                new_wrr_list.append(server)
-        wrr_server_list = new_wrr_list
-        last_wrr_list_update = time.time()
-    return wrr_server_list
+def _client_counts_resync_loop():
+
+    while True:
+        resync_client_counts()
+        time.sleep(CLIENT_COUNTS_RESYNC)
+
+def _ensure_client_counts_resync():
+
+    pid = os.getpid()
+    with client_counts_lock:
+        if _client_counts_state["resync_pid"] == pid:
+            return
+        _client_counts_state["resync_pid"] = pid
+    threading.Thread(target=_client_counts_resync_loop, name="client-counts-resync", daemon=True).start()
+
+def select_least_loaded(servers, algoritmo_balanceo):
+    """
+    Elige servidor según los clientes activos en memoria:
+      - least_connections: menos clientes.
+      - weighted_least_connections: menor clientes / peso.
+      - power_of_two_choices: dos servidores al azar y el de menor clientes / peso.
+    Los empates se resuelven al azar para no concentrar en un servidor las peticiones que
+    llegan antes de que los clientes se registren.
+    """
+    _ensure_client_counts_resync()
+    weighted = algoritmo_balanceo != 'least_connections'
+    if weighted:
+        servers = [s for s in servers if (s.get('server_weight') or 0) > 0]
+    if not servers:
+        return None
+    if algoritmo_balanceo == 'power_of_two_choices' and len(servers) > 2:
+        servers = random.sample(servers, 2)
+
+    with client_counts_lock:
+        loads = [
+            client_counts.get(s['host_name'], 0) / (s['server_weight'] if weighted else 1)
+            for s in servers
+        ]
+    lowest = min(loads)
+    return random.choice([s for s, load in zip(servers, loads) if load == lowest])
+
+def next_rr_position():
+    """
+    Devuelve la siguiente posición global del round robin.
+    """
+    global rr_index
+    value = rr_positions.next()
+    if value is not None:
+        return value - 1
+    with rr_lock:
+        position = rr_index
+        rr_index += 1
+    return position
+
+class SmoothWeightedRoundRobin:
+    """
+    Weighted Round Robin suave (como nginx): en cada elección cada servidor suma su peso a su
+    peso actual, se elige el de mayor peso actual y se le resta el peso total. Memoria
+    O(servidores) y las elecciones de un mismo servidor quedan intercaladas con las del resto
+    (pesos 5,1,1 -> a a b a c a a en lugar de a a a a a b c).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._servers = []
+        self._weights = []
+        self._current = []
+        self._total = 0
+
+    def update(self, servers):
+        """
+        Ajusta el planificador al conjunto de servidores. Solo se reconstruye si cambian los
+        servidores o sus pesos; los servidores con peso no positivo no reciben clientes.
+        """
+        ordered = sorted(
+            (s for s in servers if (s.get('server_weight') or 0) > 0),
+            key=lambda s: s['host_name']
+        )
+        signature = tuple((s['host_name'], s['ip_destino'], s['puerto'], s['server_weight']) for s in ordered)
+        with self._lock:
+            if signature == self._signature:
+                return
+            print("Reconstruyendo el planificador Weighted Round Robin...")
+            self._signature = signature
+            self._servers = ordered
+            self._weights = [s['server_weight'] for s in ordered]
+            self._current = [0] * len(ordered)
+            self._total = sum(self._weights)
+
+    def next(self):
+        """
+        Devuelve el siguiente servidor o None si no hay servidores con peso.
+        """
+        with self._lock:
+            if not self._servers:
+                return None
+            best = 0
+            for i, weight in enumerate(self._weights):
+                self._current[i] += weight
+                if self._current[i] > self._current[best]:
+                    best = i
+            self._current[best] -= self._total
+            return self._servers[best]
+
+
+# Cada worker tiene su planificador; la proporción de clientes por peso se mantiene en conjunto
+wrr_scheduler = SmoothWeightedRoundRobin()
+
+def _multicast_member_dpids(group_ips):
+    """
+    {ip_multicast: [dpids con miembros]} según la pertenencia IGMP compartida.
+    """
+    rows = fetch_all(
+        "SELECT group_ip, array_agg(DISTINCT dpid) AS dpids FROM igmp_membership "
+        "WHERE group_ip = ANY(%s) GROUP BY group_ip;",
+        (list(group_ips),)
+    )
+    return {row['group_ip']: [int(dpid) for dpid in row['dpids']] for row in rows}
+
+def select_topology_aware(servers, client_host):
+    """
+    Elige el servidor cuyo árbol multicast absorbe al cliente con menor coste de red: el del
+    camino más barato desde el switch del cliente hasta el árbol actual del grupo (la fuente si
+    aún no tiene miembros). Se descartan los servidores que alcanzaron su límite de clientes y,
+    a igual coste, decide la menor carga relativa. Sin ubicación del cliente se usa
+    weighted_least_connections.
+    """
+    _ensure_client_counts_resync()
+    with client_counts_lock:
+        counts = dict(client_counts)
+
+    def load(server):
+        return counts.get(server['host_name'], 0) / server['server_weight']
+
+    weighted = [s for s in servers if (s.get('server_weight') or 0) > 0]
+    eligible = [s for s in weighted
+                if counts.get(s['host_name'], 0) < s['server_weight'] * TOPOLOGY_CLIENTS_PER_WEIGHT]
+    if not eligible:
+        print("Todos los servidores alcanzaron su límite de clientes. Se elige el de menor carga.")
+        return select_least_loaded(servers, 'weighted_least_connections')
+
+    client_dpid = host_switch_dpid(client_host) if client_host else None
+    if client_dpid is None:
+        print(f"Ubicación desconocida para el cliente {client_host}. Se elige el servidor de menor carga.")
+        return select_least_loaded(eligible, 'weighted_least_connections')
+
+    members = _multicast_member_dpids({s['ip_destino'] for s in eligible})
+    trees = {}
+    for server in eligible:
+        source_dpid = host_switch_dpid(server['host_name'])
+        if source_dpid is not None:
+            trees[server['host_name']] = (source_dpid, members.get(server['ip_destino'], []))
+    costs = multicast_graft_costs(client_dpid, trees)
+
+    candidates = [s for s in eligible if s['host_name'] in costs]
+    if not candidates:
+        return select_least_loaded(eligible, 'weighted_least_connections')
+    return min(candidates, key=lambda s: (costs[s['host_name']], load(s)))
 
 @client_requests_bp.route('/get_multicast_stream_info', methods=['GET'])
 def get_multicast_stream_info():
     """
     Endpoint para que los clientes soliciten información del stream multicast.
-    Aplica el algoritmo de balanceo de carga configurado (RR o WRR).
+    Aplica el algoritmo de balanceo de carga configurado (RR, WRR, por menor carga o por
+    topología). Parámetro opcional: host (nombre del host cliente), usado por topology_aware.
     """
-    global rr_index 
-
     try:
-        current_config = fetch_one("SELECT algoritmo_balanceo FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1;")
-        algoritmo_balanceo = current_config['algoritmo_balanceo'] if current_config else None
+        algoritmo_balanceo = get_active_config()['algoritmo_balanceo']
 
         selected_server = None
 
         if algoritmo_balanceo == 'round_robin':
-            with rr_lock: 
-                servers = refresh_active_servers_cache()
-                if servers:
-                    selected_server = servers[rr_index % len(servers)]
-                    rr_index = (rr_index + 1) % len(servers) 
-                else:
-                    print("No hay servidores activos para Round Robin.")
+            servers = refresh_active_servers_cache()
+            if servers:
+                selected_server = servers[next_rr_position() % len(servers)]
+            else:
+                print("No hay servidores activos para Round Robin.")
         elif algoritmo_balanceo == 'weighted_round_robin':
-            with rr_lock: 
-                servers_wrr = generate_wrr_list()
-                if servers_wrr:
-                    selected_server = servers_wrr[rr_index % len(servers_wrr)]
-                    rr_index = (rr_index + 1) % len(servers_wrr) 
-                else:
-                    print("No hay servidores activos para Weighted Round Robin.")
+            wrr_scheduler.update(refresh_active_servers_cache())
+            selected_server = wrr_scheduler.next()
+            if not selected_server:
+                print("No hay servidores activos para Weighted Round Robin.")
+        elif algoritmo_balanceo in LEAST_LOAD_ALGORITHMS:
+            selected_server = select_least_loaded(refresh_active_servers_cache(), algoritmo_balanceo)
+            if not selected_server:
+                print(f"No hay servidores activos para {algoritmo_balanceo}.")
+        elif algoritmo_balanceo == 'topology_aware':
+            selected_server = select_topology_aware(refresh_active_servers_cache(), request.args.get('host'))
+            if not selected_server:
+                print("No hay servidores activos para la selección por topología.")
         else:
             print(f"Algoritmo de balanceo desconocido o no configurado ({algoritmo_balanceo}). Usando Round Robin por defecto.")
             servers = refresh_active_servers_cache()
             if servers:
-                with rr_lock:
-                    selected_server = servers[rr_index % len(servers)]
-                    rr_index = (rr_index + 1) % len(servers)
+                selected_server = servers[next_rr_position() % len(servers)]
             else:
                     print("No hay servidores activos para Round Robin (por defecto).")
 
@@ -165,9 +362,11 @@ def add_active_client():
             (host_cliente, servidor_asignado, ip_destino, puerto, video_solicitado, timestamp_inicio, estado, hora_asignacion)
             VALUES (%s, %s, %s, %s, %s, %s, 'activo', %s);
         """
-        execute_query(insert_query, (
+        ok = execute_query(insert_query, (
             host_cliente, servidor_asignado, ip_destino, puerto, video_solicitado, timestamp_inicio, hora_asignacion
         ))
+        if ok:
+            adjust_client_count(servidor_asignado, 1)
         registrar_evento("CLIENTE_ACTIVADO", host_cliente)
         return jsonify({"success": True, "message": f"Cliente {host_cliente} añadido a clientes_activos."}), 201
     except Exception as e:
@@ -183,8 +382,9 @@ def remove_active_client():
         return jsonify({"error": "Host cliente requerido."}), 400
 
     try:
-        delete_query = "DELETE FROM clientes_activos WHERE host_cliente = %s;"
-        execute_query(delete_query, (host_cliente,))
+        delete_query = "DELETE FROM clientes_activos WHERE host_cliente = %s RETURNING servidor_asignado;"
+        for row in execute_returning(delete_query, (host_cliente,)) or []:
+            adjust_client_count(row['servidor_asignado'], -1)
         registrar_evento("CLIENTE_ELIMINADO", host_cliente)
         return jsonify({"success": True, "message": f"Cliente {host_cliente} eliminado."}), 200
     except Exception as e:
@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
-from services.db import fetch_all, fetch_one, execute_query
+from services.db import fetch_all, execute_query
+from services.config_cache import get_active_config, save_config, serialize_config
 import requests
 from datetime import datetime
 
@@ -16,18 +17,8 @@ def guardar_algoritmo_balanceo():
         return jsonify({"error": "Falta el algoritmo de balanceo"}), 400
 
     try:
-
-        current_config_row = fetch_one(
-            "SELECT algoritmo_balanceo, algoritmo_enrutamiento FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1;"
-        )
-
-        algoritmo_enrutamiento_actual = current_config_row['algoritmo_enrutamiento'] if current_config_row and 'algoritmo_enrutamiento' in current_config_row else None
-
-        query = """
-            INSERT INTO configuracion (algoritmo_balanceo, algoritmo_enrutamiento)
-            VALUES (%s, %s);
-        """
-        ok = execute_query(query, (algoritmo_balanceo, algoritmo_enrutamiento_actual))
+        # El algoritmo de enrutamiento vigente se conserva
+        ok = save_config(algoritmo_balanceo=algoritmo_balanceo)
 
         if ok:
             return jsonify({"message": f"Algoritmo de balanceo '{algoritmo_balanceo}' guardado correctamente"}), 200
@@ -48,16 +39,8 @@ def guardar_algoritmo_enrutamiento():
     try:
         algoritmo_enrutamiento = algoritmo_enrutamiento.lower() 
 
-        current_config_row = fetch_one(
-            "SELECT algoritmo_balanceo, algoritmo_enrutamiento FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1;"
-        )
-        algoritmo_balanceo_actual = current_config_row['algoritmo_balanceo'] if current_config_row and 'algoritmo_balanceo' in current_config_row else None
-
-        query = """
-            INSERT INTO configuracion (algoritmo_balanceo, algoritmo_enrutamiento)
-            VALUES (%s, %s);
-        """
-        ok = execute_query(query, (algoritmo_balanceo_actual, algoritmo_enrutamiento))
+        # El algoritmo de balanceo vigente se conserva
+        ok = save_config(algoritmo_enrutamiento=algoritmo_enrutamiento)
 
         if ok:
             return jsonify({"message": f"Algoritmo de enrutamiento '{algoritmo_enrutamiento}' guardado correctamente"}), 200
@@ -129,19 +112,8 @@ def get_config_history():
 @bp.route('/current', methods=['GET'])
 def get_current_config():
     try:
-        query = "SELECT algoritmo_balanceo, algoritmo_enrutamiento, fecha_activacion FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1;"
-        current_config = fetch_one(query)
-
-        if current_config:
-            if 'fecha_activacion' in current_config and isinstance(current_config['fecha_activacion'], datetime):
-                current_config['fecha_activacion'] = current_config['fecha_activacion'].isoformat()
-            return jsonify(current_config), 200
-        else:
-            return jsonify({
-                "algoritmo_balanceo": None,
-                "algoritmo_enrutamiento": None,
-                "fecha_activacion": None
-            }), 200
+        # Sin configuración guardada todos los campos son None
+        return jsonify(serialize_config(get_active_config())), 200
     except Exception as e:
         print(f"Error al obtener configuración actual: {e}")
         return jsonify({"error": "Error interno del servidor al obtener configuración actual"}), 500
@@ -6,6 +6,7 @@ import heapq
 import logging
 
 from config import Config
+from services.config_cache import get_active_config
 
 dijkstra_bp = Blueprint('dijkstra', __name__)
 logger = logging.getLogger(__name__)
@@ -18,6 +19,14 @@ id_map           = {}  # { id_switch: dpid_int }
 id_to_name       = {}  # { id_switch: switch_nombre }
 hosts_id_to_name = {}  # { id_host: host_nombre }
 
+# Árboles de caminos mínimos ya calculados sobre la topología publicada:
+# { (dpid_origen, enlaces_excluidos): (distancias, padres) }. Se sustituye al publicar una
+# topología distinta, así que nunca mezcla versiones. SPT_CACHE_SIZE acota las variantes
+# de enlaces excluidos que puede acumular.
+topology_version = 0
+_spt_cache = {}
+SPT_CACHE_SIZE = 256
+
 
 def _get_db_connection():
     try:
@@ -27,24 +36,48 @@ def _get_db_connection():
         return None
 
 
-def load_topology():
-
+def _publish_topology(graph, switches, hosts, ids, names, host_names):
+    """
+    Sustituye la topología del worker de una sola vez: las peticiones concurrentes ven la
+    versión anterior completa o la nueva, nunca una a medio construir.
+    """
     global network_graph, switches_by_dpid, host_to_switch_map
     global id_map, id_to_name, hosts_id_to_name
+    global topology_version, _spt_cache
+
+    if (graph, switches, hosts, ids, names, host_names) == (network_graph, switches_by_dpid, host_to_switch_map,
+                                                           id_map, id_to_name, hosts_id_to_name):
+        # Topología sin cambios: se conservan la versión y los árboles ya calculados
+        return False
 
+    network_graph, switches_by_dpid, host_to_switch_map = graph, switches, hosts
+    id_map, id_to_name, hosts_id_to_name = ids, names, host_names
+    _spt_cache = {}
+    topology_version += 1
+    return True
+
+
+def load_topology():
+    """
+    Reconstruye la topología desde la base de datos, que es la fuente compartida por todos
+    los workers; cada worker mantiene su propia copia en memoria.
+    """
     conn = _get_db_connection()
     if not conn:
         return
 
+    network_graph      = collections.defaultdict(dict)
+    switches_by_dpid   = {}
+    host_to_switch_map = {}
+    id_map           = {}
+    id_to_name       = {}
+    hosts_id_to_name = {}
+
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         #  Cargar switches
         cur.execute("SELECT id_switch, nombre FROM switches")
-        id_map.clear()
-        id_to_name.clear()
-        switches_by_dpid.clear()
-        network_graph.clear()
 
         for row in cur.fetchall():
             dpid_str = "{:016x}".format(row['id_switch'])
@@ -57,7 +90,6 @@ def load_topology():
 
         #  Cargar hosts 
         cur.execute("SELECT id_host, nombre, switch_asociado, ipv4 AS ip, mac FROM hosts")
-        hosts_id_to_name.clear()
         temp_host_rows = cur.fetchall()
         for row in temp_host_rows:
             hosts_id_to_name[row['id_host']] = row['nombre']
@@ -146,7 +178,6 @@ def load_topology():
             }
 
         # Construir host_to_switch_map
-        host_to_switch_map.clear()
         for row in temp_host_rows:
             host_name   = row['nombre']
             switch_id   = row['switch_asociado']
@@ -170,14 +201,43 @@ def load_topology():
                 'name': host_name
             }
 
-        logger.info(f"Topología cargada con {len(network_graph)} switches.")
+        if _publish_topology(network_graph, switches_by_dpid, host_to_switch_map,
+                             id_map, id_to_name, hosts_id_to_name):
+            logger.info(f"Topología cargada con {len(network_graph)} switches (versión {topology_version}).")
     except Exception as e:
         logger.error(f"Error al cargar topología: {e}")
     finally:
         conn.close()
 
 
-def calculate_dijkstra_path(start_dpid, end_dpid):
+def _routing_algorithm():
+    """
+    Algoritmo de enrutamiento de la configuración activa; 'dijkstra' si no hay o es desconocido.
+    """
+    alg = get_active_config()['algoritmo_enrutamiento']
+    if alg is None:
+        return 'dijkstra'
+    if alg not in ['dijkstra', 'shortest_path']:
+        print(f"[WARNING] Algoritmo desconocido en configuracion: {alg}. Usando 'dijkstra'.")
+        return 'dijkstra'
+    return alg
+
+
+def _parse_excluded_links(raw):
+    """
+    Convierte [[dpid_a, dpid_b], ...] (enlaces caídos según el controlador) en un conjunto de frozensets.
+    """
+    excluded = set()
+    for link in raw or []:
+        if isinstance(link, (list, tuple)) and len(link) == 2:
+            try:
+                excluded.add(frozenset((int(link[0]), int(link[1]))))
+            except (TypeError, ValueError):
+                logger.warning(f"Enlace excluido inválido: {link}")
+    return excluded
+
+
+def calculate_dijkstra_path(start_dpid, end_dpid, excluded_links=frozenset()):
 
     distances = {node: float('inf') for node in network_graph}
     distances[start_dpid] = 0
@@ -194,7 +254,7 @@ def calculate_dijkstra_path(start_dpid, end_dpid):
             return path
 
         for neighbor, link in network_graph[current].items():
-            if neighbor in visited:
+            if neighbor in visited or frozenset((current, neighbor)) in excluded_links:
                 continue
             new_cost = cost + link['cost']
             if new_cost < distances[neighbor]:
@@ -207,7 +267,7 @@ def calculate_dijkstra_path(start_dpid, end_dpid):
     return None
 
 
-def calculate_shortest_path(start_dpid, end_dpid):
+def calculate_shortest_path(start_dpid, end_dpid, excluded_links=frozenset()):
 
     visited = {start_dpid}
     queue = collections.deque()
@@ -221,7 +281,7 @@ def calculate_shortest_path(start_dpid, end_dpid):
             return path
 
         for neighbor, link in network_graph[current].items():
-            if neighbor not in visited:
+            if neighbor not in visited and frozenset((current, neighbor)) not in excluded_links:
                 visited.add(neighbor)
                 po = link.get('port_out')
                 pi = link.get('port_in_neighbor')
@@ -232,12 +292,154 @@ def calculate_shortest_path(start_dpid, end_dpid):
 
 
 
+def calculate_dijkstra_tree(start_dpid, excluded_links=frozenset()):
+    """
+    Árbol de caminos mínimos desde start_dpid hacia todos los switches alcanzables.
+    Devuelve {dpid: dpid_padre} (la raíz no aparece).
+    """
+    return _shortest_path_tree(start_dpid, excluded_links)[1]
+
+
+def _shortest_path_tree(start_dpid, excluded_links=frozenset()):
+    """
+    Dijkstra completo desde start_dpid: ({dpid: coste}, {dpid: dpid_padre}), memorizado por
+    topología publicada. Los diccionarios devueltos son compartidos: no deben modificarse.
+    """
+    # Grafo y caché de la misma publicación, aunque otra petición publique entre medias
+    graph, cache = network_graph, _spt_cache
+    key = (start_dpid, frozenset(excluded_links))
+    result = cache.get(key)
+    if result is None:
+        result = _compute_shortest_path_tree(graph, start_dpid, key[1])
+        if len(cache) >= SPT_CACHE_SIZE:
+            cache.clear()
+        cache[key] = result
+    return result
+
+
+def _compute_shortest_path_tree(graph, start_dpid, excluded_links):
+
+    distances = {start_dpid: 0}
+    parents = {}
+    heap = [(0, start_dpid)]
+    visited = set()
+
+    while heap:
+        cost, current = heapq.heappop(heap)
+        if current in visited:
+            continue
+        visited.add(current)
+
+        for neighbor, link in graph.get(current, {}).items():
+            if neighbor in visited or frozenset((current, neighbor)) in excluded_links:
+                continue
+            new_cost = cost + link['cost']
+            if new_cost < distances.get(neighbor, float('inf')):
+                distances[neighbor] = new_cost
+                parents[neighbor] = current
+                heapq.heappush(heap, (new_cost, neighbor))
+
+    return distances, parents
+
+
+def host_switch_dpid(host_name):
+    """
+    dpid del switch al que está conectado el host indicado por nombre, o None.
+    """
+    if not host_to_switch_map:
+        load_topology()
+    for info in host_to_switch_map.values():
+        if info.get('name') == host_name:
+            return info.get('dpid')
+    return None
+
+
+def multicast_graft_costs(client_dpid, trees):
+    """
+    Coste de red de añadir un cliente conectado a client_dpid a cada árbol multicast.
+    trees: {clave: (dpid_fuente, [dpids_miembro])}. El árbol es el de caminos mínimos desde la
+    fuente hasta sus miembros (el que instala el controlador); sin miembros es solo la fuente.
+    Devuelve {clave: coste del camino más barato del cliente a cualquier switch del árbol};
+    las claves inalcanzables no aparecen. Los árboles por fuente salen de la caché de la
+    topología publicada: una petición solo calcula los que aún no estén.
+    """
+    if client_dpid not in network_graph:
+        return {}
+    # Los costes de los enlaces son simétricos: basta un Dijkstra desde el cliente
+    client_distances, _ = _shortest_path_tree(client_dpid)
+
+    costs = {}
+    for key, (source_dpid, member_dpids) in trees.items():
+        if source_dpid not in client_distances:
+            continue
+        parents = calculate_dijkstra_tree(source_dpid)
+        tree_nodes = {source_dpid}
+        for member in member_dpids:
+            node = member
+            while node not in tree_nodes and node in parents:
+                tree_nodes.add(node)
+                node = parents[node]
+        costs[key] = min(client_distances[node] for node in tree_nodes if node in client_distances)
+    return costs
+
+
+def _build_multicast_tree(source_dpid, member_dpids, parents):
+    """
+    Une los caminos fuente -> miembro del árbol de caminos mínimos y añade el puerto hacia el
+    cliente en los switches hoja. Devuelve (árbol serializable, error).
+    """
+    tree = {}
+
+    for dst_dpid in member_dpids:
+        if not isinstance(dst_dpid, int):
+            continue
+        if dst_dpid != source_dpid and dst_dpid not in parents:
+            return None, f"No se encontró ruta hacia {dst_dpid}"
+
+        current = dst_dpid
+        while current != source_dpid:
+            parent = parents[current]
+            enlace = network_graph.get(parent, {}).get(current)
+            if not enlace:
+                return None, f"Enlace no encontrado entre {parent} y {current}"
+
+            port_out = enlace.get('port_out')
+            if not isinstance(port_out, int) or port_out <= 0:
+                return None, f"Puerto inválido entre {parent} y {current}"
+
+            tree.setdefault(parent, set()).add(port_out)
+            current = parent
+
+    # Convertir a JSON serializable
+    serialized_tree = {str(dpid): list(ports) for dpid, ports in tree.items()}
+
+    # Agregar salida final hacia cada host conectado a los switches destino (hojas)
+    for leaf_dpid in member_dpids:
+        leaf_str = str(leaf_dpid)
+        if leaf_str in serialized_tree:
+            continue
+
+        port_cliente = None
+        for mac, info in host_to_switch_map.items():
+            if info.get('dpid') == leaf_dpid:
+                port_cliente = info.get('port')
+                break
+
+        if not isinstance(port_cliente, int) or port_cliente <= 0:
+            return None, f"No se encontró puerto hacia cliente en switch {leaf_dpid}"
+
+        serialized_tree[leaf_str] = [port_cliente]
+
+    return serialized_tree, None
+
+
 @dijkstra_bp.route('/calculate_path', methods=['POST'])
 def calculate_path():
 
     data = request.get_json(force=True)
     src_mac = data.get('src_mac')
     dst_mac = data.get('dst_mac')
+    excluded_links = _parse_excluded_links(data.get('excluded_links'))
     load_topology()
     
     src_info = host_to_switch_map.get(src_mac)
@@ -249,37 +451,13 @@ def calculate_path():
     dst_dpid = dst_info['dpid']
     dst_port = dst_info['port']
 
-    # Leer algoritmo de la tabla 'configuracion'
-    algoritmo = 'dijkstra'
-    conn = _get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute(
-                "SELECT algoritmo_enrutamiento "
-                "FROM configuracion "
-                "ORDER BY fecha_activacion DESC "
-                "LIMIT 1"
-            )
-            row = cur.fetchone()
-            if row:
-                alg = row['algoritmo_enrutamiento']
-                if alg in ['dijkstra', 'shortest_path']:
-                    algoritmo = alg
-                else:
-                    print(
-                        f"[WARNING] Algoritmo desconocido en configuracion: {alg}. Usando 'dijkstra'."
-                    )
-            cur.close()
-        except Exception as e:
-            print(f"[ERROR] Error al leer configuracion: {e}")
-        finally:
-            conn.close()
+    # Algoritmo de la configuración activa (en caché)
+    algoritmo = _routing_algorithm()
     # Calcular ruta según algoritmo
     if algoritmo == 'shortest_path':
-        raw_path = calculate_shortest_path(src_dpid, dst_dpid)
+        raw_path = calculate_shortest_path(src_dpid, dst_dpid, excluded_links)
     else:
-        raw_path = calculate_dijkstra_path(src_dpid, dst_dpid)
+        raw_path = calculate_dijkstra_path(src_dpid, dst_dpid, excluded_links)
 
     if raw_path is None:
         return jsonify({"error": "No se encontró camino entre los nodos."}), 404
@@ -324,57 +502,61 @@ def calculate_multicast_tree():
     data = request.get_json(force=True)
     source_dpid = data.get('source_dpid')
     member_dpids = data.get('member_dpids')
+    excluded_links = _parse_excluded_links(data.get('excluded_links'))
 
     if source_dpid is None or not isinstance(member_dpids, list) or not member_dpids:
         return jsonify({"error": "source_dpid o member_dpids faltantes o mal formateados"}), 400
 
     load_topology()
-    tree = {}
+    parents = calculate_dijkstra_tree(source_dpid, excluded_links)
+    serialized_tree, error = _build_multicast_tree(source_dpid, member_dpids, parents)
+    if error:
+        return jsonify({"error": error}), 400
 
-    for dst_dpid in member_dpids:
-        if not isinstance(dst_dpid, int):
-            continue
+    return jsonify({"tree": serialized_tree}), 200
 
-        path = calculate_dijkstra_path(source_dpid, dst_dpid)
-        if not path:
-            return jsonify({"error": f"No se encontró ruta hacia {dst_dpid}"}), 400
 
-        for i in range(len(path) - 1):
-            current_dpid = path[i][0]
-            next_dpid = path[i + 1][0]
 
-            enlace = network_graph.get(current_dpid, {}).get(next_dpid)
-            if not enlace:
-                return jsonify({"error": f"Enlace no encontrado entre {current_dpid} y {next_dpid}"}), 400
+@dijkstra_bp.route('/calculate_multicast_trees', methods=['POST'])
+def calculate_multicast_trees():
+    """
+    Calcula varios árboles multicast con una sola carga de topología. Los grupos con la misma
+    fuente comparten el cálculo del árbol de caminos mínimos.
+    Entrada: {"groups": [{"group": ip, "source_dpid": n, "member_dpids": [...]}], "excluded_links": [...]}
+    Salida: {"trees": {ip: árbol}, "errors": {ip: mensaje}}
+    """
+    data = request.get_json(force=True) or {}
+    entries = data.get('groups')
+    excluded_links = _parse_excluded_links(data.get('excluded_links'))
 
-            port_out = enlace.get('port_out')
-            if not isinstance(port_out, int) or port_out <= 0:
-                return jsonify({"error": f"Puerto inválido entre {current_dpid} y {next_dpid}"}), 400
+    if not isinstance(entries, list):
+        return jsonify({"error": "groups faltante o mal formateado"}), 400
 
-            tree.setdefault(current_dpid, set()).add(port_out)
+    load_topology()
+    spt_by_source = {}
+    trees = {}
+    errors = {}
 
-    # Convertir a JSON serializable
-    serialized_tree = {str(dpid): list(ports) for dpid, ports in tree.items()}
+    for entry in entries:
+        group = entry.get('group')
+        source_dpid = entry.get('source_dpid')
+        member_dpids = entry.get('member_dpids')
 
-    # Agregar salida final hacia cada host conectado a los switches destino (hojas)
-    for leaf_dpid in member_dpids:
-        leaf_str = str(leaf_dpid)
-        if leaf_str in serialized_tree:
+        if not group or source_dpid is None or not isinstance(member_dpids, list) or not member_dpids:
+            errors[str(group)] = "source_dpid o member_dpids faltantes o mal formateados"
             continue
 
-        port_cliente = None
-        for mac, info in host_to_switch_map.items():
-            if info.get('dpid') == leaf_dpid:
-                port_cliente = info.get('port')
-                break
-
-        if not isinstance(port_cliente, int) or port_cliente <= 0:
-            return jsonify({"error": f"No se encontró puerto hacia cliente en switch {leaf_dpid}"}), 400
-
-        serialized_tree[leaf_str] = [port_cliente]
+        if source_dpid not in spt_by_source:
+            spt_by_source[source_dpid] = calculate_dijkstra_tree(source_dpid, excluded_links)
 
-    return jsonify({"tree": serialized_tree}), 200
+        tree, error = _build_multicast_tree(source_dpid, member_dpids, spt_by_source[source_dpid])
+        if error:
+            errors[group] = error
+        else:
+            trees[group] = tree
 
+    logger.info(f"Árboles multicast calculados: {len(trees)} grupos, {len(spt_by_source)} fuentes, {len(errors)} errores.")
+    return jsonify({"trees": trees, "errors": errors}), 200
 
 
 @dijkstra_bp.route('/save_route', methods=['POST'])
@@ -384,31 +566,7 @@ def save_route():
     host_destino = data.get('host_destino')
     ruta = data.get('ruta')
 
-    algoritmo = 'dijkstra'
-    conn = _get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute(
-                "SELECT algoritmo_enrutamiento "
-                "FROM configuracion "
-                "ORDER BY fecha_activacion DESC "
-                "LIMIT 1"
-            )
-            row = cur.fetchone()
-            if row:
-                alg = row['algoritmo_enrutamiento']
-                if alg in ['dijkstra', 'shortest_path']:
-                    algoritmo = alg
-                else:
-                    print(
-                        f"[WARNING] Algoritmo desconocido en configuracion: {alg}. Usando 'dijkstra'."
-                    )
-            cur.close()
-        except Exception as e:
-            print(f"[ERROR] Error al leer configuracion: {e}")
-        finally:
-            conn.close()
+    algoritmo = _routing_algorithm()
     if not all([host_origen, host_destino, ruta]):
         return jsonify({"error": "Faltan parámetros: host_origen, host_destino, ruta"}), 400
 
@@ -1,83 +1,112 @@
 from flask import Blueprint, request, jsonify
 from services.db import get_connection
+import psycopg2.extras
 import logging
+import threading
 
 igmp_bp = Blueprint('igmp', __name__)
 logger = logging.getLogger(__name__)
-group_membership = {}
-
-@igmp_bp.route("/process", methods=["POST"])
-def process_igmp():
-    data = request.get_json()
-    dpid = str(data.get("dpid"))
-    in_port = data.get("in_port")
-    msgtype = data.get("msgtype")
-    address = data.get("address")
-    records = data.get("records", [])
-
-    install_flows = set()
-    remove_flows = set()
-
-    logger.info(f"IGMP recibido: switch={dpid}, puerto={in_port}, tipo={msgtype}")
-
-    if msgtype == 34:  
-        for record in records:
-            group_ip = record.get("address")
-            record_type = record.get("type")
-            sources = record.get("sources", [])
-
-            if record_type in [1, 3]:  
-                if not sources:
-                    logger.info(f" Ignorado IGMPv3 Join vacío para {group_ip}")
-                    continue
-                group_membership.setdefault(group_ip, {}).setdefault(dpid, [])
-                if in_port not in group_membership[group_ip][dpid]:
-                    group_membership[group_ip][dpid].append(in_port)
-                    logger.info(f" [JOIN-v3] {group_ip} -> switch {dpid}, port {in_port}")
-                    install_flows.add(group_ip)
-
-            elif record_type in [2, 4]:  
-                if group_ip in group_membership and dpid in group_membership[group_ip]:
-                    if in_port in group_membership[group_ip][dpid]:
-                        group_membership[group_ip][dpid].remove(in_port)
-                        logger.info(f" [LEAVE-v3] {group_ip} <- switch {dpid}, port {in_port}")
-                        if not group_membership[group_ip][dpid]:
-                            del group_membership[group_ip][dpid]
-                        if not group_membership[group_ip]:
-                            del group_membership[group_ip]
-                            remove_flows.add(group_ip)
-
-    elif msgtype == 22:  
-        group_ip = address
-        group_membership.setdefault(group_ip, {}).setdefault(dpid, [])
-        old_ports = list(group_membership[group_ip][dpid])
-
-        if in_port not in group_membership[group_ip][dpid]:
-            group_membership[group_ip][dpid].append(in_port)
-            logger.info(f" [JOIN-v2] {group_ip} -> switch {dpid}, port {in_port}")
-
-        if sorted(old_ports) != sorted(group_membership[group_ip][dpid]):
-            install_flows.add(group_ip)
-
-
-    elif msgtype == 23:  
-        group_ip = address
-        if group_ip in group_membership and dpid in group_membership[group_ip]:
-            if in_port in group_membership[group_ip][dpid]:
-                group_membership[group_ip][dpid].remove(in_port)
-                logger.info(f" [LEAVE-v2] {group_ip} <- switch {dpid}, port {in_port}")
-
-            if not group_membership[group_ip][dpid]:
-                del group_membership[group_ip][dpid]
-
-            if group_ip in group_membership and not any(group_membership[group_ip].values()):
-                del group_membership[group_ip]
-                remove_flows.add(group_ip)
-
-
-
-    return jsonify({
-        "group_membership": group_membership,
-        "install_flows": list(install_flows),
-        "remove_flows": list(remove_flows)
-    })
\ No newline at end of file
+
+# La pertenencia la calcula el controlador (querier IGMP nativo) y la envía completa a /sync;
+# aquí solo se guarda en PostgreSQL para que todos los workers/procesos del backend compartan
+# la misma vista. Cada sincronización avanza la secuencia igmp_membership_version (versión
+# monótona) y cada proceso guarda una copia en memoria que solo se recarga cuando la versión cambia.
+# La tabla y la secuencia se crean en services/migrations.py.
+MEMBERSHIP_LOCK_KEY = 'igmp_membership'
+
+_cache_lock = threading.Lock()
+_cache = {"version": None, "group_membership": {}}
+
+
+def _current_version(cur):
+
+    cur.execute("SELECT last_value, is_called FROM igmp_membership_version;")
+    last_value, is_called = cur.fetchone()
+    return last_value if is_called else 0
+
+
+def _bump_version(cur):
+
+    cur.execute("SELECT nextval('igmp_membership_version');")
+    return cur.fetchone()[0]
+
+
+def _load_membership(cur):
+    """
+    Devuelve (versión, pertenencia completa), usando la copia del proceso si la versión no cambió.
+    """
+    version = _current_version(cur)
+    with _cache_lock:
+        if _cache["version"] == version:
+            return version, _cache["group_membership"]
+
+    cur.execute("SELECT group_ip, dpid, puerto FROM igmp_membership ORDER BY group_ip, dpid, puerto;")
+    membership = {}
+    for group_ip, dpid, puerto in cur.fetchall():
+        membership.setdefault(group_ip, {}).setdefault(dpid, []).append(puerto)
+
+    with _cache_lock:
+        _cache["version"] = version
+        _cache["group_membership"] = membership
+    return version, membership
+
+
+@igmp_bp.route("/membership", methods=["GET"])
+def get_membership():
+    conn = get_connection()
+    if conn is None:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                version, membership = _load_membership(cur)
+        return jsonify({
+            "version": version,
+            "group_membership": membership
+        })
+    except Exception as e:
+        logger.error(f"Error al leer la pertenencia IGMP: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+@igmp_bp.route("/sync", methods=["POST"])
+def sync_membership():
+    """
+    Recibe la pertenencia completa calculada por el controlador (querier IGMP nativo).
+    Solo se usa para visualización.
+    """
+    data = request.get_json(force=True) or {}
+    membership = data.get("group_membership")
+    if not isinstance(membership, dict):
+        return jsonify({"error": "group_membership faltante o mal formateado"}), 400
+
+    rows = [
+        (group_ip, str(dpid), int(port))
+        for group_ip, switches in membership.items()
+        for dpid, ports in (switches or {}).items()
+        for port in ports
+    ]
+
+    conn = get_connection()
+    if conn is None:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                # Serializa las sincronizaciones concurrentes entre workers
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (MEMBERSHIP_LOCK_KEY,))
+                cur.execute("DELETE FROM igmp_membership;")
+                if rows:
+                    psycopg2.extras.execute_values(
+                        cur, "INSERT INTO igmp_membership (group_ip, dpid, puerto) VALUES %s;", rows
+                    )
+                version = _bump_version(cur)
+        logger.info(f"Pertenencia IGMP sincronizada desde el controlador: {len(membership)} grupos (versión {version})")
+        return jsonify({"version": version})
+    except Exception as e:
+        logger.error(f"Error al sincronizar la pertenencia IGMP: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
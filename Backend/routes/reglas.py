@@ -1,43 +1,161 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
 from config import get_db_connection
+from datetime import datetime
+import base64
 import json
 
 # Crear un Blueprint para las rutas de reglas y logs
 reglas_bp = Blueprint('reglas', __name__)
 
+# Las listas se leen con un cursor del lado del servidor (de STREAM_FETCH_SIZE en
+# STREAM_FETCH_SIZE filas) y se envían en streaming: la memoria no depende del tamaño de la tabla.
+# Con ?limit=N se devuelve una página y la cabecera X-Next-Cursor para pedir la siguiente
+# (?cursor=...), paginando por clave (rule_id en reglas; fecha, id en logs).
+STREAM_FETCH_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+# El controlador escucha este canal y recompila solo la regla indicada en el aviso
+RULES_NOTIFY_CHANNEL = 'reglas_cambiadas'
+
+
+def _regla_to_dict(regla):
+
+    return {
+        "dpid": regla[0],  
+        "rule_id": regla[1],  
+        "priority": regla[2],  
+        "eth_type": regla[3],
+        "ip_proto": regla[4],
+        "ipv4_src": regla[5],
+        "ipv4_dst": regla[6],
+        "tcp_src": regla[7],
+        "tcp_dst": regla[8],
+        "in_port": regla[9],
+        "actions": json.loads(regla[10]) if regla[10] else []  # Suponiendo que "actions" es un campo JSON
+    }
+
+
+def _log_to_dict(log):
+
+    return {
+        "id": log[0],  # id está en la primera columna (índice 0)
+        "timestamp": log[12],  # timestamp está en la segunda columna (índice 1)
+        "dpid": log[1],  # dpid está en la tercera columna (índice 2)
+        "rule_id": log[2],  # rule_id está en la cuarta columna (índice 3)
+        "action": log[13],  # action está en la quinta columna (índice 4)
+        "priority": log[3],  # priority está en la sexta columna (índice 5)
+        "eth_type": log[4],  # eth_type está en la séptima columna (índice 6)
+        "ip_proto": log[5],  # ip_proto está en la octava columna (índice 7)
+        "ipv4_src": log[6],  # ipv4_src está en la novena columna (índice 8)
+        "ipv4_dst": log[7],  # ipv4_dst está en la décima columna (índice 9)
+        "tcp_src": log[8],  # tcp_src está en la undécima columna (índice 10)
+        "tcp_dst": log[9],  # tcp_dst está en la duodécima columna (índice 11)
+        "in_port": log[10],  # in_port está en la decimotercera columna (índice 12)
+        "actions": json.loads(log[11]) if log[11] else []  # actions está en la decimocuarta columna (índice 13)
+    }
+
+
+def _encode_cursor(values):
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode_cursor(raw):
+    """
+    Devuelve la lista de valores del cursor o None si no se indicó. Lanza ValueError si es inválido.
+    """
+    if not raw:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(raw.encode()))
+    except Exception:
+        raise ValueError("Cursor inválido")
+    if not isinstance(values, list):
+        raise ValueError("Cursor inválido")
+    return values
+
+
+def _page_limit():
+    """
+    Tamaño de página pedido (?limit=N) o None para recorrer la tabla completa.
+    """
+    raw = request.args.get('limit')
+    if raw is None:
+        return None
+    limit = int(raw)
+    if limit <= 0:
+        raise ValueError("limit debe ser positivo")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def _stream_rows(conn, name, query, params, to_dict, prefix, suffix, empty_body):
+    """
+    Ejecuta la consulta con un cursor con nombre (lado del servidor) y devuelve una respuesta
+    JSON en streaming: prefix, elementos separados por comas, suffix. Si no hay filas se responde
+    empty_body, como antes. Cierra la conexión al terminar el envío.
+    """
+    cursor = conn.cursor(name=name)
+    cursor.itersize = STREAM_FETCH_SIZE
+    cursor.execute(query, params)
+    first = cursor.fetchone()
+    if first is None:
+        cursor.close()
+        conn.close()
+        return jsonify(empty_body), 200
+
+    dumps = current_app.json.dumps
+
+    def generate():
+        try:
+            yield prefix + dumps(to_dict(first))
+            for row in cursor:
+                yield "," + dumps(to_dict(row))
+            yield suffix
+        finally:
+            cursor.close()
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _notify_rule_change(cursor, rule_id):
+    """
+    Avisa al controlador del cambio; PostgreSQL solo entrega el aviso si la transacción se confirma.
+    """
+    cursor.execute("SELECT pg_notify(%s, %s)", (RULES_NOTIFY_CHANNEL, str(int(rule_id))))
+
+
 # Ruta para obtener todas las reglas
 @reglas_bp.route('/', methods=['GET'])
 def obtener_reglas():
-    """Retrieve all rules stored in the PostgreSQL database."""
+    """Retrieve the rules stored in the PostgreSQL database (streamed, optionally paginated)."""
+    try:
+        limit = _page_limit()
+        cursor_values = _decode_cursor(request.args.get('cursor'))
+        after_rule_id = int(cursor_values[0]) if cursor_values else None
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify({"error": f"Invalid pagination parameters: {str(e)}"}), 400
+
     try:
         conn = get_db_connection()  # Usamos la conexión a PostgreSQL
-        cursor = conn.cursor()
 
-        # Get all rules from the database
-        cursor.execute("SELECT * FROM reglas")
+        if limit is None and after_rule_id is None:
+            # Todas las reglas, en streaming
+            return _stream_rows(conn, 'reglas_stream', "SELECT * FROM reglas ORDER BY rule_id", (),
+                                _regla_to_dict, '{"switches": [', ']}', {"message": "No rules registered."})
+
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM reglas WHERE (%s IS NULL OR rule_id > %s) ORDER BY rule_id LIMIT %s",
+            (after_rule_id, after_rule_id, limit or MAX_PAGE_SIZE)
+        )
         reglas = cursor.fetchall()
+        conn.close()
 
-        if not reglas:
-            return jsonify({"message": "No rules registered."}), 200
-
-        # Convert results to JSON format
-        reglas_lista = []
-        for regla in reglas:
-            reglas_lista.append({
-                "dpid": regla[0],  
-                "rule_id": regla[1],  
-                "priority": regla[2],  
-                "eth_type": regla[3],
-                "ip_proto": regla[4],
-                "ipv4_src": regla[5],
-                "ipv4_dst": regla[6],
-                "tcp_src": regla[7],
-                "tcp_dst": regla[8],
-                "in_port": regla[9],
-                "actions": json.loads(regla[10]) if regla[10] else []  # Suponiendo que "actions" es un campo JSON
-            })
-
-        return jsonify({"switches": reglas_lista})
+        response = jsonify({"switches": [_regla_to_dict(regla) for regla in reglas]})
+        if reglas and len(reglas) == (limit or MAX_PAGE_SIZE):
+            response.headers['X-Next-Cursor'] = _encode_cursor([reglas[-1][1]])
+        return response
 
     except Exception as e:
         return jsonify({"error": f"Error fetching rules: {str(e)}"}), 500
@@ -82,6 +200,7 @@ def agregar_regla(dpid):
             json.dumps(data["actions"])  # Convertir 'actions' a JSON si es válido
         ))
 
+        _notify_rule_change(cursor, data["rule_id"])
         conn.commit()
         return jsonify({"message": "Rule added successfully", "rule_id": data["rule_id"]})
 
@@ -169,6 +288,7 @@ def modificar_regla(rule_id):
         sql_update = f"UPDATE reglas SET {', '.join(fields_to_update)} WHERE rule_id = %s"
         
         cursor.execute(sql_update, values)
+        _notify_rule_change(cursor, rule_id)
         conn.commit()
 
         return jsonify({"message": "Rule modified successfully", "rule_id": rule_id})
@@ -200,6 +320,7 @@ def eliminar_regla(rule_id):
 
         # Eliminar la regla
         cursor.execute("DELETE FROM reglas WHERE rule_id = %s", (rule_id,))
+        _notify_rule_change(cursor, rule_id)
         conn.commit()
 
         # Verificar si el switch tiene más reglas asociadas
@@ -216,38 +337,40 @@ def eliminar_regla(rule_id):
 # Ruta para obtener todos los logs
 @reglas_bp.route('/logs', methods=['GET'])
 def obtener_logs():
-    """Retrieve all change logs from the PostgreSQL database."""
+    """Retrieve the change logs, newest first (streamed, optionally paginated)."""
+    try:
+        limit = _page_limit()
+        cursor_values = _decode_cursor(request.args.get('cursor'))
+        after = None
+        if cursor_values:
+            after = (datetime.fromisoformat(cursor_values[0]), int(cursor_values[1]))
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify({"error": f"Invalid pagination parameters: {str(e)}"}), 400
+
     try:
         conn = get_db_connection()  # Conexión a PostgreSQL
-        cursor = conn.cursor()
 
-        # Ejecutar la consulta para obtener todos los logs ordenados por timestamp descendente
-        cursor.execute("SELECT * FROM logs ORDER BY fecha DESC")
+        if limit is None and after is None:
+            # Todos los logs ordenados por fecha descendente, en streaming
+            return _stream_rows(conn, 'logs_stream', "SELECT * FROM logs ORDER BY fecha DESC, id DESC", (),
+                                _log_to_dict, '[', ']', {"message": "No log records."})
+
+        cursor = conn.cursor()
+        if after is None:
+            cursor.execute("SELECT * FROM logs ORDER BY fecha DESC, id DESC LIMIT %s", (limit or MAX_PAGE_SIZE,))
+        else:
+            cursor.execute(
+                "SELECT * FROM logs WHERE (fecha, id) < (%s, %s) ORDER BY fecha DESC, id DESC LIMIT %s",
+                (after[0], after[1], limit or MAX_PAGE_SIZE)
+            )
         logs = cursor.fetchall()
+        conn.close()
 
-        if not logs:
-            return jsonify({"message": "No log records."}), 200
-
-        logs_lista = []
-        for log in logs:
-            logs_lista.append({
-                "id": log[0],  # id está en la primera columna (índice 0)
-                "timestamp": log[12],  # timestamp está en la segunda columna (índice 1)
-                "dpid": log[1],  # dpid está en la tercera columna (índice 2)
-                "rule_id": log[2],  # rule_id está en la cuarta columna (índice 3)
-                "action": log[13],  # action está en la quinta columna (índice 4)
-                "priority": log[3],  # priority está en la sexta columna (índice 5)
-                "eth_type": log[4],  # eth_type está en la séptima columna (índice 6)
-                "ip_proto": log[5],  # ip_proto está en la octava columna (índice 7)
-                "ipv4_src": log[6],  # ipv4_src está en la novena columna (índice 8)
-                "ipv4_dst": log[7],  # ipv4_dst está en la décima columna (índice 9)
-                "tcp_src": log[8],  # tcp_src está en la undécima columna (índice 10)
-                "tcp_dst": log[9],  # tcp_dst está en la duodécima columna (índice 11)
-                "in_port": log[10],  # in_port está en la decimotercera columna (índice 12)
-                "actions": json.loads(log[11]) if log[11] else []  # actions está en la decimocuarta columna (índice 13)
-            })
-
-        return jsonify(logs_lista)
+        response = jsonify([_log_to_dict(log) for log in logs])
+        if logs and len(logs) == (limit or MAX_PAGE_SIZE):
+            last = logs[-1]
+            response.headers['X-Next-Cursor'] = _encode_cursor([last[12].isoformat(), last[0]])
+        return response
 
     except Exception as e:
         return jsonify({"error": f"Error fetching logs: {str(e)}"}), 500
@@ -9,23 +9,25 @@ from routes.stats import registrar_evento
 
 from config import Config
 from services.db import fetch_all, fetch_one, execute_query  
+from services.shared_state import next_in_sequence
 
 servers_bp = Blueprint('servers', __name__)
 url_agent = Config.MININET_AGENT_URL
 
-# Variables para asignación de IPs multicast
-video_processes = {}
+# Asignación de IPs multicast: el índice es una secuencia de PostgreSQL para que dos workers
+# nunca entreguen la misma IP. La IP de un servidor vive en servidores_vlc_activos.
 MULTICAST_IP_POOL_START = 0xEF000001
-NEXT_MULTICAST_IP_INDEX = 0
-ALLOCATED_MULTICAST_IPS = {}
+MULTICAST_IP_SEQUENCE = 'multicast_ip_pool_seq'
 
 def get_next_multicast_ip():
     """
     Genera la siguiente dirección IP multicast de forma incremental.
+    Devuelve None si no se puede reservar el índice en la base de datos.
     """
-    global NEXT_MULTICAST_IP_INDEX
-    base_ip = MULTICAST_IP_POOL_START + NEXT_MULTICAST_IP_INDEX
-    NEXT_MULTICAST_IP_INDEX += 1
+    value = next_in_sequence(MULTICAST_IP_SEQUENCE)
+    if value is None:
+        return None
+    base_ip = MULTICAST_IP_POOL_START + value - 1
     return f"{((base_ip >> 24) & 0xFF)}.{(base_ip >> 16) & 0xFF}.{(base_ip >> 8) & 0xFF}.{(base_ip & 0xFF)}"
 
 @servers_bp.route('/add', methods=['POST'])
@@ -54,6 +56,8 @@ def iniciar_servidor_hosts_table():
         else:
             multicast_ip   = get_next_multicast_ip()
             multicast_port = 5004
+            if multicast_ip is None:
+                return jsonify({"error": "No se pudo asignar una IP multicast."}), 500
 
         # INSERT o UPDATE en la tabla servidores_vlc_activos
         query_vlc = """
@@ -168,10 +172,6 @@ def remover_servidor_hosts_table():
         if ok_vlc is False:
             return jsonify({"error": "No se pudo eliminar el servidor VLC de la base de datos."}), 500
 
-        # Liberar IP multicast de ser necesario
-        if nombre in ALLOCATED_MULTICAST_IPS:
-            del ALLOCATED_MULTICAST_IPS[nombre]
-
         return jsonify({"message": "Servidor y clientes eliminados correctamente."}), 200
 
     except Exception as e:
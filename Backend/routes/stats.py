@@ -1,102 +1,197 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, Response, jsonify, request
 from services.db import fetch_all
+import hashlib
+import threading
+import time
 
 bp = Blueprint('stats', __name__)
 
-from services.db import fetch_one, execute_query
-import logging
+from services.db import fetch_one
+from services import event_recorder, timeseries
 
 def registrar_evento(tipo, nombre_host):
-    try:
-        host = fetch_one("SELECT id_host FROM hosts WHERE nombre = %s", (nombre_host,))
-        if host:
-            execute_query(
-                "INSERT INTO estadisticas (id_host, tipo, timestamp) VALUES (%s, %s, NOW())",
-                (host['id_host'], tipo)
-            )
-        else:
-            logging.warning(f"No se encontró el host '{nombre_host}' para registrar evento '{tipo}'")
-    except Exception as e:
-        logging.error(f"Error al registrar evento '{tipo}' para host '{nombre_host}': {str(e)}")
+    """
+    Registra el evento de forma asíncrona: se encola y lo escribe en lote el hilo de event_recorder.
+    """
+    event_recorder.record(tipo, nombre_host)
+
+
+# El panel se consulta por sondeo: una única consulta (CTE) por worker cada DASHBOARD_TTL
+# segundos, y las respuestas sin cambios se contestan con 304 gracias al ETag.
+DASHBOARD_TTL = 2
+_dashboard_lock = threading.Lock()
+_dashboard_cache = {"body": None, "etag": None, "expires": 0}
+
+DASHBOARD_QUERY = """
+    WITH clientes AS (
+        SELECT host_cliente, servidor_asignado, ip_destino FROM clientes_activos
+    ),
+    activos AS (
+        SELECT host_name, server_weight, ip_destino
+        FROM servidores_vlc_activos
+        WHERE status = 'activo'
+    ),
+    por_servidor AS (
+        SELECT servidor_asignado AS servidor, COUNT(*) AS total_clientes
+        FROM clientes
+        GROUP BY servidor_asignado
+    ),
+    carga AS (
+        SELECT s.host_name AS servidor, s.server_weight AS peso_configurado,
+               COUNT(c.host_cliente) AS clientes_asignados
+        FROM activos s
+        LEFT JOIN clientes c ON c.servidor_asignado = s.host_name
+        GROUP BY s.host_name, s.server_weight
+    ),
+    eventos AS (
+        SELECT h.nombre AS host, e.tipo AS tipo_evento, e.timestamp
+        FROM estadisticas e
+        JOIN hosts h ON e.id_host = h.id_host
+        ORDER BY e.timestamp DESC
+        LIMIT 10
+    ),
+    grupos AS (
+        SELECT ip_destino AS grupo, COUNT(*) AS total_puertos
+        FROM clientes
+        GROUP BY ip_destino
+    )
+    SELECT
+        COALESCE((SELECT json_agg(p) FROM por_servidor p), '[]'::json) AS clientes_por_servidor,
+        (SELECT COUNT(DISTINCT ip_destino) FROM activos) AS transmisiones_activas,
+        (SELECT COUNT(*) FROM clientes) AS total_clientes,
+        COALESCE((SELECT json_agg(c) FROM carga c), '[]'::json) AS carga_vs_peso,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'host', ev.host,
+                'tipo_evento', ev.tipo_evento,
+                -- Mismo formato HTTP-date que producía jsonify con el datetime
+                'timestamp', to_char(ev.timestamp, 'Dy, DD Mon YYYY HH24:MI:SS "GMT"')
+            ) ORDER BY ev.timestamp DESC)
+            FROM eventos ev
+        ), '[]'::json) AS ultimos_eventos,
+        COALESCE((SELECT json_agg(g) FROM grupos g), '[]'::json) AS flujos_multicast;
+"""
+
+
+def _dashboard_snapshot():
+    """
+    Devuelve (cuerpo JSON, etag) del panel, recalculándolo como mucho una vez por TTL.
+    Lanza RuntimeError si la consulta falla.
+    """
+    with _dashboard_lock:
+        if _dashboard_cache["body"] is not None and time.time() < _dashboard_cache["expires"]:
+            return _dashboard_cache["body"], _dashboard_cache["etag"]
+
+        row = fetch_one(DASHBOARD_QUERY)
+        if row is None:
+            raise RuntimeError("No se pudo consultar la base de datos")
+
+        body = jsonify(dict(row)).get_data()
+        _dashboard_cache["body"] = body
+        _dashboard_cache["etag"] = hashlib.sha1(body).hexdigest()
+        _dashboard_cache["expires"] = time.time() + DASHBOARD_TTL
+        return body, _dashboard_cache["etag"]
 
 
 @bp.route('/dashboard', methods=['GET'])
 def get_dashboard_stats():
     try:
-        # Clientes por servidor
-        clientes_por_servidor = fetch_all("""
-            SELECT servidor_asignado AS servidor, COUNT(*) AS total_clientes
-            FROM clientes_activos
-            GROUP BY servidor_asignado;
-        """)
-
-        # Total de transmisiones 
-        transmisiones_activas = fetch_all("""
-            SELECT COUNT(DISTINCT ip_destino) AS total_transmisiones
-            FROM servidores_vlc_activos
-            WHERE status = 'activo';
-        """)[0]['total_transmisiones']
-
-        # Clientes activos totales
-        total_clientes = fetch_all("""
-            SELECT COUNT(*) AS total_clientes
-            FROM clientes_activos;
-        """)[0]['total_clientes']
-
-        # Carga vs peso
-        carga_vs_peso = fetch_all("""
-            SELECT s.host_name AS servidor, s.server_weight AS peso_configurado,
-                   COUNT(c.host_cliente) AS clientes_asignados
-            FROM servidores_vlc_activos s
-            LEFT JOIN clientes_activos c ON c.servidor_asignado = s.host_name
-            WHERE s.status = 'activo'
-            GROUP BY s.host_name, s.server_weight;
-        """)
-
-        # Últimos eventos 
-        ultimos_eventos = fetch_all("""
-            SELECT h.nombre AS host, e.tipo AS tipo_evento, e.timestamp
-            FROM estadisticas e
-            JOIN hosts h ON e.id_host = h.id_host
-            ORDER BY e.timestamp DESC
-            LIMIT 10;
-        """)
-
-        # Total de flujos multicast activos 
-        flujos_multicast = fetch_all("""
-            SELECT ip_destino AS grupo, COUNT(*) AS total_puertos
-            FROM clientes_activos
-            GROUP BY ip_destino;
-        """)
-
-        return jsonify({
-            "clientes_por_servidor": clientes_por_servidor,
-            "transmisiones_activas": transmisiones_activas,
-            "total_clientes": total_clientes,
-            "carga_vs_peso": carga_vs_peso,
-            "ultimos_eventos": ultimos_eventos,
-            "flujos_multicast": flujos_multicast
-        }), 200
+        body, etag = _dashboard_snapshot()
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # El navegador debe revalidar siempre; si nada cambió recibe 304 sin cuerpo
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
     except Exception as e:
         return jsonify({"error": f"Error al generar estadísticas: {str(e)}"}), 500
 
+@bp.route('/eventos/cola', methods=['GET'])
+def get_event_queue_stats():
+    # Contadores del registro asíncrono de eventos de este worker
+    return jsonify(event_recorder.get_stats())
+
+def _latency_rollup_query(keys, window_condition):
+    """
+    Consulta sobre los agregados de latencias agrupada por `keys`: media, mínimo y máximo exactos
+    y percentiles aproximados a partir de la suma de los histogramas de las cubetas.
+    """
+    return f"""
+        WITH agregados AS (
+            SELECT {keys},
+                   SUM(muestras) AS muestras,
+                   SUM(suma_rtt) / SUM(muestras) AS rtt,
+                   SUM(suma_jitter) / NULLIF(SUM(muestras_jitter), 0) AS jitter,
+                   MIN(rtt_min) AS rtt_min,
+                   MAX(rtt_max) AS rtt_max,
+                   MAX(ultima_ruta) AS ultima_ruta
+            FROM latencias_rollup
+            WHERE {window_condition}
+            GROUP BY {keys}
+        ),
+        histograma AS (
+            SELECT {keys}, metrica, celda, SUM(muestras) AS n
+            FROM latencias_rollup_sketch
+            WHERE {window_condition}
+            GROUP BY {keys}, metrica, celda
+        ),
+        acumulado AS (
+            SELECT h.*,
+                   SUM(n) OVER (PARTITION BY {keys}, metrica ORDER BY celda) AS acumuladas,
+                   SUM(n) OVER (PARTITION BY {keys}, metrica) AS total
+            FROM histograma h
+        ),
+        percentiles AS (
+            SELECT {keys},
+                   latencia_valor_celda(MIN(celda) FILTER (WHERE metrica = 'rtt' AND acumuladas >= 0.50 * total)) AS rtt_p50,
+                   latencia_valor_celda(MIN(celda) FILTER (WHERE metrica = 'rtt' AND acumuladas >= 0.95 * total)) AS rtt_p95,
+                   latencia_valor_celda(MIN(celda) FILTER (WHERE metrica = 'rtt' AND acumuladas >= 0.99 * total)) AS rtt_p99,
+                   latencia_valor_celda(MIN(celda) FILTER (WHERE metrica = 'jitter' AND acumuladas >= 0.95 * total)) AS jitter_p95
+            FROM acumulado
+            GROUP BY {keys}
+        )
+        SELECT a.*, p.rtt_p50, p.rtt_p95, p.rtt_p99, p.jitter_p95
+        FROM agregados a
+        LEFT JOIN percentiles p USING ({keys})
+    """
+
+
+def _round(value, digits=3):
+
+    return round(float(value), digits) if value is not None else None
+
+
 @bp.route('/combined_stats', methods=['GET'])
 def get_combined_stats():
     try:
-        # Fetch combined data from both rutas_ping and latencias
-        combined_stats = fetch_all("""
-            SELECT
-                l.host_origen,
-                l.host_destino,
-                r.descripcion AS ruta,
-                r.algoritmo_enrutamiento,
-                l.rtt_ms AS rtt,
-                l.jitter_ms AS jitter
-            FROM rutas_ping r
-            JOIN latencias l ON r.id_ruta = l.id_ruta;
-        """)
-        
+        if not timeseries.schema_ready():
+            return jsonify({"error": "Los agregados de latencias no están disponibles"}), 503
+        # Una fila por par de hosts y algoritmo, leída de los agregados: el coste no depende
+        # del número de medidas almacenadas
+        condition, params = timeseries.rollup_window(request.args.get('horas', type=int))
+        rows = fetch_all(f"""
+            SELECT s.*, r.descripcion AS ruta
+            FROM ({_latency_rollup_query("algoritmo_enrutamiento, host_origen, host_destino", condition)}) s
+            LEFT JOIN rutas_ping r ON r.id_ruta = s.ultima_ruta
+            ORDER BY s.host_origen, s.host_destino, s.algoritmo_enrutamiento;
+        """, params)
+
+        combined_stats = [{
+            "host_origen": row['host_origen'],
+            "host_destino": row['host_destino'],
+            "ruta": row['ruta'],
+            "algoritmo_enrutamiento": row['algoritmo_enrutamiento'],
+            "muestras": row['muestras'],
+            "rtt": _round(row['rtt']),
+            "jitter": _round(row['jitter']),
+            "rtt_min": _round(row['rtt_min']),
+            "rtt_max": _round(row['rtt_max']),
+            "rtt_p50": _round(row['rtt_p50']),
+            "rtt_p95": _round(row['rtt_p95']),
+            "rtt_p99": _round(row['rtt_p99']),
+            "jitter_p95": _round(row['jitter_p95'])
+        } for row in rows]
+
         return jsonify(combined_stats), 200
     
     except Exception as e:
@@ -105,16 +200,15 @@ def get_combined_stats():
 @bp.route('/comparar_algoritmos', methods=['GET'])
 def comparar_algoritmos():
     try:
-        # Obtener las métricas de RTT y Jitter para cada algoritmo
-        metrics = fetch_all("""
-            SELECT r.algoritmo_enrutamiento, 
-                   AVG(l.rtt_ms) AS avg_rtt, 
-                   AVG(l.jitter_ms) AS avg_jitter
-            FROM rutas_ping r
-            JOIN latencias l ON r.id_ruta = l.id_ruta
-            WHERE r.algoritmo_enrutamiento IN ('dijkstra', 'shortest_path')
-            GROUP BY r.algoritmo_enrutamiento;
-        """)
+        if not timeseries.schema_ready():
+            return jsonify({"error": "Los agregados de latencias no están disponibles"}), 503
+        # Obtener las métricas de RTT y Jitter para cada algoritmo desde los agregados
+        condition, params = timeseries.rollup_window(request.args.get('horas', type=int))
+        metrics = fetch_all(
+            _latency_rollup_query("algoritmo_enrutamiento", condition)
+            + " WHERE a.algoritmo_enrutamiento IN ('dijkstra', 'shortest_path');",
+            params
+        )
 
         # Preparar los datos para el gráfico
         data = {
@@ -129,14 +223,34 @@ def comparar_algoritmos():
         }
 
         for metric in metrics:
-            if metric['algoritmo_enrutamiento'] == 'dijkstra':
-                data['dijkstra']['avg_rtt'] = metric['avg_rtt']
-                data['dijkstra']['avg_jitter'] = metric['avg_jitter']
-            elif metric['algoritmo_enrutamiento'] == 'shortest_path':
-                data['shortest_path']['avg_rtt'] = metric['avg_rtt']
-                data['shortest_path']['avg_jitter'] = metric['avg_jitter']
+            data[metric['algoritmo_enrutamiento']] = {
+                "avg_rtt": _round(metric['rtt']),
+                "avg_jitter": _round(metric['jitter']),
+                "p95_rtt": _round(metric['rtt_p95']),
+                "p95_jitter": _round(metric['jitter_p95']),
+                "muestras": metric['muestras']
+            }
 
         return jsonify(data), 200
 
     except Exception as e:
         return jsonify({"error": f"Error al generar la comparación: {str(e)}"}), 500
+
+@bp.route('/eventos/series', methods=['GET'])
+def eventos_series():
+    try:
+        if not timeseries.schema_ready():
+            return jsonify({"error": "Los agregados de eventos no están disponibles"}), 503
+        # Eventos por tipo y cubeta (minuto hasta 24 h, hora en ventanas mayores); por defecto 24 h
+        horas = request.args.get('horas', default=24, type=int)
+        condition, params = timeseries.rollup_window(horas)
+        rows = fetch_all(f"""
+            SELECT to_char(bucket, 'YYYY-MM-DD"T"HH24:MI:SS') AS bucket, tipo, eventos
+            FROM estadisticas_rollup
+            WHERE {condition}
+            ORDER BY bucket, tipo;
+        """, params)
+        return jsonify({"granularidad": params["granularidad"], "series": rows}), 200
+
+    except Exception as e:
+        return jsonify({"error": f"Error al generar la serie de eventos: {str(e)}"}), 500
@@ -0,0 +1,184 @@
+import os
+import select
+import threading
+import time
+from datetime import datetime
+from psycopg2.extras import RealDictCursor
+from services.db import get_connection
+
+# Copia en memoria de la configuración activa (última fila de configuracion). Las escrituras
+# pasan por save_config, que actualiza la copia local y emite NOTIFY en la misma transacción;
+# cada worker escucha el canal con LISTEN e invalida su copia al recibir el aviso. Si la
+# conexión de escucha no está disponible, la copia caduca a los FALLBACK_TTL segundos.
+
+CONFIG_CHANNEL = 'configuracion_cambiada'
+FALLBACK_TTL = 5
+LISTEN_RECONNECT_DELAY = 5
+
+_CONFIG_FIELDS = ('algoritmo_balanceo', 'algoritmo_enrutamiento', 'fecha_activacion')
+_EMPTY_CONFIG = {field: None for field in _CONFIG_FIELDS}
+
+_lock = threading.Lock()
+_state = {
+    "config": None,       # dict con _CONFIG_FIELDS, None si hay que recargar
+    "version": 0,         # avanza con cada cambio observado por este proceso
+    "generation": 0,      # avanza con cada invalidación: descarta cargas iniciadas antes
+    "loaded_at": 0,
+    "listening": False,
+    "listener_pid": None  # el hilo de escucha no sobrevive al fork de los workers
+}
+
+
+def _load():
+
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                "SELECT algoritmo_balanceo, algoritmo_enrutamiento, fecha_activacion "
+                "FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1;"
+            )
+            row = cur.fetchone()
+        return dict(row) if row else dict(_EMPTY_CONFIG)
+    except Exception as e:
+        print(f"Error al cargar la configuración activa: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def _store(config, generation=None):
+
+    with _lock:
+        if generation is not None and generation != _state["generation"]:
+            return
+        if config != _state["config"]:
+            _state["version"] += 1
+        _state["config"] = config
+        _state["loaded_at"] = time.time()
+
+
+def invalidate():
+
+    with _lock:
+        _state["config"] = None
+        _state["generation"] += 1
+
+
+def _listen_loop():
+    """
+    Mantiene una conexión con LISTEN al canal de configuración e invalida la copia local con
+    cada aviso. Se reconecta si la conexión se pierde.
+    """
+    while True:
+        conn = get_connection()
+        if conn is None:
+            time.sleep(LISTEN_RECONNECT_DELAY)
+            continue
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CONFIG_CHANNEL};")
+            with _lock:
+                _state["listening"] = True
+            # Lo cambiado mientras no se escuchaba no generó aviso para este proceso
+            invalidate()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    invalidate()
+        except Exception as e:
+            print(f"Conexión LISTEN de configuración perdida: {e}")
+        finally:
+            with _lock:
+                _state["listening"] = False
+            try:
+                conn.close()
+            except Exception:
+                pass
+        time.sleep(LISTEN_RECONNECT_DELAY)
+
+
+def _ensure_listener():
+
+    pid = os.getpid()
+    with _lock:
+        if _state["listener_pid"] == pid:
+            return
+        _state["listener_pid"] = pid
+        _state["listening"] = False
+    threading.Thread(target=_listen_loop, name="config-listener", daemon=True).start()
+
+
+def get_active_config():
+    """
+    Devuelve (sin consultar la base de datos salvo tras un cambio) la configuración activa:
+    {'algoritmo_balanceo', 'algoritmo_enrutamiento', 'fecha_activacion'}.
+    """
+    _ensure_listener()
+    with _lock:
+        config = _state["config"]
+        fresh = _state["listening"] or time.time() - _state["loaded_at"] < FALLBACK_TTL
+        generation = _state["generation"]
+    if config is not None and fresh:
+        return dict(config)
+
+    config = _load()
+    if config is None:
+        # Sin base de datos se sigue sirviendo la última configuración conocida
+        with _lock:
+            return dict(_state["config"] or _EMPTY_CONFIG)
+    _store(config, generation)
+    return dict(config)
+
+
+def get_config_version():
+
+    with _lock:
+        return _state["version"]
+
+
+def save_config(algoritmo_balanceo=None, algoritmo_enrutamiento=None):
+    """
+    Activa una nueva configuración. Los campos en None conservan el valor de la configuración
+    vigente. Devuelve la fila insertada o None si falló la escritura.
+    """
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    WITH actual AS (
+                        SELECT algoritmo_balanceo, algoritmo_enrutamiento
+                        FROM configuracion ORDER BY fecha_activacion DESC LIMIT 1
+                    )
+                    INSERT INTO configuracion (algoritmo_balanceo, algoritmo_enrutamiento)
+                    SELECT COALESCE(%s, (SELECT algoritmo_balanceo FROM actual)),
+                           COALESCE(%s, (SELECT algoritmo_enrutamiento FROM actual))
+                    RETURNING algoritmo_balanceo, algoritmo_enrutamiento, fecha_activacion;
+                """, (algoritmo_balanceo, algoritmo_enrutamiento))
+                row = dict(cur.fetchone())
+                # Se entrega a los demás workers al confirmar la transacción
+                cur.execute(f"NOTIFY {CONFIG_CHANNEL};")
+        _store(row)
+        return row
+    except Exception as e:
+        print(f"Error al guardar la configuración: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def serialize_config(config):
+
+    result = dict(config)
+    if isinstance(result.get('fecha_activacion'), datetime):
+        result['fecha_activacion'] = result['fecha_activacion'].isoformat()
+    return result
@@ -80,3 +80,24 @@ def execute_query(query, params=None):
         if conn:
             conn.close() # Asegura que la conexión se cierre incluso en caso de error
         return False # Indica que la operación falló
+
+def execute_returning(query, params=None):
+    """
+    Ejecuta una consulta INSERT, UPDATE o DELETE con RETURNING y devuelve las filas devueltas
+    como una lista de diccionarios. Devuelve None en caso de error de conexión o ejecución.
+    """
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, params or ())
+                result = cur.fetchall()
+        conn.close()
+        return result
+    except Exception as e:
+        print(f"Error al ejecutar execute_returning: {e}")
+        if conn:
+            conn.close()
+        return None
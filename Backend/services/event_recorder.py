@@ -0,0 +1,175 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from psycopg2.extras import execute_values
+from services.db import get_connection
+
+# Registro asíncrono de eventos en estadisticas. record() solo encola (no toca la base de datos)
+# y un hilo escritor por proceso agrupa los eventos y los inserta con un único INSERT de varias
+# filas. La cola está acotada: si la base de datos no da abasto, los eventos sobrantes se
+# descartan y se cuentan en lugar de frenar las peticiones.
+
+EVENT_QUEUE_SIZE = int(os.environ.get("BACKEND_EVENT_QUEUE_SIZE", "10000"))
+EVENT_BATCH_SIZE = 500
+EVENT_FLUSH_INTERVAL = 0.5
+EVENT_MAX_RETRIES = 3
+EVENT_RETRY_DELAY = 2
+SHUTDOWN_FLUSH_TIMEOUT = 5
+
+_queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+_lock = threading.Lock()
+_host_ids = {}  # {nombre: id_host}
+_state = {
+    "writer_pid": None,  # el hilo escritor no sobrevive al fork de los workers
+    "encolados": 0,
+    "escritos": 0,
+    "descartados": 0,
+    "cola_llena": 0,  # parte de descartados: eventos rechazados por record() con la cola llena
+    "sin_host": 0
+}
+
+
+def _count(field, amount=1):
+
+    with _lock:
+        _state[field] += amount
+
+
+def _resolve_hosts(cur, names):
+    """
+    Completa la caché nombre -> id_host con los nombres que aún no están en ella.
+    """
+    missing = [name for name in names if name not in _host_ids]
+    if missing:
+        cur.execute("SELECT nombre, id_host FROM hosts WHERE nombre = ANY(%s);", (missing,))
+        _host_ids.update(cur.fetchall())
+
+
+def _write_batch(events):
+    """
+    Inserta un lote de eventos (tipo, nombre_host, instante). Devuelve False si hay que reintentar.
+    """
+    conn = get_connection()
+    if conn is None:
+        return False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                _resolve_hosts(cur, {name for _, name, _ in events})
+                rows = []
+                for tipo, name, created in events:
+                    host_id = _host_ids.get(name)
+                    if host_id is None:
+                        _count("sin_host")
+                        print(f"No se encontró el host '{name}' para registrar evento '{tipo}'")
+                        continue
+                    rows.append((host_id, tipo, created))
+                if rows:
+                    # to_timestamp conserva el instante en que ocurrió el evento, no el de la escritura
+                    execute_values(
+                        cur, "INSERT INTO estadisticas (id_host, tipo, timestamp) VALUES %s;", rows,
+                        template="(%s, %s, to_timestamp(%s))", page_size=EVENT_BATCH_SIZE
+                    )
+        _count("escritos", len(rows))
+        return True
+    except Exception as e:
+        print(f"Error al registrar {len(events)} eventos: {e}")
+        # Un host borrado o renombrado deja ids obsoletos en la caché
+        _host_ids.clear()
+        return False
+    finally:
+        conn.close()
+
+
+def _drain(first=None):
+
+    events = [first] if first is not None else []
+    while len(events) < EVENT_BATCH_SIZE:
+        try:
+            events.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return events
+
+
+def _flush_events(events):
+
+    for _ in range(EVENT_MAX_RETRIES):
+        if _write_batch(events):
+            return
+        time.sleep(EVENT_RETRY_DELAY)
+    _count("descartados", len(events))
+    print(f"Se descartan {len(events)} eventos tras {EVENT_MAX_RETRIES} intentos fallidos")
+
+
+def _writer_loop():
+
+    # Los descartes por cola llena se avisan desde aquí, como mucho una vez por intervalo,
+    # para no escribir en stdout en cada petición justo cuando el proceso está saturado
+    reported = 0
+    last_report = 0
+    while True:
+        try:
+            first = _queue.get(timeout=EVENT_FLUSH_INTERVAL)
+            _flush_events(_drain(first))
+        except queue.Empty:
+            pass
+        now = time.time()
+        if now - last_report >= EVENT_FLUSH_INTERVAL:
+            with _lock:
+                dropped = _state["cola_llena"]
+            if dropped > reported:
+                print(f"Cola de eventos llena: {dropped - reported} eventos descartados desde el último aviso")
+                reported = dropped
+            last_report = now
+
+
+def _ensure_writer():
+
+    pid = os.getpid()
+    with _lock:
+        if _state["writer_pid"] == pid:
+            return
+        _state["writer_pid"] = pid
+    threading.Thread(target=_writer_loop, name="event-recorder", daemon=True).start()
+
+
+def record(tipo, nombre_host):
+    """
+    Encola un evento para estadisticas sin esperar a la base de datos.
+    """
+    _ensure_writer()
+    try:
+        _queue.put_nowait((tipo, nombre_host, time.time()))
+        _count("encolados")
+    except queue.Full:
+        with _lock:
+            _state["descartados"] += 1
+            _state["cola_llena"] += 1
+
+
+def flush(timeout=SHUTDOWN_FLUSH_TIMEOUT):
+    """
+    Escribe en el hilo actual lo que quede en la cola (al apagar el proceso).
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        events = _drain()
+        if not events:
+            return
+        if not _write_batch(events):
+            _count("descartados", len(events) + _queue.qsize())
+            return
+
+
+def get_stats():
+
+    with _lock:
+        stats = {k: v for k, v in _state.items() if k != "writer_pid"}
+    stats["pendientes"] = _queue.qsize()
+    return stats
+
+
+atexit.register(flush)
@@ -0,0 +1,93 @@
+import sys
+from services.db import get_connection
+from services import timeseries
+
+# Cambios de esquema del backend. Se aplican al desplegar (python -m services.migrations, o al
+# arrancar wsgi.py antes de servir peticiones), nunca desde una petición: los índices sobre
+# tablas grandes se construyen con CREATE INDEX CONCURRENTLY para no bloquear las escrituras.
+
+# Tablas propias del backend
+SCHEMA_SQL = """
+    -- Pertenencia IGMP compartida por todos los workers (la lee también client_requests)
+    CREATE TABLE IF NOT EXISTS igmp_membership (
+        group_ip VARCHAR(45) NOT NULL,
+        dpid VARCHAR(32) NOT NULL,
+        puerto INTEGER NOT NULL,
+        actualizado TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (group_ip, dpid, puerto)
+    );
+    CREATE SEQUENCE IF NOT EXISTS igmp_membership_version;
+"""
+
+# (nombre, definición) de los índices creados sin bloquear la tabla
+CONCURRENT_INDEXES = [
+    # Paginación de /reglas por (fecha, id) sin ordenar la tabla completa
+    ("idx_logs_fecha_id", "ON logs (fecha DESC, id DESC)"),
+    # Últimos eventos del panel de /stats leídos por índice, sin recorrer estadisticas
+    ("idx_estadisticas_timestamp", "ON estadisticas (timestamp DESC)"),
+]
+
+
+def _create_index_concurrently(cur, name, definition):
+    """
+    CREATE INDEX CONCURRENTLY no puede ir dentro de una transacción y, si falla a medias, deja
+    el índice marcado como inválido: se borra y se vuelve a construir.
+    """
+    cur.execute("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = %s;", (name,))
+    row = cur.fetchone()
+    if row is not None:
+        if row[0]:
+            return
+        print(f"Índice {name} inválido (construcción interrumpida): se reconstruye")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    cur.execute(f"CREATE INDEX CONCURRENTLY {name} {definition};")
+    print(f"Índice {name} creado")
+
+
+def _create_tables():
+
+    conn = get_connection()
+    if conn is None:
+        return False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA_SQL)
+        return True
+    except Exception as e:
+        print(f"Error al crear las tablas del backend: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def _create_indexes():
+
+    conn = get_connection()
+    if conn is None:
+        return False
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for name, definition in CONCURRENT_INDEXES:
+                _create_index_concurrently(cur, name, definition)
+        return True
+    except Exception as e:
+        print(f"Error al crear los índices: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def migrate():
+    """
+    Aplica todas las migraciones del backend. Devuelve False si alguna falló.
+    """
+    results = [_create_tables(), _create_indexes(), timeseries.migrate()]
+    return all(results)
+
+
+if __name__ == '__main__':
+    # Migración explícita al desplegar: cd Backend && python -m services.migrations
+    sys.exit(0 if migrate() else 1)
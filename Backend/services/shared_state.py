@@ -0,0 +1,92 @@
+import os
+import re
+import threading
+from services.db import get_connection
+
+# Estado que debe ser único entre todos los workers/procesos del backend (gunicorn con varios
+# workers no comparte memoria). Los contadores viven en secuencias de PostgreSQL: nextval es
+# atómico entre conexiones y no se revierte con la transacción.
+
+_SEQUENCE_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+_ready_sequences = set()
+
+
+def next_in_sequence(name):
+    """
+    Devuelve el siguiente valor (empezando en 1) de la secuencia indicada, creándola si no existe.
+    Devuelve None si no se puede conectar a la base de datos.
+    """
+    if not _SEQUENCE_NAME.match(name):
+        raise ValueError(f"Nombre de secuencia inválido: {name}")
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if name not in _ready_sequences:
+                    cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {name};")
+                    _ready_sequences.add(name)
+                cur.execute("SELECT nextval(%s);", (name,))
+                return cur.fetchone()[0]
+    except Exception as e:
+        print(f"Error al avanzar la secuencia {name}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+class SequenceBlock:
+    """
+    Reparte valores de una secuencia reservándolos de block_size en block_size: la secuencia
+    avanza de bloque en bloque (INCREMENT BY block_size) y cada worker entrega su bloque desde
+    memoria, así que solo una de cada block_size llamadas toca la base de datos. Los valores
+    siguen siendo únicos entre workers, aunque no se entregan en orden global estricto.
+    """
+
+    def __init__(self, name, block_size):
+        if not _SEQUENCE_NAME.match(name):
+            raise ValueError(f"Nombre de secuencia inválido: {name}")
+        self.name = name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._ready = False
+        self._pid = None  # un bloque reservado antes del fork no debe repartirse en varios workers
+        self._next = 0
+        self._end = 0
+
+    def _reserve(self):
+
+        conn = get_connection()
+        if conn is None:
+            return None
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    if not self._ready:
+                        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {self.name} INCREMENT BY {int(self.block_size)};")
+                        # Secuencias creadas antes con otro incremento
+                        cur.execute(f"ALTER SEQUENCE {self.name} INCREMENT BY {int(self.block_size)};")
+                        self._ready = True
+                    cur.execute("SELECT nextval(%s);", (self.name,))
+                    return cur.fetchone()[0]
+        except Exception as e:
+            print(f"Error al reservar un bloque de la secuencia {self.name}: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def next(self):
+        """
+        Siguiente valor (empezando en 1), o None si hace falta un bloque y no se puede reservar.
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._next >= self._end:
+                start = self._reserve()
+                if start is None:
+                    return None
+                self._pid = os.getpid()
+                self._next, self._end = start, start + self.block_size
+            value = self._next
+            self._next += 1
+            return value
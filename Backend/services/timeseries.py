@@ -0,0 +1,367 @@
+import os
+import threading
+import time
+from services.db import get_connection
+
+# Agregados temporales de latencias y estadisticas. Las filas crudas las escriben otros procesos
+# (el agente Mininet inserta la medida y luego fija rtt_ms/jitter_ms), así que los agregados se
+# mantienen con triggers en PostgreSQL: cada muestra suma en su cubeta de minuto y de hora.
+# Los percentiles salen de un histograma logarítmico (celdas de un 10 % de anchura sobre
+# microsegundos), que se puede sumar entre cubetas con un error relativo inferior al 5 %.
+# Un hilo de mantenimiento por proceso aplica la retención; un lock consultivo garantiza que
+# solo un worker la ejecuta en cada ronda.
+# El esquema se instala con migrate() al desplegar (ver services/migrations.py), nunca desde
+# una petición: la carga inicial del histórico bloquea las escrituras en las tablas crudas. La versión aplicada queda en
+# timeseries_schema; cualquier cambio en SCHEMA_SQL (p. ej. el cuerpo de una función) debe ir
+# acompañado de un SCHEMA_VERSION mayor para que la migración lo aplique.
+
+# Ventanas de hasta MINUTE_ROLLUP_WINDOW horas se leen de las cubetas de minuto
+MINUTE_ROLLUP_WINDOW = 24
+
+
+
+def _optional_days(name):
+
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Las tablas crudas no son de este backend (las escribe el agente Mininet y el registro de
+# eventos): solo se recortan si se configura su retención. Sin variable no se borra nada.
+RETENCION_LATENCIAS_DIAS = _optional_days("RETENCION_LATENCIAS_DIAS")
+RETENCION_ESTADISTICAS_DIAS = _optional_days("RETENCION_ESTADISTICAS_DIAS")
+RETENCION_MINUTO_DIAS = int(os.environ.get("RETENCION_ROLLUP_MINUTO_DIAS", "7"))
+RETENCION_HORA_DIAS = int(os.environ.get("RETENCION_ROLLUP_HORA_DIAS", "365"))
+MAINTENANCE_INTERVAL = 3600
+RETENTION_BATCH = 10000
+
+SCHEMA_VERSION = 1
+SCHEMA_LOCK_KEY = 'timeseries_schema'
+MAINTENANCE_LOCK_KEY = 'timeseries_mantenimiento'
+
+VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS timeseries_schema (
+        version INTEGER PRIMARY KEY,
+        aplicada_en TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+# Idempotente: se ejecuta completo en cada migración para reemplazar las funciones
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS latencias_rollup (
+        granularidad VARCHAR(10) NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        algoritmo_enrutamiento TEXT NOT NULL,
+        host_origen TEXT NOT NULL,
+        host_destino TEXT NOT NULL,
+        muestras BIGINT NOT NULL,
+        suma_rtt DOUBLE PRECISION NOT NULL,
+        rtt_min DOUBLE PRECISION NOT NULL,
+        rtt_max DOUBLE PRECISION NOT NULL,
+        muestras_jitter BIGINT NOT NULL,
+        suma_jitter DOUBLE PRECISION NOT NULL,
+        ultima_ruta INTEGER,
+        PRIMARY KEY (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino)
+    );
+    CREATE TABLE IF NOT EXISTS latencias_rollup_sketch (
+        granularidad VARCHAR(10) NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        algoritmo_enrutamiento TEXT NOT NULL,
+        host_origen TEXT NOT NULL,
+        host_destino TEXT NOT NULL,
+        metrica VARCHAR(10) NOT NULL,
+        celda SMALLINT NOT NULL,
+        muestras BIGINT NOT NULL,
+        PRIMARY KEY (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino, metrica, celda)
+    );
+    CREATE TABLE IF NOT EXISTS estadisticas_rollup (
+        granularidad VARCHAR(10) NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        tipo TEXT NOT NULL,
+        eventos BIGINT NOT NULL,
+        PRIMARY KEY (granularidad, bucket, tipo)
+    );
+    -- Índices BRIN: las filas crudas llegan en orden de tiempo, así que los rangos por fecha
+    -- (retención) descartan bloques enteros con un índice de tamaño despreciable
+    CREATE INDEX IF NOT EXISTS idx_latencias_timestamp_brin ON latencias USING brin (timestamp);
+    CREATE INDEX IF NOT EXISTS idx_estadisticas_timestamp_brin ON estadisticas USING brin (timestamp);
+
+    CREATE OR REPLACE FUNCTION latencia_celda(valor DOUBLE PRECISION) RETURNS SMALLINT AS $$
+        SELECT FLOOR(LN(1 + GREATEST(valor, 0) * 1000) / LN(1.1))::SMALLINT
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION latencia_valor_celda(celda INTEGER) RETURNS DOUBLE PRECISION AS $$
+        SELECT (POWER(1.1, celda + 0.5) - 1) / 1000
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION latencias_rollup_muestra() RETURNS trigger AS $$
+    DECLARE
+        algoritmo TEXT;
+    BEGIN
+        SELECT algoritmo_enrutamiento INTO algoritmo FROM rutas_ping WHERE id_ruta = NEW.id_ruta;
+        algoritmo := COALESCE(algoritmo, 'desconocido');
+
+        INSERT INTO latencias_rollup AS r (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino,
+                                           muestras, suma_rtt, rtt_min, rtt_max, muestras_jitter, suma_jitter, ultima_ruta)
+        SELECT g.nombre, date_trunc(g.unidad, NEW.timestamp::timestamp), algoritmo,
+               NEW.host_origen::text, NEW.host_destino::text,
+               1, NEW.rtt_ms, NEW.rtt_ms, NEW.rtt_ms,
+               (NEW.jitter_ms IS NOT NULL)::int, COALESCE(NEW.jitter_ms, 0), NEW.id_ruta
+        FROM (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+        ON CONFLICT (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino) DO UPDATE SET
+            muestras = r.muestras + 1,
+            suma_rtt = r.suma_rtt + EXCLUDED.suma_rtt,
+            rtt_min = LEAST(r.rtt_min, EXCLUDED.rtt_min),
+            rtt_max = GREATEST(r.rtt_max, EXCLUDED.rtt_max),
+            muestras_jitter = r.muestras_jitter + EXCLUDED.muestras_jitter,
+            suma_jitter = r.suma_jitter + EXCLUDED.suma_jitter,
+            ultima_ruta = GREATEST(r.ultima_ruta, EXCLUDED.ultima_ruta);
+
+        INSERT INTO latencias_rollup_sketch AS s (granularidad, bucket, algoritmo_enrutamiento, host_origen,
+                                                  host_destino, metrica, celda, muestras)
+        SELECT g.nombre, date_trunc(g.unidad, NEW.timestamp::timestamp), algoritmo,
+               NEW.host_origen::text, NEW.host_destino::text, m.metrica, latencia_celda(m.valor), 1
+        FROM (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+        CROSS JOIN (VALUES ('rtt', NEW.rtt_ms), ('jitter', NEW.jitter_ms)) AS m(metrica, valor)
+        WHERE m.valor IS NOT NULL
+        ON CONFLICT (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino, metrica, celda)
+        DO UPDATE SET muestras = s.muestras + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION estadisticas_rollup_eventos() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO estadisticas_rollup AS r (granularidad, bucket, tipo, eventos)
+        SELECT g.nombre, date_trunc(g.unidad, n.timestamp::timestamp), n.tipo, COUNT(*)
+        FROM nuevas n
+        CROSS JOIN (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (granularidad, bucket, tipo) DO UPDATE SET eventos = r.eventos + EXCLUDED.eventos;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Carga inicial de los agregados con el histórico existente (solo al crear los triggers)
+BACKFILL_SQL = """
+    WITH muestras AS (
+        SELECT l.timestamp::timestamp AS instante, COALESCE(r.algoritmo_enrutamiento, 'desconocido') AS algoritmo,
+               l.host_origen::text AS host_origen, l.host_destino::text AS host_destino,
+               l.rtt_ms, l.jitter_ms, l.id_ruta
+        FROM latencias l
+        LEFT JOIN rutas_ping r ON r.id_ruta = l.id_ruta
+        WHERE l.rtt_ms IS NOT NULL
+    )
+    INSERT INTO latencias_rollup (granularidad, bucket, algoritmo_enrutamiento, host_origen, host_destino,
+                                  muestras, suma_rtt, rtt_min, rtt_max, muestras_jitter, suma_jitter, ultima_ruta)
+    SELECT g.nombre, date_trunc(g.unidad, m.instante), m.algoritmo, m.host_origen, m.host_destino,
+           COUNT(*), SUM(m.rtt_ms), MIN(m.rtt_ms), MAX(m.rtt_ms),
+           COUNT(m.jitter_ms), COALESCE(SUM(m.jitter_ms), 0), MAX(m.id_ruta)
+    FROM muestras m
+    CROSS JOIN (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+    GROUP BY 1, 2, 3, 4, 5;
+
+    WITH muestras AS (
+        SELECT l.timestamp::timestamp AS instante, COALESCE(r.algoritmo_enrutamiento, 'desconocido') AS algoritmo,
+               l.host_origen::text AS host_origen, l.host_destino::text AS host_destino,
+               l.rtt_ms, l.jitter_ms
+        FROM latencias l
+        LEFT JOIN rutas_ping r ON r.id_ruta = l.id_ruta
+        WHERE l.rtt_ms IS NOT NULL
+    )
+    INSERT INTO latencias_rollup_sketch (granularidad, bucket, algoritmo_enrutamiento, host_origen,
+                                         host_destino, metrica, celda, muestras)
+    SELECT g.nombre, date_trunc(g.unidad, m.instante), m.algoritmo, m.host_origen, m.host_destino,
+           v.metrica, latencia_celda(v.valor), COUNT(*)
+    FROM muestras m
+    CROSS JOIN (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+    CROSS JOIN LATERAL (VALUES ('rtt', m.rtt_ms), ('jitter', m.jitter_ms)) AS v(metrica, valor)
+    WHERE v.valor IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5, 6, 7;
+
+    INSERT INTO estadisticas_rollup (granularidad, bucket, tipo, eventos)
+    SELECT g.nombre, date_trunc(g.unidad, e.timestamp::timestamp), e.tipo, COUNT(*)
+    FROM estadisticas e
+    CROSS JOIN (VALUES ('minuto', 'minute'), ('hora', 'hour')) AS g(nombre, unidad)
+    GROUP BY 1, 2, 3;
+"""
+
+TRIGGERS_SQL = """
+    CREATE TRIGGER latencias_rollup_ins AFTER INSERT ON latencias
+        FOR EACH ROW WHEN (NEW.rtt_ms IS NOT NULL) EXECUTE FUNCTION latencias_rollup_muestra();
+    -- El agente crea la medida sin rtt y la completa al terminar el ping: cuenta una sola vez
+    CREATE TRIGGER latencias_rollup_upd AFTER UPDATE OF rtt_ms ON latencias
+        FOR EACH ROW WHEN (OLD.rtt_ms IS NULL AND NEW.rtt_ms IS NOT NULL) EXECUTE FUNCTION latencias_rollup_muestra();
+    -- Por sentencia: los lotes del registro de eventos se agregan con un único INSERT
+    CREATE TRIGGER estadisticas_rollup_ins AFTER INSERT ON estadisticas
+        REFERENCING NEW TABLE AS nuevas FOR EACH STATEMENT EXECUTE FUNCTION estadisticas_rollup_eventos();
+"""
+
+_lock = threading.Lock()
+_state = {
+    "schema_ready": False,
+    "maintenance_pid": None  # el hilo de mantenimiento no sobrevive al fork de los workers
+}
+
+
+def migrate():
+    """
+    Aplica el esquema de agregados si la versión registrada es anterior a SCHEMA_VERSION: crea
+    las tablas y reemplaza las funciones. La primera vez que se crean los triggers se cargan los
+    agregados con el histórico, con las tablas crudas bloqueadas para escritura para que ninguna
+    muestra se cuente dos veces ni se pierda, así que debe ejecutarse al desplegar y no desde
+    una petición. Devuelve False si no se pudo aplicar.
+    """
+    conn = get_connection()
+    if conn is None:
+        return False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (SCHEMA_LOCK_KEY,))
+                cur.execute(VERSION_SQL)
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM timeseries_schema;")
+                version = cur.fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    return True
+                cur.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'latencias_rollup_ins');")
+                installed = cur.fetchone()[0]
+                if not installed:
+                    cur.execute("LOCK TABLE latencias, estadisticas IN SHARE ROW EXCLUSIVE MODE;")
+                cur.execute(SCHEMA_SQL)
+                if not installed:
+                    cur.execute(BACKFILL_SQL)
+                    cur.execute(TRIGGERS_SQL)
+                    print("Agregados de latencias y estadisticas creados y cargados con el histórico")
+                cur.execute("INSERT INTO timeseries_schema (version) VALUES (%s);", (SCHEMA_VERSION,))
+                print(f"Esquema de agregados temporales migrado de la versión {version} a la {SCHEMA_VERSION}")
+        return True
+    except Exception as e:
+        print(f"Error al migrar los agregados temporales: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def schema_ready():
+    """
+    Comprueba (sin bloqueos) que migrate() ya instaló la versión actual del esquema. Se consulta
+    hasta que la respuesta es afirmativa y después se recuerda en el proceso.
+    """
+    with _lock:
+        if _state["schema_ready"]:
+            return True
+    conn = get_connection()
+    if conn is None:
+        return False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('timeseries_schema') IS NOT NULL;")
+                ready = cur.fetchone()[0]
+                if ready:
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM timeseries_schema WHERE version >= %s);",
+                                (SCHEMA_VERSION,))
+                    ready = cur.fetchone()[0]
+        if not ready:
+            print(f"Los agregados temporales no están en la versión {SCHEMA_VERSION}: "
+                  "ejecuta python -m services.migrations")
+            return False
+        with _lock:
+            _state["schema_ready"] = True
+        return True
+    except Exception as e:
+        print(f"Error al comprobar el esquema de los agregados temporales: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def _delete_in_batches(cur, table, condition, params):
+    """
+    Borra por lotes (por ctid) para no mantener bloqueos largos ni generar una transacción enorme.
+    """
+    total = 0
+    while True:
+        cur.execute(
+            f"DELETE FROM {table} WHERE ctid = ANY(ARRAY(SELECT ctid FROM {table} WHERE {condition} LIMIT %s));",
+            params + (RETENTION_BATCH,)
+        )
+        cur.connection.commit()
+        total += cur.rowcount
+        if cur.rowcount < RETENTION_BATCH:
+            return total
+
+
+def apply_retention():
+    """
+    Elimina las cubetas (y las filas crudas, si se configuró su retención) que superan su
+    periodo de retención. Solo un worker la ejecuta a la vez; devuelve {tabla: filas borradas}
+    o None si otro worker la tenía.
+    """
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (MAINTENANCE_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return None
+            try:
+                deleted = {}
+                for table, dias in (('latencias', RETENCION_LATENCIAS_DIAS),
+                                    ('estadisticas', RETENCION_ESTADISTICAS_DIAS)):
+                    if dias is not None:
+                        deleted[table] = _delete_in_batches(
+                            cur, table, "timestamp < NOW() - make_interval(days => %s)", (dias,))
+                for table in ('latencias_rollup', 'latencias_rollup_sketch', 'estadisticas_rollup'):
+                    deleted[table] = sum(
+                        _delete_in_batches(
+                            cur, table, "granularidad = %s AND bucket < NOW() - make_interval(days => %s)",
+                            (granularidad, dias))
+                        for granularidad, dias in (('minuto', RETENCION_MINUTO_DIAS), ('hora', RETENCION_HORA_DIAS))
+                    )
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (MAINTENANCE_LOCK_KEY,))
+                conn.commit()
+        return deleted
+    except Exception as e:
+        print(f"Error al aplicar la retención: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def _maintenance_loop():
+
+    while True:
+        if schema_ready():
+            deleted = apply_retention()
+            if deleted and any(deleted.values()):
+                print(f"Retención aplicada: {deleted}")
+        time.sleep(MAINTENANCE_INTERVAL)
+
+
+def ensure_maintenance():
+
+    pid = os.getpid()
+    with _lock:
+        if _state["maintenance_pid"] == pid:
+            return
+        _state["maintenance_pid"] = pid
+    threading.Thread(target=_maintenance_loop, name="timeseries-maintenance", daemon=True).start()
+
+
+def rollup_window(horas):
+    """
+    Devuelve (condición SQL, parámetros) que selecciona las cubetas de las últimas `horas` horas
+    (None: todo el histórico agregado, en cubetas de hora).
+    """
+    if horas is None:
+        return "granularidad = %(granularidad)s", {"granularidad": 'hora'}
+    granularidad = 'minuto' if horas <= MINUTE_ROLLUP_WINDOW else 'hora'
+    return ("granularidad = %(granularidad)s AND bucket >= NOW() - make_interval(hours => %(horas)s)",
+            {"granularidad": granularidad, "horas": horas})
+
@@ -208,7 +208,7 @@ document.getElementById('requestStreamBtn').addEventListener('click', async () =
     }
 
     try {
-        const response = await fetch(`${API_BASE_URL}/client/get_multicast_stream_info`);
+        const response = await fetch(`${API_BASE_URL}/client/get_multicast_stream_info?host=${encodeURIComponent(clientHost)}`);
         const data = await response.json();
 
         if (response.ok && data.host_name && data.multicast_ip && data.multicast_port) {
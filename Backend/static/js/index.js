@@ -4,6 +4,8 @@
 // ==============================
 const API_BASE_URL      = 'http://192.168.18.151:5000';
 const MININET_AGENT_URL = 'http://192.168.18.208:5002';  
+// Algoritmos de balanceo que usan el peso del servidor
+const WEIGHTED_LB_ALGORITHMS = ['weighted_round_robin', 'weighted_least_connections', 'power_of_two_choices', 'topology_aware'];
 
 // ==============================
 //  Función auxiliar para mostrar modales
@@ -75,7 +77,7 @@ async function updateDashboard() {
     // Mostrar/ocultar input de peso para WRR
     const weightGroup = document.getElementById('server-weight-input-group');
     if (weightGroup) {
-      if (cfgData.algoritmo_balanceo === 'weighted_round_robin') {
+      if (WEIGHTED_LB_ALGORITHMS.includes(cfgData.algoritmo_balanceo)) {
         weightGroup.classList.remove('hidden');
       } else {
         weightGroup.classList.add('hidden');
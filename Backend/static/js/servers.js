@@ -175,7 +175,7 @@ async function verificarAlgoritmoBalanceo() {
 
     const pesoGroup = document.getElementById('modal-server-weight-group');
     if (pesoGroup) {
-      pesoGroup.classList.toggle('hidden', algoritmoBalanceoActual !== 'weighted_round_robin');
+      pesoGroup.classList.toggle('hidden', !WEIGHTED_LB_ALGORITHMS.includes(algoritmoBalanceoActual));
     }
   } catch (err) {
     console.error("Error al verificar algoritmo:", err);
@@ -250,7 +250,7 @@ async function iniciarServidorDesdeModal() {
   }
 
   const host = selectedHosts[0];
-  const peso = (algoritmoBalanceoActual === 'weighted_round_robin')
+  const peso = WEIGHTED_LB_ALGORITHMS.includes(algoritmoBalanceoActual)
     ? parseInt(document.getElementById('modal-server-weight').value) || 1
     : 1;
 
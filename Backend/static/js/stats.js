@@ -103,8 +103,10 @@ async function cargarEstadisticasConRutas() {
           <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Host Destino</th>
           <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Ruta</th>
           <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Algoritmo</th>
-          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">RTT (ms)</th>
-          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Jitter (ms)</th>
+          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Muestras</th>
+          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">RTT medio (ms)</th>
+          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">RTT p95 (ms)</th>
+          <th class="py-2 px-4 border-b bg-gray-50 text-left text-xs font-semibold text-gray-600 uppercase">Jitter medio (ms)</th>
         </tr>
       </thead>
       <tbody>
@@ -118,7 +120,9 @@ async function cargarEstadisticasConRutas() {
           <td class="py-2 px-4">${item.host_destino}</td>
           <td class="py-2 px-4">${item.ruta}</td>
           <td class="py-2 px-4">${item.algoritmo_enrutamiento}</td>
+          <td class="py-2 px-4">${item.muestras}</td>
           <td class="py-2 px-4">${item.rtt}</td>
+          <td class="py-2 px-4">${item.rtt_p95 ?? "N/A"}</td>
           <td class="py-2 px-4">${item.jitter || "N/A"}</td>
         </tr>
       `;
@@ -0,0 +1,18 @@
+import os
+
+# Con workers gevent hay que parchear la biblioteca estándar y psycopg2 antes de importar la
+# aplicación (con preload_app la importa el proceso maestro antes de crear los workers).
+if os.environ.get("GUNICORN_WORKER_CLASS", "gevent") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+from app import create_app
+from services import migrations
+
+# Migraciones antes de aceptar peticiones (con preload_app, una sola vez en el maestro)
+if os.environ.get("BACKEND_MIGRAR_AL_ARRANCAR", "1") == "1":
+    migrations.migrate()
+
+app = create_app()
@@ -1,8 +1,14 @@
 import psycopg2
+import os
 import sys
 import collections
 import threading 
 import time      
+import bisect
+import ipaddress
+import itertools
+import json
+import select
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
@@ -18,9 +24,12 @@ from ryu.lib.packet import icmp
 from ryu.lib.packet import igmp 
 from ryu.ofproto import inet 
 from ryu.controller.handler import DEAD_DISPATCHER
+from ryu.app.wsgi import ControllerBase, WSGIApplication, route
+from webob import Response
 
 import psycopg2.extras 
 import requests
+import msgpack
 
 import logging
 from logging.handlers import RotatingFileHandler
@@ -32,8 +41,253 @@ handler.setFormatter(formatter)
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)  
 root_logger.addHandler(handler)
+
+
+def _parse_rate_overrides(raw):
+    """
+    Convierte una cadena 'dpid:pps[:burst],dpid:pps[:burst]' en {dpid: (pps, burst)}.
+    """
+    overrides = {}
+    for entry in (raw or "").split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        parts = entry.split(':')
+        try:
+            dpid = int(parts[0], 0)
+            rate = int(parts[1])
+            burst = int(parts[2]) if len(parts) > 2 else None
+        except (IndexError, ValueError):
+            logging.warning(f"Entrada de tasa packet-in inválida ignorada: '{entry}'")
+            continue
+        overrides[dpid] = (rate, burst)
+    return overrides
+
+
+# Protección del plano de control: medidor OpenFlow en la regla table-miss
+# y cubeta de tokens por switch en el manejador de packet-in.
+PACKET_IN_METER_ID = 1
+PACKET_IN_METERS_ENABLED = os.environ.get("PACKET_IN_METERS_ENABLED", "1") == "1"
+PACKET_IN_RATE_PPS = int(os.environ.get("PACKET_IN_RATE_PPS", "200"))
+PACKET_IN_BURST = int(os.environ.get("PACKET_IN_BURST", "50"))
+# Tasas específicas por switch, p.ej. PACKET_IN_RATE_OVERRIDES="1:500,7:100:20"
+PACKET_IN_RATE_OVERRIDES = _parse_rate_overrides(os.environ.get("PACKET_IN_RATE_OVERRIDES", ""))
+PACKET_IN_STATS_INTERVAL = 30
+# ARP e IGMP tienen su propia cubeta: una tormenta de tráfico de datos no debe hacer caducar la
+# pertenencia IGMP ni dejar sin resolver direcciones. En el switch, IGMP sube al controlador por
+# una regla propia sin medidor.
+CONTROL_PACKET_IN_RATE_PPS = int(os.environ.get("CONTROL_PACKET_IN_RATE_PPS", "100"))
+CONTROL_PACKET_IN_BURST = int(os.environ.get("CONTROL_PACKET_IN_BURST", "100"))
+IGMP_TO_CONTROLLER_PRIORITY = 70
+
+MULTICAST_FLOW_PRIORITY = 200
+UNICAST_FLOW_PRIORITY = 100
+
+# Caché negativa: reglas de descarte temporales para grupos multicast sin miembros
+NEGATIVE_CACHE_PRIORITY = 150
+NEGATIVE_CACHE_TIMEOUT = int(os.environ.get("MULTICAST_NEGATIVE_CACHE_TIMEOUT", "10"))
+
+# Árbol de difusión calculado por el controlador (reemplaza OFPP_FLOOD y STP en los switches)
+BROADCAST_MAC = 'ff:ff:ff:ff:ff:ff'
+BROADCAST_ARP_PRIORITY = 60
+BROADCAST_TREE_PRIORITY = 50
+BROADCAST_BLOCK_PRIORITY = 40
+NON_IP_MULTICAST_IDLE_TIMEOUT = 60
+
+# Reenrutamiento ante caída de enlaces. Con CONTROLLER_FAST_FAILOVER=1 las rutas unicast se
+# instalan con grupos fast-failover (siguiente salto de respaldo disjunto en enlaces).
+FAST_FAILOVER_ENABLED = os.environ.get("CONTROLLER_FAST_FAILOVER", "0") == "1"
+UNICAST_BACKUP_PRIORITY = 90
+
+# IGMP nativo: el controlador actúa como querier y envejece la pertenencia (RFC 2236 / RFC 3376)
+IGMP_QUERY_INTERVAL = int(os.environ.get("IGMP_QUERY_INTERVAL", "60"))
+IGMP_QUERY_RESPONSE_INTERVAL = 10
+IGMP_ROBUSTNESS = 2
+IGMP_MEMBERSHIP_TIMEOUT = IGMP_ROBUSTNESS * IGMP_QUERY_INTERVAL + IGMP_QUERY_RESPONSE_INTERVAL
+IGMP_QUERIER_IP = os.environ.get("IGMP_QUERIER_IP", "10.0.0.254")
+IGMP_QUERIER_MAC = os.environ.get("IGMP_QUERIER_MAC", "02:00:00:00:00:fe")
+IGMP_ALL_HOSTS_IP = '224.0.0.1'
+IGMP_ALL_HOSTS_MAC = '01:00:5e:00:00:01'
+# Intervalo mínimo entre envíos de la pertenencia al backend (solo visualización)
+IGMP_SYNC_INTERVAL = 5
+# Ventana en segundos para agrupar cambios de pertenencia de un grupo en un solo recálculo del árbol
+MULTICAST_RECOMPUTE_DEBOUNCE = float(os.environ.get("MULTICAST_RECOMPUTE_DEBOUNCE", "0.2"))
+
+# Reglas del gestor SDN (tabla reglas): el backend avisa por NOTIFY del rule_id modificado y
+# además se resincroniza la tabla completa cada RULES_SYNC_INTERVAL segundos
+RULES_NOTIFY_CHANNEL = 'reglas_cambiadas'
+RULES_SYNC_INTERVAL = int(os.environ.get("CONTROLLER_RULES_SYNC_INTERVAL", "30"))
+RULE_IP_FIELDS = ('ipv4_src', 'ipv4_dst')
+RULE_L4_FIELDS = {6: ('tcp_src', 'tcp_dst'), 17: ('udp_src', 'udp_dst')}
+# Estados de una regla; solo las instalables llegan al switch
+RULE_INSTALLABLE_STATES = ('activa', 'sombreada', 'ambigua')
+
+
+class TokenBucket(object):
+    """
+    Cubeta de tokens para limitar la tasa de eventos aceptados por switch.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+BARRIER_TIMEOUT = 2.0
+# Reconciliación al conectar: si GroupDesc/FlowStats no se completan en este plazo se repite
+RECONCILE_TIMEOUT = float(os.environ.get("CONTROLLER_RECONCILE_TIMEOUT", "10"))
+
+# Instantánea del estado de ejecución para reinicios en caliente
+SNAPSHOT_PATH = os.environ.get("CONTROLLER_SNAPSHOT_PATH", "controller_state.msgpack")
+SNAPSHOT_INTERVAL = int(os.environ.get("CONTROLLER_SNAPSHOT_INTERVAL", "15"))
+SNAPSHOT_MAX_AGE = int(os.environ.get("CONTROLLER_SNAPSHOT_MAX_AGE", "900"))
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+class FlowModBatch(object):
+    """
+    Agrupa los mensajes OpenFlow generados por un evento. Se envían por switch en orden
+    de ruta (de egreso a ingreso), cada grupo terminado en un OFPBarrierRequest, y los
+    packet-out retenidos se liberan cuando llegan todas las respuestas de barrera.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # {dpid: (datapath, [mensajes])} en el orden en que se añadió cada switch (ingreso -> egreso)
+        self.messages = collections.OrderedDict()
+        self.packet_outs = []
+        self.pending_barriers = set()
+        self.sent_at = None
+
+    def add(self, datapath, msg):
+        self.messages.setdefault(datapath.id, (datapath, []))[1].append(msg)
+
+    def add_packet_out(self, datapath, msg):
+        self.packet_outs.append((datapath, msg))
+
+    def message_count(self):
+        return sum(len(msgs) for _, msgs in self.messages.values())
+
+
+# Métricas en formato de texto de Prometheus expuestas en /metrics (WSGI de Ryu, puerto de ryu-manager --wsapi-port)
+METRICS_INSTANCE_NAME = 'controller_app'
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _MetricTimer(object):
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.monotonic() - self.start, self.labels)
+        return False
+
+
+class MetricsRegistry(object):
+    """
+    Contadores e histogramas en memoria. Registrar una muestra es un incremento en un
+    diccionario; el texto para Prometheus solo se genera al consultar /metrics.
+    Las etiquetas son tuplas ((nombre, valor), ...).
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.descriptions = {}
+        # {(nombre, etiquetas): valor}
+        self.counters = collections.defaultdict(float)
+        # {(nombre, etiquetas): [cuentas por bucket..., +Inf, suma]}
+        self.histograms = {}
+
+    def describe(self, name, metric_type, help_text):
+        self.descriptions[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=(), amount=1):
+        self.counters[(name, labels)] += amount
+
+    def observe(self, name, value, labels=()):
+        values = self.histograms.get((name, labels))
+        if values is None:
+            values = self.histograms[(name, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def time(self, name, labels=()):
+        return _MetricTimer(self, name, labels)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self, gauges=()):
+        """
+        Texto de exposición de Prometheus. gauges: [(nombre, etiquetas, valor)] calculados al consultar.
+        """
+        samples = collections.defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            samples[name].append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), values in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                bucket_labels = labels + (('le', bound if bound == '+Inf' else f"{bound:g}"),)
+                samples[name].append(f"{name}_bucket{self._format_labels(bucket_labels)} {cumulative}")
+            samples[name].append(f"{name}_sum{self._format_labels(labels)} {values[-1]:g}")
+            samples[name].append(f"{name}_count{self._format_labels(labels)} {cumulative}")
+        for name, labels, value in gauges:
+            samples[name].append(f"{name}{self._format_labels(labels)} {value:g}")
+
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text = self.descriptions.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsController(ControllerBase):
+    """
+    Endpoint WSGI de Ryu que publica las métricas del controlador.
+    """
+
+    def __init__(self, req, link, data, **config):
+        super(MetricsController, self).__init__(req, link, data, **config)
+        self.controller_app = data[METRICS_INSTANCE_NAME]
+
+    @route('metrics', '/metrics', methods=['GET'])
+    def metrics(self, req, **kwargs):
+        body = self.controller_app.render_metrics()
+        return Response(content_type='text/plain', charset='utf-8', text=body)
+
+
 class Controller(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'wsgi': WSGIApplication}
 
     def __init__(self, *args, **kwargs):
 
@@ -51,6 +305,17 @@ class Controller(app_manager.RyuApp):
 
         self.datapaths = {}
 
+        # Enlaces switch-switch: {dpid: {dpid_vecino: puerto_local}}
+        self.switch_links = collections.defaultdict(dict)
+        # Árbol de difusión sin lazos: {dpid: {puertos del árbol (enlaces + hosts)}}
+        self.broadcast_tree_ports = {}
+        # Enlaces caídos según EventOFPPortStatus: {frozenset((dpid_a, dpid_b))}
+        self.down_links = set()
+        # Índice enlace -> flujos que lo atraviesan: {enlace: {('unicast', (src, dst)) | ('multicast', grupo)}}
+        self.link_index = collections.defaultdict(set)
+        # {entrada: {enlaces}} para actualizar el índice cuando cambia una ruta o un árbol
+        self._indexed_links = {}
+
         # Tabla ARP para el controlador (IP -> MAC)
         self.arp_table = {}
 
@@ -58,23 +323,166 @@ class Controller(app_manager.RyuApp):
 
         # {multicast_ip: {dpid_switch: [puertos_interesados]}}
         self.multicast_group_members = collections.defaultdict(lambda: collections.defaultdict(list))
+        # Estado IGMP por puerto de host: {grupo: {dpid: {puerto: {'mode': 'include'|'exclude',
+        #                                                          'sources': set(), 'expires_at': t}}}}
+        self.igmp_members = {}
+        # Versión local de la pertenencia y última versión enviada al backend
+        self.igmp_membership_version = 0
+        self._igmp_pushed_version = 0
+        # Grupos con recálculo de árbol pendiente dentro de la ventana de agrupación
+        self._pending_tree_updates = set()
+        self._tree_update_timer = None
         # {multicast_ip: dpid_switch_fuente}
         self.multicast_sources = {}
         # {multicast_ip: {dpid1, dpid2, ...}}
         self.multicast_flow_installed_at = collections.defaultdict(set)
+        # {multicast_ip: {dpid: expiración}} reglas de descarte para grupos sin miembros
+        self.multicast_negative_cache = collections.defaultdict(dict)
+
+        # Índice autoritativo de flujos instalados, mantenido con EventOFPFlowRemoved:
+        # {dpid: {(prioridad, match): {'cookie': c, 'installed_at': t, 'idle_timeout': i, 'hard_timeout': h}}}
+        self.installed_flows = collections.defaultdict(dict)
+        self._next_cookie = 1
+        # Rutas unicast instaladas (estado deseado para reconciliación):
+        # {(mac_origen, mac_destino): {'hops': [(dpid, out_port)], 'backup_hops': [(dpid, out_port)],
+        #                              'groups': {dpid: (group_id, puerto_primario, puerto_respaldo)},
+        #                              'expires_at': t}}
+        self.unicast_routes = {}
+        self._next_group_id = 1
+        # Grupos OFPGT_ALL de replicación multicast, compartidos por los grupos IP que salen
+        # por el mismo conjunto de puertos: {dpid: {(puertos,): {'group_id': g, 'groups': {multicast_ip}}}}
+        self.multicast_port_groups = collections.defaultdict(dict)
+        # {(dpid, multicast_ip): (puertos,)} grupo de tabla al que apunta la regla de cada grupo IP
+        self.multicast_group_bindings = {}
+        # {dpid: [OFPFlowStats]} respuestas multiparte de FlowStats en curso
+        self._flow_stats_parts = {}
+        # {dpid: [OFPGroupDescStats]} respuestas multiparte de GroupDesc en curso
+        self._group_desc_parts = {}
+        # {dpid: instante (monotonic)} reconciliaciones en curso, para repetirlas si no terminan
+        self._reconcile_started_at = {}
+        # {dpid: {group_id: (puerto_primario, puerto_respaldo)}} grupos fast-failover presentes en el
+        # switch pero desconocidos: se conservan si algún flujo adoptado al reconciliar los usa
+        self._unclaimed_failover_groups = {}
+        # Reglas del gestor SDN compiladas: {rule_id: {'dpid', 'priority', 'match': {campo: valor},
+        #   'actions': (('output', puerto | 'normal'),), 'estado', 'motivo'}}
+        self.rules = {}
+        # Lo instalado por cada regla: {rule_id: (dpid, prioridad, campos del match, acciones)}
+        self._installed_rules = {}
+
+        # {(dpid, xid): FlowModBatch} barreras pendientes de respuesta
+        self._pending_barriers = {}
+        # Latencia de instalación por lote: (nombre, mensajes, segundos)
+        self.flow_install_latencies = collections.deque(maxlen=1000)
+
+        # {dpid: TokenBucket} para limitar packet-ins por switch
+        self.packet_in_buckets = {}
+        # {dpid: TokenBucket} cubeta aparte para los packet-in de ARP e IGMP
+        self.control_packet_in_buckets = {}
+        # Switches que admiten el medidor packet-in (según OFPMeterFeatures y sin errores al crearlo)
+        self.meter_capable = set()
+        # {dpid: {'recibidos': n, 'limitados': n}}
+        self.packet_in_counters = collections.defaultdict(lambda: {'recibidos': 0, 'limitados': 0})
 
         self.db_lock = threading.Lock() 
         self.topology_lock = threading.RLock() 
 
+        self.metrics = MetricsRegistry()
+        self._describe_metrics()
+        kwargs['wsgi'].register(MetricsController, {METRICS_INSTANCE_NAME: self})
+
         self.logger.info("Aplicación de Controlador Ryu Inicializada")
         self._load_topology_from_db()
+        self._load_snapshot()
 
         self.update_server_thread = threading.Thread(target=self._update_server_info_periodically)
         self.update_server_thread.daemon = True 
         self.update_server_thread.start()
 
+        self.packet_in_stats_thread = threading.Thread(target=self._report_packet_in_counters_periodically)
+        self.packet_in_stats_thread.daemon = True
+        self.packet_in_stats_thread.start()
+
+        self.snapshot_thread = threading.Thread(target=self._save_snapshot_periodically)
+        self.snapshot_thread.daemon = True
+        self.snapshot_thread.start()
+
+        self.igmp_querier_thread = threading.Thread(target=self._igmp_querier_loop)
+        self.igmp_querier_thread.daemon = True
+        self.igmp_querier_thread.start()
+
+        self.igmp_sync_thread = threading.Thread(target=self._push_membership_periodically)
+        self.igmp_sync_thread.daemon = True
+        self.igmp_sync_thread.start()
+
+        self.rules_sync_thread = threading.Thread(target=self._rules_sync_loop)
+        self.rules_sync_thread.daemon = True
+        self.rules_sync_thread.start()
+
+        self.barrier_expiry_thread = threading.Thread(target=self._expire_batches_periodically)
+        self.barrier_expiry_thread.daemon = True
+        self.barrier_expiry_thread.start()
+
+        self.reconcile_retry_thread = threading.Thread(target=self._retry_stalled_reconciliations)
+        self.reconcile_retry_thread.daemon = True
+        self.reconcile_retry_thread.start()
+
         self.logger.info("Hilos de monitoreo iniciados.")
 
+    def stop(self):
+
+        self._save_snapshot()
+        super(Controller, self).stop()
+
+
+    def _describe_metrics(self):
+
+        describe = self.metrics.describe
+        describe('controller_packet_in_total', 'counter', 'Packet-in procesados por switch y tipo de paquete.')
+        describe('controller_packet_in_handler_seconds', 'histogram', 'Duración del manejador de packet-in por tipo.')
+        describe('controller_packet_in_throttled_total', 'counter', 'Packet-in descartados por la cubeta de tokens del switch.')
+        describe('controller_backend_request_seconds', 'histogram', 'Latencia de las llamadas HTTP al backend por endpoint.')
+        describe('controller_backend_request_failures_total', 'counter', 'Llamadas HTTP al backend fallidas por endpoint y motivo.')
+        describe('controller_flow_mods_total', 'counter', 'FlowMod enviados por switch y comando.')
+        describe('controller_group_mods_total', 'counter', 'GroupMod enviados por switch y comando.')
+        describe('controller_flow_batch_seconds', 'histogram', 'Tiempo hasta confirmar con barreras un lote de FlowMod.')
+        describe('controller_multicast_tree_recomputations_total', 'counter', 'Recálculos de árboles multicast por resultado.')
+        describe('controller_multicast_recomputations_saved_total', 'counter',
+                 'Cambios de pertenencia absorbidos por un recálculo de árbol ya programado.')
+        describe('controller_db_seconds', 'histogram', 'Duración de las operaciones de base de datos del controlador.')
+        describe('controller_igmp_messages_total', 'counter', 'Mensajes IGMP procesados por tipo.')
+        describe('controller_igmp_expired_members_total', 'counter', 'Puertos miembro retirados por expiración del temporizador IGMP.')
+        describe('controller_installed_flows', 'gauge', 'Flujos presentes en el índice por switch.')
+        describe('controller_pending_barriers', 'gauge', 'Barreras enviadas pendientes de respuesta.')
+        describe('controller_multicast_replication_groups', 'gauge', 'Grupos OFPGT_ALL de replicación multicast por switch.')
+        describe('controller_rules', 'gauge', 'Reglas del gestor SDN por estado (activa, sombreada, ambigua, duplicada, conflicto, invalida).')
+
+    def render_metrics(self):
+
+        gauges = [('controller_installed_flows', (('dpid', str(dpid)),), len(flows))
+                  for dpid, flows in self.installed_flows.items()]
+        gauges.append(('controller_pending_barriers', (), len(self._pending_barriers)))
+        gauges.extend(('controller_multicast_replication_groups', (('dpid', str(dpid)),), len(table))
+                      for dpid, table in self.multicast_port_groups.items())
+        rule_states = collections.Counter(rule['estado'] for rule in self.rules.values())
+        gauges.extend(('controller_rules', (('estado', estado),), count) for estado, count in sorted(rule_states.items()))
+        return self.metrics.render(gauges)
+
+    def _backend_request(self, url, payload=None, timeout=3, method='POST'):
+        """
+        Llamada HTTP al backend registrando latencia y fallos por endpoint. Propaga las excepciones de requests.
+        """
+        labels = (('endpoint', url.split(':5000', 1)[-1]),)
+        start = time.monotonic()
+        try:
+            response = requests.request(method, url, json=payload, timeout=timeout)
+        except requests.RequestException as e:
+            self.metrics.inc('controller_backend_request_failures_total', labels + (('motivo', e.__class__.__name__),))
+            raise
+        finally:
+            self.metrics.observe('controller_backend_request_seconds', time.monotonic() - start, labels)
+        if response.status_code != 200:
+            self.metrics.inc('controller_backend_request_failures_total', labels + (('motivo', f"http_{response.status_code}"),))
+        return response
 
     def _get_db_connection(self):
 
@@ -90,6 +498,7 @@ class Controller(app_manager.RyuApp):
 
         conn = None
         cur = None
+        start = time.monotonic()
         try:
             conn = self._get_db_connection()
             cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor) 
@@ -131,6 +540,30 @@ class Controller(app_manager.RyuApp):
                 puertos_dict[(nodo_origen, nodo_destino)] = (puerto_origen_int, puerto_destino_int)
             self.logger.info(f"Cargados {len(puertos_dict)} entradas de puertos.")
 
+            # Obtener enlaces switch-switch y resolver el puerto local en cada extremo
+            cur.execute("SELECT id_origen, id_destino FROM enlaces;")
+            for e in cur.fetchall():
+                info_origen = id_switch_to_info.get(e['id_origen'])
+                info_destino = id_switch_to_info.get(e['id_destino'])
+                if not info_origen or not info_destino:
+                    continue
+                nombre_origen = info_origen['nombre']
+                nombre_destino = info_destino['nombre']
+
+                if (nombre_origen, nombre_destino) in puertos_dict:
+                    puerto_origen, puerto_destino = puertos_dict[(nombre_origen, nombre_destino)]
+                elif (nombre_destino, nombre_origen) in puertos_dict:
+                    puerto_destino, puerto_origen = puertos_dict[(nombre_destino, nombre_origen)]
+                else:
+                    self.logger.warning(f"No se encontraron puertos para el enlace {nombre_origen} <-> {nombre_destino}. Enlace omitido.")
+                    continue
+
+                if puerto_origen is None or puerto_destino is None:
+                    continue
+                self.switch_links[info_origen['dpid_int']][info_destino['dpid_int']] = puerto_origen
+                self.switch_links[info_destino['dpid_int']][info_origen['dpid_int']] = puerto_destino
+            self.logger.info(f"Cargados enlaces de {len(self.switch_links)} switches.")
+
 
             # Obtener hosts y mapearlos a switches/puertos
             cur.execute("SELECT nombre, switch_asociado, ipv4 AS ip, mac FROM hosts;")
@@ -187,13 +620,103 @@ class Controller(app_manager.RyuApp):
             if conn:
                 conn.close()
             self.logger.info("Conexión a la base de datos cerrada (carga inicial).")
+            self.metrics.observe('controller_db_seconds', time.monotonic() - start, (('operacion', 'topologia'),))
             self.logger.info(f"Cargados {len(self.switches_by_dpid)} switches y {len(self.host_to_switch_map)} hosts.")
 
+        self._compute_broadcast_tree()
+
+    def _host_ports_by_dpid(self):
+        """
+        Devuelve {dpid: {puertos hacia hosts}} a partir de host_to_switch_map.
+        """
+        host_ports = collections.defaultdict(set)
+        for info in self.host_to_switch_map.values():
+            host_ports[info['dpid']].add(info['port'])
+        return host_ports
+
+    def _compute_broadcast_tree(self):
+        """
+        Calcula un árbol de expansión (BFS desde el menor DPID de cada componente) sobre
+        los enlaces switch-switch conocidos. El resultado son los puertos por switch
+        a los que se puede difundir sin formar lazos.
+        """
+        tree_ports = collections.defaultdict(set)
+        visited = set()
+        all_dpids = set(self.switches_by_dpid.keys()).union(self.switch_links.keys())
+
+        for root in sorted(all_dpids):
+            if root in visited:
+                continue
+            visited.add(root)
+            queue = collections.deque([root])
+            while queue:
+                current = queue.popleft()
+                for neighbor in sorted(self.switch_links.get(current, {})):
+                    if neighbor in visited or frozenset((current, neighbor)) in self.down_links:
+                        continue
+                    port_back = self.switch_links.get(neighbor, {}).get(current)
+                    if port_back is None:
+                        continue
+                    visited.add(neighbor)
+                    tree_ports[current].add(self.switch_links[current][neighbor])
+                    tree_ports[neighbor].add(port_back)
+                    queue.append(neighbor)
+
+        for dpid, ports in self._host_ports_by_dpid().items():
+            tree_ports[dpid].update(ports)
+
+        self.broadcast_tree_ports = dict(tree_ports)
+        self.logger.info(f"Árbol de difusión calculado: {self.broadcast_tree_ports}")
+
+    def _broadcast_out_ports(self, dpid, in_port):
+        """
+        Puertos por los que reenviar una difusión recibida en in_port (vacío si in_port no pertenece al árbol).
+        """
+        ports = self.broadcast_tree_ports.get(dpid, set())
+        if in_port not in ports:
+            return []
+        return sorted(p for p in ports if p != in_port)
+
+    def _broadcast_flow_specs(self, datapath):
+        """
+        Reglas de difusión del switch siguiendo el árbol del controlador:
+        - ARP broadcast desde hosts al controlador (proxy ARP).
+        - Broadcast recibido por un puerto del árbol se reenvía al resto de puertos del árbol.
+        - Broadcast recibido por un enlace fuera del árbol se descarta.
+        """
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        tree_ports = self.broadcast_tree_ports.get(dpid, set())
+        host_ports = self._host_ports_by_dpid().get(dpid, set())
+        specs = []
+
+        for port in sorted(host_ports):
+            match = parser.OFPMatch(in_port=port, eth_type=ether_types.ETH_TYPE_ARP, eth_dst=BROADCAST_MAC)
+            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+            specs.append(dict(priority=BROADCAST_ARP_PRIORITY, match=match, actions=actions,
+                              meter_id=self._controller_meter_id(dpid)))
+
+        for port in sorted(tree_ports):
+            match = parser.OFPMatch(in_port=port, eth_dst=BROADCAST_MAC)
+            actions = [parser.OFPActionOutput(p) for p in sorted(tree_ports) if p != port]
+            specs.append(dict(priority=BROADCAST_TREE_PRIORITY, match=match, actions=actions))
+
+        specs.append(dict(priority=BROADCAST_BLOCK_PRIORITY, match=parser.OFPMatch(eth_dst=BROADCAST_MAC), actions=[]))
+        return specs
+
+    def _install_broadcast_flows(self, datapath, batch=None):
+
+        for spec in self._broadcast_flow_specs(datapath):
+            self.add_flow(datapath, batch=batch, **spec)
+        self.logger.info(f"Flujos de difusión instalados en switch {datapath.id}: "
+                         f"puertos del árbol {sorted(self.broadcast_tree_ports.get(datapath.id, set()))}")
+
     def update_switch_status_in_db(self, dpid, status):
 
         query = "UPDATE switches SET status = %s WHERE id_switch = %s;"
         try:
-            with self.db_lock:
+            with self.db_lock, self.metrics.time('controller_db_seconds', (('operacion', 'estado_switch'),)):
                 conn = self._get_db_connection()
                 cur = conn.cursor()
                 cur.execute(query, (status, dpid))
@@ -207,7 +730,7 @@ class Controller(app_manager.RyuApp):
     def _update_server_info_periodically(self):
 
         while True:
-            with self.db_lock:
+            with self.db_lock, self.metrics.time('controller_db_seconds', (('operacion', 'servidores_activos'),)):
                 conn = None
                 cur = None
                 try:
@@ -259,41 +782,498 @@ class Controller(app_manager.RyuApp):
                     if conn: conn.close()
             time.sleep(10) 
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0):
+    def _snapshot_state(self):
+        """
+        Estado de ejecución que permite retomar el servicio sin reaprender flujos y árboles.
+        """
+        return {
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'saved_at': time.time(),
+            'next_cookie': self._next_cookie,
+            'next_group_id': self._next_group_id,
+            'mac_to_port': {dpid: dict(macs) for dpid, macs in self.mac_to_port.items()},
+            'multicast_group_members': {
+                group: {dpid: list(ports) for dpid, ports in switches.items()}
+                for group, switches in self.multicast_group_members.items()
+            },
+            'multicast_sources': dict(self.multicast_sources),
+            'last_installed_tree': {
+                group: {dpid: list(ports) for dpid, ports in tree.items()}
+                for group, tree in self._last_installed_tree.items()
+            },
+            'multicast_flow_installed_at': {
+                group: sorted(dpids) for group, dpids in self.multicast_flow_installed_at.items()
+            },
+            'multicast_port_groups': {
+                dpid: [[list(ports), entry['group_id'], sorted(entry['groups'])] for ports, entry in table.items()]
+                for dpid, table in self.multicast_port_groups.items() if table
+            },
+            # Sin las rutas unicast, la reconciliación tras reiniciar borraría sus flujos como huérfanos
+            'unicast_routes': [
+                [src_mac, dst_mac, [list(hop) for hop in route['hops']],
+                 [list(hop) for hop in route.get('backup_hops', [])],
+                 [[dpid] + list(group) for dpid, group in route.get('groups', {}).items()],
+                 route['expires_at']]
+                for (src_mac, dst_mac), route in self.unicast_routes.items()
+            ]
+        }
+
+    def _save_snapshot(self):
+        """
+        Escribe la instantánea en formato msgpack de forma atómica (archivo temporal + rename).
+        """
+        tmp_path = SNAPSHOT_PATH + ".tmp"
+        try:
+            data = msgpack.packb(self._snapshot_state(), use_bin_type=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, SNAPSHOT_PATH)
+            self.logger.debug(f"[SNAPSHOT] Estado guardado en {SNAPSHOT_PATH} ({len(data)} bytes)")
+        except Exception as e:
+            self.logger.error(f"[SNAPSHOT] Fallo al guardar el estado: {e}")
+
+    def _save_snapshot_periodically(self):
+
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            self._save_snapshot()
+
+    def _load_snapshot(self):
+        """
+        Restaura el estado guardado si existe y no es demasiado antiguo. Lo que sigue
+        instalado en los switches se confirma al reconectar (_reconcile_flow_table).
+        """
+        if not os.path.exists(SNAPSHOT_PATH):
+            self.logger.info("[SNAPSHOT] No hay estado previo. Arranque en frío.")
+            return
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                state = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+        except Exception as e:
+            self.logger.error(f"[SNAPSHOT] No se pudo leer {SNAPSHOT_PATH}: {e}. Arranque en frío.")
+            return
+
+        if state.get('version') != SNAPSHOT_FORMAT_VERSION:
+            self.logger.warning(f"[SNAPSHOT] Versión de formato desconocida ({state.get('version')}). Se ignora.")
+            return
+        age = time.time() - state.get('saved_at', 0)
+        if age > SNAPSHOT_MAX_AGE:
+            self.logger.warning(f"[SNAPSHOT] Estado de hace {age:.0f}s (máximo {SNAPSHOT_MAX_AGE}s). Se ignora.")
+            return
+
+        self._next_cookie = max(self._next_cookie, state.get('next_cookie', 1))
+        self._next_group_id = max(self._next_group_id, state.get('next_group_id', 1))
+        for dpid, macs in state.get('mac_to_port', {}).items():
+            self.mac_to_port.setdefault(dpid, {}).update(macs)
+        # Los puertos restaurados se consideran miembros hasta que expiren o respondan a la próxima consulta
+        expires_at = time.time() + IGMP_MEMBERSHIP_TIMEOUT
+        for group, switches in state.get('multicast_group_members', {}).items():
+            self.multicast_group_members[group] = collections.defaultdict(list, switches)
+            self.igmp_members[group] = {
+                dpid: {port: {'mode': 'exclude', 'sources': set(), 'expires_at': expires_at} for port in ports}
+                for dpid, ports in switches.items()
+            }
+        self.multicast_sources.update(state.get('multicast_sources', {}))
+        self._last_installed_tree = {
+            group: {dpid: list(ports) for dpid, ports in tree.items()}
+            for group, tree in state.get('last_installed_tree', {}).items()
+        }
+        for group, dpids in state.get('multicast_flow_installed_at', {}).items():
+            self.multicast_flow_installed_at[group] = set(dpids)
+        for dpid, entries in state.get('multicast_port_groups', {}).items():
+            for ports, group_id, groups in entries:
+                ports = tuple(ports)
+                self.multicast_port_groups[dpid][ports] = {'group_id': group_id, 'groups': set(groups)}
+                for group in groups:
+                    self.multicast_group_bindings[(dpid, group)] = ports
+        now = time.time()
+        for src_mac, dst_mac, hops, backup_hops, groups, expires_at in state.get('unicast_routes', []):
+            if expires_at <= now:
+                continue
+            route = {
+                'hops': [tuple(hop) for hop in hops],
+                'backup_hops': [tuple(hop) for hop in backup_hops],
+                'groups': {dpid: (group_id, primary_port, backup_port)
+                           for dpid, group_id, primary_port, backup_port in groups},
+                'expires_at': expires_at
+            }
+            self.unicast_routes[(src_mac, dst_mac)] = route
+            self._index_links(('unicast', (src_mac, dst_mac)), self._links_of_hops(route['hops']))
+        # Ningún grupo nuevo puede reutilizar un identificador restaurado
+        restored_ids = [group[0] for route in self.unicast_routes.values() for group in route['groups'].values()]
+        restored_ids.extend(entry['group_id'] for table in self.multicast_port_groups.values() for entry in table.values())
+        if restored_ids:
+            self._next_group_id = max(self._next_group_id, max(restored_ids) + 1)
+
+        self.logger.info(f"[SNAPSHOT] Estado restaurado (hace {age:.0f}s): "
+                         f"{len(self.multicast_group_members)} grupos, {len(self._last_installed_tree)} árboles, "
+                         f"{len(self.unicast_routes)} rutas unicast.")
+
+    def _packet_in_rate(self, dpid):
+        """
+        Devuelve (pps, burst) configurados para los packet-in de un switch.
+        """
+        rate, burst = PACKET_IN_RATE_OVERRIDES.get(dpid, (PACKET_IN_RATE_PPS, None))
+        return rate, burst if burst is not None else PACKET_IN_BURST
+
+    @staticmethod
+    def _is_control_packet(data):
+        """
+        ARP o IGMP, mirando solo las cabeceras en bruto (sin parsear el paquete).
+        """
+        if len(data) < 14:
+            return False
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype == ether_types.ETH_TYPE_ARP:
+            return True
+        # Protocolo IPv4 en el byte 9 de la cabecera IP
+        return ethertype == ether_types.ETH_TYPE_IP and len(data) > 23 and data[23] == inet.IPPROTO_IGMP
+
+    def _allow_packet_in(self, dpid, control=False):
+        """
+        Aplica la cubeta de tokens del switch (la de control para ARP/IGMP). Devuelve False si
+        el packet-in debe descartarse.
+        """
+        if control:
+            bucket = self.control_packet_in_buckets.get(dpid)
+            if bucket is None:
+                bucket = self.control_packet_in_buckets[dpid] = TokenBucket(CONTROL_PACKET_IN_RATE_PPS,
+                                                                            CONTROL_PACKET_IN_BURST)
+        else:
+            bucket = self.packet_in_buckets.get(dpid)
+            if bucket is None:
+                rate, burst = self._packet_in_rate(dpid)
+                bucket = self.packet_in_buckets[dpid] = TokenBucket(rate, burst)
+
+        counters = self.packet_in_counters[dpid]
+        counters['recibidos'] += 1
+        if bucket.consume():
+            return True
+        counters['limitados'] += 1
+        self.metrics.inc('controller_packet_in_throttled_total', (('dpid', str(dpid)),))
+        return False
+
+    def get_packet_in_counters(self):
+        """
+        Copia de los contadores de packet-in recibidos y limitados por switch.
+        """
+        return {dpid: dict(c) for dpid, c in self.packet_in_counters.items()}
+
+    def _report_packet_in_counters_periodically(self):
+
+        while True:
+            time.sleep(PACKET_IN_STATS_INTERVAL)
+            for dpid, counters in sorted(self.get_packet_in_counters().items()):
+                if counters['limitados']:
+                    self.logger.warning(f"[PACKET-IN] switch={dpid} recibidos={counters['recibidos']} limitados={counters['limitados']}")
+                else:
+                    self.logger.debug(f"[PACKET-IN] switch={dpid} recibidos={counters['recibidos']} limitados=0")
+
+    def _request_meter_features(self, datapath):
+
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPMeterFeaturesStatsRequest(datapath, 0))
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply, MAIN_DISPATCHER)
+    def _meter_features_reply_handler(self, ev):
+        """
+        Solo se usa el medidor si el switch admite medidores por paquetes con banda de descarte;
+        en ese caso las reglas hacia el controlador se reinstalan con él.
+        """
+        datapath = ev.msg.datapath
+        ofproto = datapath.ofproto
+        supported = any(
+            f.max_meter >= PACKET_IN_METER_ID
+            and f.band_types & (1 << ofproto.OFPMBT_DROP)
+            and f.capabilities & ofproto.OFPMF_PKTPS
+            for f in ev.msg.body
+        )
+        if not supported:
+            self.logger.warning(f"Switch {datapath.id} sin soporte de medidores: packet-in limitado solo en el controlador.")
+            return
+        self.meter_capable.add(datapath.id)
+        self._install_packet_in_meter(datapath)
+        self._install_controller_bound_flows(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        """
+        Si el switch rechaza el medidor (o las instrucciones que lo referencian), las reglas hacia
+        el controlador se reinstalan sin él para no perder el tráfico que llega al controlador.
+        """
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        self.logger.warning(f"Error OpenFlow del switch {datapath.id}: type={msg.type} code={msg.code}")
+        meter_rejected = (
+            (msg.type == ofproto.OFPET_METER_MOD_FAILED and msg.code != ofproto.OFPMMFC_METER_EXISTS)
+            or msg.type == ofproto.OFPET_BAD_INSTRUCTION
+        )
+        if meter_rejected and datapath.id in self.meter_capable:
+            self.logger.warning(f"Switch {datapath.id} rechazó el medidor packet-in: reinstalando reglas sin medidor.")
+            self.meter_capable.discard(datapath.id)
+            self._install_controller_bound_flows(datapath)
+
+    def _install_controller_bound_flows(self, datapath):
+        """
+        (Re)instala las reglas cuyo destino es el controlador con el medidor que corresponda.
+        """
+        self.add_flow(datapath, **self._table_miss_spec(datapath))
+        for spec in self._broadcast_flow_specs(datapath):
+            if spec['priority'] == BROADCAST_ARP_PRIORITY:
+                self.add_flow(datapath, **spec)
 
+    def _install_packet_in_meter(self, datapath):
+        """
+        Instala (o reinstala) el medidor OpenFlow 1.3 que limita el tráfico enviado al controlador.
+        """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        rate, burst = self._packet_in_rate(datapath.id)
+
+        # ADD seguido de MODIFY: si el switch conserva el medidor de una conexión anterior
+        # el ADD falla (METER_EXISTS) y el MODIFY actualiza la tasa sin borrar los flujos que lo usan.
+        bands = [parser.OFPMeterBandDrop(rate=rate, burst_size=burst)]
+        for command in (ofproto.OFPMC_ADD, ofproto.OFPMC_MODIFY):
+            mod = parser.OFPMeterMod(datapath=datapath, command=command,
+                                     flags=ofproto.OFPMF_PKTPS | ofproto.OFPMF_BURST,
+                                     meter_id=PACKET_IN_METER_ID, bands=bands)
+            datapath.send_msg(mod)
+        self.logger.info(f"Medidor packet-in instalado en switch {datapath.id}: {rate} pps, burst {burst}")
+
+    def _controller_meter_id(self, dpid):
+        """
+        Medidor a usar en reglas cuyo destino es el controlador (None si están deshabilitados o el
+        switch no los admite).
+        """
+        if PACKET_IN_METERS_ENABLED and dpid in self.meter_capable:
+            return PACKET_IN_METER_ID
+        return None
+
+    @staticmethod
+    def _flow_key(priority, match):
+        """
+        Clave de un flujo en el índice: (prioridad, campos del match ordenados).
+        """
+        return (priority, tuple(sorted(match.items())))
+
+    def _new_cookie(self):
+
+        cookie = self._next_cookie
+        self._next_cookie += 1
+        return cookie
+
+    def _record_flow(self, dpid, priority, match, cookie, idle_timeout, hard_timeout):
+
+        self.installed_flows[dpid][self._flow_key(priority, match)] = {
+            'cookie': cookie,
+            'installed_at': time.time(),
+            'idle_timeout': idle_timeout,
+            'hard_timeout': hard_timeout
+        }
+
+    def _forget_flows(self, dpid, match, priority=None):
+        """
+        Refleja en el índice un borrado: exacto si se da la prioridad, o de todos los
+        flujos cuyo match contiene los campos indicados (semántica OFPFC_DELETE).
+        """
+        flows = self.installed_flows.get(dpid)
+        if not flows:
+            return
+        if priority is not None:
+            flows.pop(self._flow_key(priority, match), None)
+            return
+        fields = set(match.items())
+        for key in [k for k in flows if fields.issubset(k[1])]:
+            del flows[key]
+
+    def is_flow_installed(self, dpid, priority, match):
 
+        return self._flow_key(priority, match) in self.installed_flows.get(dpid, {})
+
+    def _multicast_flow_present(self, dpid, multicast_group_addr):
+        """
+        Indica si el switch tiene, según el índice de flujos, la regla de replicación del grupo.
+        """
+        datapath = self.datapaths.get(dpid)
+        if not datapath:
+            return False
+        match = self._multicast_group_match(datapath.ofproto_parser, multicast_group_addr)
+        return self.is_flow_installed(dpid, MULTICAST_FLOW_PRIORITY, match)
+
+    def _send_or_queue(self, datapath, msg, batch):
+
+        if batch is not None:
+            batch.add(datapath, msg)
+        else:
+            datapath.send_msg(msg)
+
+    def _commit_batch(self, batch):
+        """
+        Envía un lote: switches en orden inverso (egreso primero), cada uno seguido de una
+        barrera. Los packet-out se liberan en _complete_batch al recibir todas las respuestas.
+        """
+        self._expire_stale_batches()
+        batch.sent_at = time.monotonic()
+
+        for dpid, (datapath, msgs) in reversed(list(batch.messages.items())):
+            for msg in msgs:
+                datapath.send_msg(msg)
+            barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(barrier)
+            self._pending_barriers[(dpid, barrier.xid)] = batch
+            batch.pending_barriers.add((dpid, barrier.xid))
+            datapath.send_msg(barrier)
+
+        if not batch.pending_barriers:
+            self._complete_batch(batch)
+
+    def _complete_batch(self, batch):
+
+        for datapath, msg in batch.packet_outs:
+            datapath.send_msg(msg)
+        batch.packet_outs = []
+
+        if batch.messages:
+            elapsed = time.monotonic() - batch.sent_at
+            self.flow_install_latencies.append((batch.name, batch.message_count(), elapsed))
+            self.metrics.observe('controller_flow_batch_seconds', elapsed)
+            self.logger.debug(f"[BATCH] {batch.name}: {batch.message_count()} mensajes en {len(batch.messages)} switches "
+                              f"confirmados en {elapsed * 1000:.1f} ms")
+
+    def _resolve_barrier(self, key):
+
+        batch = self._pending_barriers.pop(key, None)
+        if batch is None:
+            return
+        batch.pending_barriers.discard(key)
+        if not batch.pending_barriers:
+            self._complete_batch(batch)
+
+    def _expire_stale_batches(self):
+        """
+        Libera lotes cuyas barreras no obtuvieron respuesta dentro de BARRIER_TIMEOUT.
+        """
+        now = time.monotonic()
+        for key, batch in list(self._pending_barriers.items()):
+            if batch.sent_at is not None and now - batch.sent_at > BARRIER_TIMEOUT:
+                self.logger.warning(f"[BATCH] {batch.name}: sin respuesta de barrera del switch {key[0]} tras {BARRIER_TIMEOUT}s.")
+                self._resolve_barrier(key)
+
+    def _expire_batches_periodically(self):
+        """
+        Sin este barrido, un lote cuya barrera no recibe respuesta retendría sus packet-out hasta
+        el siguiente _commit_batch, que puede no llegar nunca.
+        """
+        while True:
+            time.sleep(BARRIER_TIMEOUT / 2)
+            self._expire_stale_batches()
+
+    def _drop_datapath_batches(self, dpid):
+        """
+        Descarta las barreras y packet-out pendientes de un switch desconectado. Los lotes que solo
+        esperaban a ese switch se completan para liberar los packet-out del resto.
+        """
+        for key in [k for k in self._pending_barriers if k[0] == dpid]:
+            batch = self._pending_barriers.pop(key)
+            batch.pending_barriers.discard(key)
+            batch.packet_outs = [(dp, msg) for dp, msg in batch.packet_outs if dp.id != dpid]
+            if not batch.pending_barriers:
+                self._complete_batch(batch)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+
+        msg = ev.msg
+        self._resolve_barrier((msg.datapath.id, msg.xid))
+
+    @staticmethod
+    def _build_instructions(datapath, actions, meter_id=None):
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id, ofproto.OFPIT_METER))
+        return inst
+
+    @staticmethod
+    def _normalize_instructions(datapath, instructions):
+        """
+        Forma comparable de una lista de instrucciones (las listas de acciones vacías equivalen a descartar).
+        """
+        parser = datapath.ofproto_parser
+        normalized = []
+        for inst in instructions:
+            if isinstance(inst, parser.OFPInstructionMeter):
+                normalized.append(('meter', inst.meter_id))
+            elif isinstance(inst, parser.OFPInstructionActions):
+                actions = []
+                for action in inst.actions:
+                    if isinstance(action, parser.OFPActionOutput):
+                        actions.append(('output', action.port))
+                    elif isinstance(action, parser.OFPActionGroup):
+                        actions.append(('group', action.group_id))
+                    else:
+                        actions.append((action.__class__.__name__, str(action)))
+                if actions:
+                    normalized.append(('actions', inst.type, tuple(actions)))
+            else:
+                normalized.append((inst.__class__.__name__, str(inst)))
+        return tuple(sorted(normalized))
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None, idle_timeout=0, hard_timeout=0, meter_id=None, batch=None):
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        inst = self._build_instructions(datapath, actions, meter_id)
+        cookie = self._new_cookie()
         mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id if buffer_id is not None else ofproto.OFP_NO_BUFFER,
+                                 cookie=cookie,
                                  priority=priority, match=match,
                                  instructions=inst,
                                  idle_timeout=idle_timeout,
-                                 hard_timeout=hard_timeout)
-        datapath.send_msg(mod)
+                                 hard_timeout=hard_timeout,
+                                 flags=ofproto.OFPFF_SEND_FLOW_REM)
+        self._send_or_queue(datapath, mod, batch)
+        self.metrics.inc('controller_flow_mods_total', (('dpid', str(datapath.id)), ('comando', 'add')))
+        self._record_flow(datapath.id, priority, match, cookie, idle_timeout, hard_timeout)
         self.logger.debug(f"Regla de flujo añadida al switch {datapath.id}: priority={priority}, match={match}, actions={actions}")
 
-    def remove_flow_by_match(self, datapath, match):
+    def remove_flow_by_match(self, datapath, match, priority=None, batch=None):
         """
         Elimina flujos que coincidan con un match específico de un datapath.
+        Si se indica la prioridad, solo se elimina la regla exacta (DELETE_STRICT).
         """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE,
-                                out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
-                                match=match)
-        datapath.send_msg(mod)
+        if priority is None:
+            mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE,
+                                    out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                    match=match)
+        else:
+            mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE_STRICT,
+                                    out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                    priority=priority, match=match)
+        self._send_or_queue(datapath, mod, batch)
+        self.metrics.inc('controller_flow_mods_total', (('dpid', str(datapath.id)), ('comando', 'delete')))
+        self._forget_flows(datapath.id, match, priority)
         self.logger.info(f"Flujo eliminado del switch {datapath.id} con match: {match}")
 
-    def _send_packet_out(self, datapath, buffer_id, in_port, actions, data):
+    def _send_packet_out(self, datapath, buffer_id, in_port, actions, data, batch=None):
         """
-        Envía un paquete fuera del switch.
+        Envía un paquete fuera del switch. Con un lote, el envío se retiene hasta que
+        todos los switches confirmen sus reglas.
         """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         out = parser.OFPPacketOut(datapath=datapath, buffer_id=buffer_id,
                                    in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+        if batch is not None:
+            batch.add_packet_out(datapath, out)
+        else:
+            datapath.send_msg(out)
 
     def _send_arp_reply(self, datapath, target_mac, target_ip, src_mac, src_ip, out_port):
 
@@ -319,99 +1299,446 @@ class Controller(app_manager.RyuApp):
         datapath.send_msg(out)
         self.logger.info(f"Respuesta ARP proxy enviada: {src_ip} está en {src_mac} a {target_mac}")
 
-    def _handle_igmp_packet(self, datapath, msg, dpid, in_port, igmp_pkt):
+    def _multicast_group_match(self, parser, multicast_group_addr):
+
+        return parser.OFPMatch(
+            eth_type=ether_types.ETH_TYPE_IP,
+            ipv4_dst=multicast_group_addr,
+            ip_proto=inet.IPPROTO_UDP
+        )
+
+    def _install_negative_cache_rule(self, dpid, multicast_group_addr):
         """
-        Redirige la lógica IGMP a un backend externo vía HTTP.
+        Instala en el switch fuente una regla de descarte de baja prioridad y corta duración
+        para un grupo multicast sin miembros, evitando un packet-in por cada paquete del stream.
         """
-        self.logger.info(f"Redirigiendo IGMP a backend externo. switch={dpid}, puerto={in_port}, tipo={igmp_pkt.msgtype}")
-        url = "http://192.168.18.151:5000/igmp/process" 
+        # Preferir el switch donde está conectado el servidor del grupo
+        source_dpid = self.multicast_sources.get(multicast_group_addr)
+        target_dpid = source_dpid if source_dpid in self.datapaths else dpid
+        datapath = self.datapaths.get(target_dpid)
+        if not datapath:
+            return
 
-        payload = {
-            "dpid": dpid,
-            "in_port": in_port,
-            "msgtype": igmp_pkt.msgtype,
-            "records": [],  
-            "address": igmp_pkt.address 
-        }
+        now = time.time()
+        cached = self.multicast_negative_cache[multicast_group_addr]
+        if cached.get(target_dpid, 0) > now:
+            return
 
+        match = self._multicast_group_match(datapath.ofproto_parser, multicast_group_addr)
+        self.add_flow(datapath, priority=NEGATIVE_CACHE_PRIORITY, match=match, actions=[],
+                      hard_timeout=NEGATIVE_CACHE_TIMEOUT)
+        cached[target_dpid] = now + NEGATIVE_CACHE_TIMEOUT
+        self.logger.info(f"[CACHE-NEG] Regla de descarte instalada en {target_dpid} para {multicast_group_addr} "
+                         f"(sin miembros, {NEGATIVE_CACHE_TIMEOUT}s)")
 
-        if igmp_pkt.msgtype == 34:  
-            records = []
-            for record in igmp_pkt.records:
-                records.append({
-                    "address": record.address,
-                    "type": record.type_,
-                    "sources": record.sources
-                })
-            payload["records"] = records
+    def _clear_negative_cache(self, multicast_group_addr, batch=None):
+        """
+        Elimina las reglas de descarte de un grupo (p.ej. al llegar el primer join IGMP).
+        """
+        cached = self.multicast_negative_cache.pop(multicast_group_addr, None)
+        if not cached:
+            return
 
-        elif igmp_pkt.msgtype in [22, 23]:  # IGMPv2 Join/Leave
-            payload["address"] = igmp_pkt.address
+        now = time.time()
+        for dpid, expires_at in cached.items():
+            datapath = self.datapaths.get(dpid)
+            if not datapath or expires_at <= now:
+                continue
+            match = self._multicast_group_match(datapath.ofproto_parser, multicast_group_addr)
+            self.remove_flow_by_match(datapath, match, priority=NEGATIVE_CACHE_PRIORITY, batch=batch)
+            self.logger.info(f"[CACHE-NEG] Regla de descarte eliminada en {dpid} para {multicast_group_addr}")
 
+    @staticmethod
+    def _is_igmp_group(address):
+        """
+        Grupo multicast válido para pertenencia (se excluye 224.0.0.0/24, de control local).
+        """
         try:
-            response = requests.post(url, json=payload, timeout=3)
-            if response.status_code == 200:
-                result = response.json()
-                self.logger.info(f"[IGMP BACKEND] Respuesta: {result}")
+            addr = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return addr.is_multicast and addr not in ipaddress.ip_network('224.0.0.0/24')
 
-                self.multicast_group_members = {
-                    group: {int(dpid): ports for dpid, ports in switches.items()}
-                    for group, switches in result.get("group_membership", {}).items()
-                }
-                for group_ip in result.get("install_flows", []):
-                    self._install_multicast_flows(group_ip)
-                for group_ip in result.get("remove_flows", []):
-                    self._remove_multicast_flows(group_ip)
+    def _apply_igmp_record(self, group, dpid, port, record_type, sources, now):
+        """
+        Aplica un registro de grupo IGMPv3 (los mensajes v1/v2 se traducen a IS_EX{} y TO_IN{})
+        al estado de filtro del puerto según RFC 3376.
+        """
+        ports = self.igmp_members.setdefault(group, {}).setdefault(dpid, {})
+        state = ports.get(port)
+        sources = set(sources)
+
+        if record_type in (igmp.MODE_IS_EXCLUDE, igmp.CHANGE_TO_EXCLUDE_MODE):
+            state = {'mode': 'exclude', 'sources': sources}
+        elif record_type == igmp.CHANGE_TO_INCLUDE_MODE:
+            state = {'mode': 'include', 'sources': sources}
+        elif record_type in (igmp.MODE_IS_INCLUDE, igmp.ALLOW_NEW_SOURCES):
+            if state is None:
+                state = {'mode': 'include', 'sources': sources}
+            elif state['mode'] == 'include':
+                state['sources'] |= sources
             else:
-                self.logger.error(f"Error desde backend IGMP: {response.status_code} {response.text}")
+                state['sources'] -= sources
+        elif record_type == igmp.BLOCK_OLD_SOURCES:
+            if state is None:
+                return
+            if state['mode'] == 'include':
+                state['sources'] -= sources
+            else:
+                state['sources'] |= sources
+        else:
+            self.logger.debug(f"[IGMP] Tipo de registro desconocido {record_type} para {group} en {dpid}:{port}")
+            return
+
+        if state['mode'] == 'include' and not state['sources']:
+            # INCLUDE{} equivale a abandonar el grupo
+            if ports.pop(port, None) is not None:
+                self.logger.info(f"[IGMP] [LEAVE] {group} <- switch {dpid}, puerto {port}")
+        else:
+            if port not in ports:
+                self.logger.info(f"[IGMP] [JOIN] {group} -> switch {dpid}, puerto {port} ({state['mode']})")
+            state['expires_at'] = now + IGMP_MEMBERSHIP_TIMEOUT
+            ports[port] = state
+
+        if not ports:
+            self.igmp_members[group].pop(dpid, None)
+        if not self.igmp_members[group]:
+            self.igmp_members.pop(group, None)
+
+    def _refresh_group_members(self, group):
+        """
+        Recalcula multicast_group_members[grupo] a partir del estado IGMP. Devuelve True si cambió.
+        """
+        members = {dpid: sorted(ports) for dpid, ports in self.igmp_members.get(group, {}).items() if ports}
+        current = self.multicast_group_members.get(group)
+        if current is not None and {d: sorted(p) for d, p in current.items() if p} == members:
+            return False
+        if members:
+            self.multicast_group_members[group] = members
+        else:
+            self.multicast_group_members.pop(group, None)
+        if not members and current is None:
+            return False
+        self.igmp_membership_version += 1
+        return True
+
+    def _handle_igmp_packet(self, datapath, msg, dpid, in_port, igmp_pkt):
+        """
+        Procesa localmente informes IGMP v1/v2/v3 y abandonos v2 del puerto de host in_port.
+        """
+        msgtype = igmp_pkt.msgtype
+        now = time.time()
+        self.metrics.inc('controller_igmp_messages_total', (('tipo', hex(msgtype)),))
+
+        if msgtype == igmp.IGMP_TYPE_REPORT_V3:
+            records = [(r.address, r.type_, r.srcs or []) for r in igmp_pkt.records]
+        elif msgtype in (igmp.IGMP_TYPE_REPORT_V1, igmp.IGMP_TYPE_REPORT_V2):
+            records = [(igmp_pkt.address, igmp.MODE_IS_EXCLUDE, [])]
+        elif msgtype == igmp.IGMP_TYPE_LEAVE:
+            # Puertos de host punto a punto: abandono inmediato sin consulta específica de grupo
+            records = [(igmp_pkt.address, igmp.CHANGE_TO_INCLUDE_MODE, [])]
+        elif msgtype == igmp.IGMP_TYPE_QUERY:
+            self.logger.debug(f"[IGMP] Consulta recibida de otro querier en {dpid}:{in_port}. Ignorada.")
+            return
+        else:
+            self.logger.debug(f"[IGMP] Tipo de mensaje no soportado {msgtype} en {dpid}:{in_port}")
+            return
+
+        with self.topology_lock:
+            groups = set()
+            for group, record_type, sources in records:
+                if not self._is_igmp_group(group):
+                    continue
+                self._apply_igmp_record(group, dpid, in_port, record_type, sources, now)
+                groups.add(group)
+            changed = {group for group in groups if self._refresh_group_members(group)}
+            self._apply_membership_changes(changed)
+
+    def _expire_igmp_members(self, now):
+        """
+        Retira los puertos cuyo temporizador de pertenencia venció sin recibir informes.
+        """
+        with self.topology_lock:
+            groups = set()
+            for group, switches in list(self.igmp_members.items()):
+                for dpid, ports in list(switches.items()):
+                    for port, state in list(ports.items()):
+                        if state['expires_at'] <= now:
+                            del ports[port]
+                            groups.add(group)
+                            self.metrics.inc('controller_igmp_expired_members_total')
+                            self.logger.info(f"[IGMP] [EXPIRADO] {group} <- switch {dpid}, puerto {port}")
+                    if not ports:
+                        del switches[dpid]
+                if not switches:
+                    del self.igmp_members[group]
+            changed = {group for group in groups if self._refresh_group_members(group)}
+            self._apply_membership_changes(changed)
+
+    def _build_general_query(self):
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_IP,
+                                           dst=IGMP_ALL_HOSTS_MAC, src=IGMP_QUERIER_MAC))
+        pkt.add_protocol(ipv4.ipv4(dst=IGMP_ALL_HOSTS_IP, src=IGMP_QUERIER_IP,
+                                   proto=inet.IPPROTO_IGMP, ttl=1))
+        # Consulta v3: los hosts v2 la interpretan como consulta general v2
+        pkt.add_protocol(igmp.igmpv3_query(maxresp=IGMP_QUERY_RESPONSE_INTERVAL * 10,
+                                           address='0.0.0.0', qrv=IGMP_ROBUSTNESS,
+                                           qqic=min(IGMP_QUERY_INTERVAL, 127)))
+        pkt.serialize()
+        return pkt.data
+
+    def _send_general_query(self, datapath, data=None):
+        """
+        Envía una General Query por los puertos de host del switch.
+        """
+        host_ports = sorted(self._host_ports_by_dpid().get(datapath.id, set()))
+        if not host_ports:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(port) for port in host_ports]
+        self._send_packet_out(datapath, ofproto.OFP_NO_BUFFER, ofproto.OFPP_CONTROLLER, actions,
+                              data or self._build_general_query())
+
+    def _igmp_querier_loop(self):
+
+        next_query = 0
+        while True:
+            now = time.time()
+            if now >= next_query:
+                data = self._build_general_query()
+                for datapath in list(self.datapaths.values()):
+                    self._send_general_query(datapath, data)
+                self.logger.debug(f"[IGMP] General Query enviada a {len(self.datapaths)} switches.")
+                next_query = now + IGMP_QUERY_INTERVAL
+            self._expire_igmp_members(now)
+            time.sleep(1)
+
+    def _push_membership_periodically(self):
+        """
+        Envía la pertenencia al backend (solo para visualización) cuando cambia, fuera del camino de packet-in.
+        """
+        url = "http://192.168.18.151:5000/igmp/sync"
+        while True:
+            time.sleep(IGMP_SYNC_INTERVAL)
+            version = self.igmp_membership_version
+            if version == self._igmp_pushed_version:
+                continue
+            with self.topology_lock:
+                payload = {
+                    "group_membership": {
+                        group: {str(dpid): list(ports) for dpid, ports in switches.items()}
+                        for group, switches in self.multicast_group_members.items()
+                    }
+                }
+            try:
+                response = self._backend_request(url, payload, timeout=3)
+                if response.status_code == 200:
+                    self._igmp_pushed_version = version
+                else:
+                    self.logger.error(f"Error al enviar pertenencia IGMP al backend: {response.status_code} {response.text}")
+            except requests.RequestException as e:
+                self.logger.error(f"Fallo al enviar pertenencia IGMP al backend: {e}")
+
+    def _apply_membership_changes(self, changed):
+        """
+        Programa el recálculo del árbol de cada grupo modificado. Los cambios que llegan dentro de
+        MULTICAST_RECOMPUTE_DEBOUNCE se agrupan: un único cálculo por grupo y una sola petición de
+        árboles al backend para todos los grupos de la ventana.
+        """
+        if MULTICAST_RECOMPUTE_DEBOUNCE <= 0:
+            if changed:
+                self._recompute_multicast_groups(changed)
+            return
+        with self.topology_lock:
+            for group_ip in changed:
+                if group_ip in self._pending_tree_updates:
+                    self.metrics.inc('controller_multicast_recomputations_saved_total')
+                else:
+                    self._pending_tree_updates.add(group_ip)
+            if self._pending_tree_updates and self._tree_update_timer is None:
+                self._tree_update_timer = threading.Timer(MULTICAST_RECOMPUTE_DEBOUNCE, self._flush_tree_updates)
+                self._tree_update_timer.daemon = True
+                self._tree_update_timer.start()
+
+    def _flush_tree_updates(self):
+        """
+        Recalcula los grupos pendientes. La petición HTTP de árboles se hace sin topology_lock para
+        no detener los packet-in y PortStatus durante la ida y vuelta al backend; los cambios que
+        lleguen mientras tanto vuelven a quedar pendientes y se tratan en la siguiente ventana.
+        """
+        with self.topology_lock:
+            groups = self._pending_tree_updates
+            self._pending_tree_updates = set()
+            self._tree_update_timer = None
+            entries = self._multicast_tree_entries(groups)
+            excluded_links = self._excluded_links_payload()
+
+        try:
+            trees = self._request_multicast_trees(entries, excluded_links)
+            with self.topology_lock:
+                self._recompute_multicast_groups(groups, trees=trees)
         except Exception as e:
-            self.logger.error(f"Fallo al comunicar con backend IGMP: {e}")
+            self.logger.error(f"Error al recalcular los árboles de {sorted(groups)}: {e}", exc_info=True)
 
-    
     def _handle_multicast_ip_traffic(self, datapath, msg, dpid, in_port, multicast_ip):
 
             self.logger.debug(f"DEBUG: Entrando a _handle_multicast_ip_traffic para {multicast_ip} en switch {dpid} puerto {in_port}.")
             # Verificar si hay algún miembro para este grupo multicast en cualquier switch
             if not self.multicast_group_members.get(multicast_ip):
                 self.logger.debug(f"Tráfico IP Multicast {multicast_ip} de {dpid} en {in_port} llegó al controlador, pero no hay clientes suscritos. Descartando paquete.")
+                self._install_negative_cache_rule(dpid, multicast_ip)
                 self.logger.debug(f"DEBUG: Saliendo de _handle_multicast_ip_traffic (sin suscriptores).")
                 return 
 
             self.logger.warning(f"Tráfico IP Multicast {multicast_ip} de {dpid} en {in_port} llegó al controlador. Re-evaluando e instalando flujos.")
             self.logger.debug(f"DEBUG: Llamando a _install_multicast_flows desde _handle_multicast_ip_traffic para {multicast_ip}.")
 
-            if dpid not in self.multicast_flow_installed_at.get(multicast_ip, set()):
-                self.logger.debug(f"Instalando flujos para {multicast_ip} desde controlador (primera vez en {dpid}).")
-                self._install_multicast_flows(multicast_ip)
-            else:
+            if self._multicast_flow_present(dpid, multicast_ip):
                 self.logger.debug(f"[SKIP] Flujos ya instalados para {multicast_ip} en {dpid}.")
                 return
-            self.logger.debug(f"DEBUG: _install_multicast_flows finalizado desde _handle_multicast_ip_traffic.")
 
-            data = None
-            if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
-                data = msg.data
+            # Las reglas del árbol y el packet-out de respaldo viajan en el mismo lote:
+            # el paquete solo se libera cuando todos los switches confirmaron sus reglas.
+            batch = FlowModBatch(f"multicast {multicast_ip} (packet-in {dpid})")
+            try:
+                self.logger.debug(f"Instalando flujos para {multicast_ip} desde controlador (primera vez en {dpid}).")
+                self._install_multicast_flows(multicast_ip, batch=batch)
+                self.logger.debug(f"DEBUG: _install_multicast_flows finalizado desde _handle_multicast_ip_traffic.")
+
+                data = None
+                if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
+                    data = msg.data
 
-            # Intentar reenviar el paquete si hay miembros conocidos en este switch
-            if dpid in self.multicast_group_members[multicast_ip]:
-                out_ports = self.multicast_group_members[multicast_ip][dpid]
+                # Intentar reenviar el paquete si hay miembros conocidos en este switch
+                out_ports = self.multicast_group_members[multicast_ip].get(dpid)
                 if out_ports:
                     actions = [datapath.ofproto_parser.OFPActionOutput(p) for p in out_ports]
-                    self._send_packet_out(datapath, msg.buffer_id, in_port, actions, data)
+                    self._send_packet_out(datapath, msg.buffer_id, in_port, actions, data, batch=batch)
                     self.logger.debug(f"Fallback: Paquete multicast reenviado desde {dpid} a {out_ports}")
                     self.logger.debug(f"DEBUG: Saliendo de _handle_multicast_ip_traffic (reenviado fallback).")
                     return
-            self.logger.warning(f"Paquete multicast {multicast_ip} en {dpid} (in_port {in_port}) no pudo ser reenviado por el controlador fallback (no hay miembros en este switch o puertos de salida).")
-            self.logger.debug(f"DEBUG: Saliendo de _handle_multicast_ip_traffic (no reenviado fallback).")
+                self.logger.warning(f"Paquete multicast {multicast_ip} en {dpid} (in_port {in_port}) no pudo ser reenviado por el controlador fallback (no hay miembros en este switch o puertos de salida).")
+                self.logger.debug(f"DEBUG: Saliendo de _handle_multicast_ip_traffic (no reenviado fallback).")
+            finally:
+                self._commit_batch(batch)
 
 
-    def _install_multicast_flows(self, multicast_group_addr):
+    def _tree_order(self, source_dpid, tree):
         """
-        Calcula e instala las reglas de flujo para un árbol multicast.
-        Incluye lógica de cache para no reinstalar si el árbol no cambió.
-        Asegura que los puertos hoja correctos (de IGMP) se fusionen con los caminos del árbol.
+        Ordena los switches de un árbol multicast desde la fuente hacia las hojas (BFS
+        siguiendo los puertos de salida del árbol). Los switches no alcanzables van al final.
         """
-        self.logger.debug(f"DEBUG: Entrando a _install_multicast_flows para grupo {multicast_group_addr}.")
+        order = []
+        visited = set()
+        queue = collections.deque([source_dpid] if source_dpid in tree else [])
+        while queue:
+            dpid = queue.popleft()
+            if dpid in visited:
+                continue
+            visited.add(dpid)
+            order.append(dpid)
+            port_to_neighbor = {port: neighbor for neighbor, port in self.switch_links.get(dpid, {}).items()}
+            for port in tree.get(dpid, []):
+                neighbor = port_to_neighbor.get(port)
+                if neighbor in tree and neighbor not in visited:
+                    queue.append(neighbor)
+        order.extend(sorted(d for d in tree if d not in visited))
+        return order
+
+    def _fetch_multicast_trees(self, groups):
+        """
+        Pide al backend en una sola llamada los árboles base de varios grupos. Devuelve {grupo: árbol};
+        los grupos sin fuente, sin miembros o con error no aparecen.
+        """
+        return self._request_multicast_trees(self._multicast_tree_entries(groups), self._excluded_links_payload())
+
+    def _multicast_tree_entries(self, groups):
+        """
+        Entradas de la petición de árboles (grupo, fuente, switches miembros) para los grupos que
+        tienen fuente y miembros.
+        """
+        entries = []
+        for group in groups:
+            source_dpid = self.multicast_sources.get(group)
+            member_switches = self.multicast_group_members.get(group, {})
+            if source_dpid and member_switches:
+                entries.append({
+                    "group": group,
+                    "source_dpid": source_dpid,
+                    "member_dpids": list(member_switches.keys())
+                })
+        return entries
+
+    def _request_multicast_trees(self, entries, excluded_links):
+
+        if not entries:
+            return {}
+
+        self.logger.debug(f"DEBUG: Solicitando {len(entries)} árboles multicast remotos: {entries}")
+        try:
+            url = "http://192.168.18.151:5000/dijkstra/calculate_multicast_trees"
+            payload = {"groups": entries, "excluded_links": excluded_links}
+            response = self._backend_request(url, payload, timeout=5)
+            if response.status_code != 200:
+                self.logger.error(f"Error al obtener árboles multicast de dijkstra.py: {response.status_code} {response.text}")
+                return {}
+            result = response.json()
+        except requests.RequestException as e:
+            self.logger.error(f"Fallo en la solicitud al servidor de rutas multicast (dijkstra.py): {e}")
+            return {}
+
+        for group, error in result.get("errors", {}).items():
+            self.logger.error(f"Error al obtener árbol multicast de {group} en dijkstra.py: {error}")
+        return result.get("trees", {})
+
+    def _recompute_multicast_groups(self, groups, trees=None):
+        """
+        Recalcula varios grupos con una sola petición de árboles y un único lote de FlowMod.
+        Los grupos sin miembros se eliminan. trees permite aplicar árboles ya pedidos al backend.
+        """
+        groups = sorted(groups)
+        active = [group for group in groups if self.multicast_group_members.get(group)]
+        if trees is None:
+            trees = self._fetch_multicast_trees(active)
+
+        batch = FlowModBatch(f"multicast ({len(active)} grupos)")
+        try:
+            for group in active:
+                if group not in trees:
+                    self.logger.warning(f"Sin árbol para {group} (fuente desconocida o error en dijkstra.py). No se instalan flujos.")
+                    continue
+                self._clear_negative_cache(group, batch=batch)
+                self._install_multicast_flows(group, batch=batch, dijkstra_tree_raw=trees[group])
+        finally:
+            self._commit_batch(batch)
+
+        for group in groups:
+            if group not in active:
+                self._remove_multicast_flows(group)
+
+    def _install_multicast_flows(self, multicast_group_addr, batch=None, dijkstra_tree_raw=None):
+        """
+        Calcula e instala las reglas de flujo para un árbol multicast.
+        Incluye lógica de cache para no reinstalar si el árbol no cambió.
+        Asegura que los puertos hoja correctos (de IGMP) se fusionen con los caminos del árbol.
+        Si no se recibe un lote, los FlowMod se envían en uno propio confirmado con barreras.
+        dijkstra_tree_raw permite reutilizar un árbol ya obtenido con _fetch_multicast_trees.
+        """
+        own_batch = batch is None
+        if own_batch:
+            batch = FlowModBatch(f"multicast {multicast_group_addr}")
+        try:
+            self._install_multicast_flows_batched(multicast_group_addr, batch, dijkstra_tree_raw)
+        finally:
+            if own_batch:
+                self._commit_batch(batch)
+
+    def _install_multicast_flows_batched(self, multicast_group_addr, batch, dijkstra_tree_raw=None):
+
+        self.logger.debug(f"DEBUG: Entrando a _install_multicast_flows para grupo {multicast_group_addr}.")
 
         # Conseguir la fuente (DPID) para este grupo multicast
         source_dpid = self.multicast_sources.get(multicast_group_addr)
@@ -428,31 +1755,17 @@ class Controller(app_manager.RyuApp):
 
             if self._last_installed_tree.get(multicast_group_addr):
                  self.logger.info(f"No hay miembros para {multicast_group_addr}, pero había un árbol anterior. Limpiando flujos.")
-                 self._clear_flows_for_group(multicast_group_addr) 
+                 self._clear_flows_for_group(multicast_group_addr, batch=batch)
                  self._last_installed_tree.pop(multicast_group_addr, None)
             return
 
-        # Pedir al backend Flask el árbol multicast base
-        self.logger.debug(f"DEBUG: Solicitando árbol multicast remoto para {multicast_group_addr} "
-                          f"desde fuente {source_dpid} a miembros {list(member_switches.keys())}.")
-        try:
-            url = "http://192.168.18.151:5000/dijkstra/calculate_multicast_tree"
-            payload = {
-                "source_dpid": source_dpid,
-                "member_dpids": list(member_switches.keys()) 
-            }
-            response = requests.post(url, json=payload, timeout=5)
-            if response.status_code != 200:
-                self.logger.error(f"Error al obtener árbol multicast de dijkstra.py: {response.status_code} {response.text}")
-                self.logger.debug(f"DEBUG: Saliendo de _install_multicast_flows (respuesta no 200 de dijkstra).")
+        # Pedir al backend Flask el árbol multicast base (salvo que ya venga de una petición por lotes)
+        if dijkstra_tree_raw is None:
+            dijkstra_tree_raw = self._fetch_multicast_trees([multicast_group_addr]).get(multicast_group_addr)
+            if dijkstra_tree_raw is None:
+                self.logger.debug(f"DEBUG: Saliendo de _install_multicast_flows (sin árbol de dijkstra).")
                 return
 
-            dijkstra_tree_raw = response.json().get("tree", {})
-        except requests.RequestException as e:
-            self.logger.error(f"Fallo en la solicitud al servidor de rutas multicast (dijkstra.py): {e}")
-            self.logger.debug(f"DEBUG: Saliendo de _install_multicast_flows (excepción en request a dijkstra).")
-            return
-
         self.logger.debug(f"DEBUG: Árbol base recibido de dijkstra.py para {multicast_group_addr}: {dijkstra_tree_raw}")
 
         # Parsear el árbol de Dijkstra 
@@ -503,7 +1816,14 @@ class Controller(app_manager.RyuApp):
         # Comparar con el último árbol instalado para este grupo
         last_installed_tree_for_group = self._last_installed_tree.get(multicast_group_addr, {})
         
-        if last_installed_tree_for_group == current_tree_for_installation:
+        # Un árbol igual solo se omite si el índice confirma que sus flujos siguen en los switches
+        missing_flows = [d for d in current_tree_for_installation
+                         if d in self.datapaths and not self._multicast_flow_present(d, multicast_group_addr)]
+        if missing_flows:
+            self.logger.info(f"Flujos de {multicast_group_addr} ausentes en {missing_flows} según el índice. Se reinstalará el árbol.")
+
+        if last_installed_tree_for_group == current_tree_for_installation and not missing_flows:
+            self.metrics.inc('controller_multicast_tree_recomputations_total', (('resultado', 'sin_cambios'),))
             self.logger.debug(f"DEBUG: El árbol multicast para {multicast_group_addr} no cambió. "
                               f"Se omite reinstalación de flujos. Actual: {current_tree_for_installation}, Anterior: {last_installed_tree_for_group}")
 
@@ -512,28 +1832,24 @@ class Controller(app_manager.RyuApp):
             return
 
         # Guardar el nuevo árbol
+        self.metrics.inc('controller_multicast_tree_recomputations_total', (('resultado', 'cambiado'),))
         self.logger.info(f"Cambio detectado para {multicast_group_addr}. Anterior: {last_installed_tree_for_group}, Nuevo: {current_tree_for_installation}")
         self._last_installed_tree[multicast_group_addr] = current_tree_for_installation
+        self._index_links(('multicast', multicast_group_addr),
+                          self._links_of_hops((d, p) for d, ports in current_tree_for_installation.items() for p in ports))
 
-        # Limpiar flujos viejos para este grupo EN TODOS LOS SWITCHES donde podrían haber estado.
-        dpids_potentially_with_old_flows = set(last_installed_tree_for_group.keys()).union(set(current_tree_for_installation.keys()))
+        # Limpiar flujos viejos en los switches que salen del árbol. En los que permanecen,
+        # el OFPFC_ADD con el mismo match y prioridad reemplaza la regla sin dejar huecos.
+        dpids_potentially_with_old_flows = set(last_installed_tree_for_group.keys())
         dpids_potentially_with_old_flows.update(self.multicast_flow_installed_at.get(multicast_group_addr, set()))
+        dpids_potentially_with_old_flows.difference_update(current_tree_for_installation.keys())
 
         self.logger.debug(f"DEBUG: Limpiando flujos existentes para {multicast_group_addr} en DPIDs: {dpids_potentially_with_old_flows}")
-        
+        self._clear_negative_cache(multicast_group_addr, batch=batch)
+
         for dpid_to_clear in dpids_potentially_with_old_flows:
-            if dpid_to_clear in self.datapaths:
-                datapath = self.datapaths[dpid_to_clear]
-                parser = datapath.ofproto_parser
-                match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ipv4_dst=multicast_group_addr,
-                    ip_proto=inet.IPPROTO_UDP 
-                )
-                self.remove_flow_by_match(datapath, match) 
-            # Eliminar de multicast_flow_installed_at si ya no es parte del nuevo árbol
-            if dpid_to_clear not in current_tree_for_installation:
-                self.multicast_flow_installed_at.get(multicast_group_addr, set()).discard(dpid_to_clear)
+            self._remove_multicast_replication(dpid_to_clear, multicast_group_addr, batch=batch)
+            self.multicast_flow_installed_at.get(multicast_group_addr, set()).discard(dpid_to_clear)
 
         if not current_tree_for_installation:
             self.logger.info(f"El nuevo árbol para {multicast_group_addr} está vacío. No se instalarán nuevos flujos. Limpieza completada.")
@@ -546,7 +1862,9 @@ class Controller(app_manager.RyuApp):
         # Instalar flujos nuevos según current_tree_for_installation
         self.logger.debug(f"DEBUG: Instalando nuevos flujos para {multicast_group_addr} con árbol: {current_tree_for_installation}")
         current_dpids_with_flow_for_group = set()
-        for dpid, out_ports in current_tree_for_installation.items():
+        # Añadir en orden fuente -> hojas; el lote se envía en orden inverso (hojas primero)
+        for dpid in self._tree_order(source_dpid, current_tree_for_installation):
+            out_ports = current_tree_for_installation[dpid]
             if dpid not in self.datapaths:
                 self.logger.warning(f"Switch {dpid} no encontrado en self.datapaths. No se puede instalar flujo multicast para {multicast_group_addr}.")
                 continue
@@ -556,22 +1874,13 @@ class Controller(app_manager.RyuApp):
                 continue
 
             datapath = self.datapaths[dpid]
-            parser = datapath.ofproto_parser
-            # Crear una acción de salida para cada puerto válido
-            actions = [parser.OFPActionOutput(port_num) for port_num in out_ports]
-            
-            match = parser.OFPMatch(
-                eth_type=ether_types.ETH_TYPE_IP,
-                ipv4_dst=multicast_group_addr,
-                ip_proto=inet.IPPROTO_UDP 
-            )
-
-            self.add_flow(datapath, priority=200, match=match, actions=actions,
-                          idle_timeout=300, hard_timeout=0) 
+            # La replicación la hace un grupo OFPGT_ALL; la regla solo apunta a él
+            changed = self._install_multicast_replication(datapath, multicast_group_addr, out_ports, batch=batch)
 
             current_dpids_with_flow_for_group.add(dpid)
-            self.logger.info(f"[MULTICAST] Flujo instalado/actualizado en {dpid} para {multicast_group_addr} "
-                             f"→ puertos de salida: {out_ports}")
+            if changed:
+                self.logger.info(f"[MULTICAST] Replicación instalada/actualizada en {dpid} para {multicast_group_addr} "
+                                 f"→ puertos de salida: {out_ports}")
         
         # Actualizar el registro de dónde se han instalado los flujos
         if current_dpids_with_flow_for_group:
@@ -583,6 +1892,19 @@ class Controller(app_manager.RyuApp):
         self.logger.debug(f"DEBUG: Saliendo de _install_multicast_flows para grupo {multicast_group_addr}.")
 
 
+    def _clear_flows_for_group(self, multicast_group_addr, batch=None):
+        """
+        Elimina los flujos de replicación de un grupo en todos los switches donde estén instalados.
+        """
+        dpids_a_eliminar = set(self.multicast_flow_installed_at.get(multicast_group_addr, set()))
+        dpids_a_eliminar.update(self._last_installed_tree.get(multicast_group_addr, {}).keys())
+        for dpid in dpids_a_eliminar:
+            if self._remove_multicast_replication(dpid, multicast_group_addr, batch=batch):
+                self.logger.info(f"Flujo multicast eliminado en switch {dpid} para {multicast_group_addr}.")
+            else:
+                self.logger.warning(f"Switch {dpid} no encontrado al intentar eliminar flujo para {multicast_group_addr}.")
+        self.multicast_flow_installed_at.pop(multicast_group_addr, None)
+
     def _remove_multicast_flows(self, multicast_group_addr):
 
         self.logger.debug(f"DEBUG: Entrando a _remove_multicast_flows para grupo {multicast_group_addr}.")
@@ -593,23 +1915,9 @@ class Controller(app_manager.RyuApp):
 
                 if not quedan_miembros:
                     self.logger.info(f"No quedan miembros para el grupo multicast {multicast_group_addr}. Eliminando todos los flujos.")
-
-                    dpids_a_eliminar = list(self.multicast_flow_installed_at.get(multicast_group_addr, set()))
-                    for dpid in dpids_a_eliminar:
-                        if dpid in self.datapaths:
-                            datapath = self.datapaths[dpid]
-                            parser = datapath.ofproto_parser
-                            match = parser.OFPMatch(
-                                eth_type=ether_types.ETH_TYPE_IP,
-                                ipv4_dst=multicast_group_addr,
-                                ip_proto=inet.IPPROTO_UDP
-                            )
-                            self.remove_flow_by_match(datapath, match)
-                            self.logger.info(f"Flujo multicast eliminado en switch {dpid} para {multicast_group_addr}.")
-                        else:
-                            self.logger.warning(f"Switch {dpid} no encontrado al intentar eliminar flujo para {multicast_group_addr}.")
-
-                    self.multicast_flow_installed_at.pop(multicast_group_addr, None)
+                    batch = FlowModBatch(f"multicast {multicast_group_addr} (baja)")
+                    self._clear_flows_for_group(multicast_group_addr, batch=batch)
+                    self._commit_batch(batch)
                     self._last_installed_tree.pop(multicast_group_addr, None)
                 else:
                     self.logger.info(f"Aún quedan miembros activos para {multicast_group_addr}. Reinstalando flujos.")
@@ -619,6 +1927,1002 @@ class Controller(app_manager.RyuApp):
             self.logger.error(f"Error en _remove_multicast_flows para {multicast_group_addr}: {e}", exc_info=True)
 
 
+    def _port_neighbor(self, dpid, port):
+        """
+        Switch vecino alcanzado por un puerto (None si el puerto conecta un host o es desconocido).
+        """
+        for neighbor, local_port in self.switch_links.get(dpid, {}).items():
+            if local_port == port:
+                return neighbor
+        return None
+
+    def _links_of_hops(self, hops):
+
+        links = set()
+        for dpid, port in hops:
+            neighbor = self._port_neighbor(dpid, port)
+            if neighbor is not None:
+                links.add(frozenset((dpid, neighbor)))
+        return links
+
+    def _index_links(self, entry, links):
+        """
+        Actualiza el índice enlace -> flujos para una ruta unicast o un árbol multicast.
+        """
+        for link in self._indexed_links.pop(entry, set()):
+            self.link_index[link].discard(entry)
+            if not self.link_index[link]:
+                del self.link_index[link]
+        if links:
+            self._indexed_links[entry] = set(links)
+            for link in links:
+                self.link_index[link].add(entry)
+
+    def _excluded_links_payload(self):
+
+        return [sorted(link) for link in sorted(self.down_links, key=sorted)]
+
+    def _backup_path(self, start_dpid, dst_dpid, failed_link, avoid):
+        """
+        BFS desde start_dpid hasta dst_dpid sin usar failed_link, enlaces caídos ni los switches de avoid.
+        """
+        parents = {start_dpid: None}
+        queue = collections.deque([start_dpid])
+        while queue:
+            current = queue.popleft()
+            if current == dst_dpid:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = parents[current]
+                return list(reversed(path))
+            for neighbor in sorted(self.switch_links.get(current, {})):
+                link = frozenset((current, neighbor))
+                if neighbor in parents or neighbor in avoid or link == failed_link or link in self.down_links:
+                    continue
+                parents[neighbor] = current
+                queue.append(neighbor)
+        return None
+
+    def _plan_failover(self, hops):
+        """
+        Para cada salto switch-switch de la ruta busca un siguiente salto de respaldo disjunto en
+        enlaces que no vuelva a switches anteriores de la ruta. Devuelve ({dpid: (puerto_primario,
+        puerto_respaldo)}, [(dpid, out_port)] flujos de respaldo fuera de la ruta primaria).
+        """
+        failover = {}
+        backup_hops = []
+        path_dpids = [dpid for dpid, _ in hops]
+        dst_dpid = path_dpids[-1]
+        for index, (dpid, out_port) in enumerate(hops):
+            neighbor = self._port_neighbor(dpid, out_port)
+            if neighbor is None:
+                continue
+            upstream = set(path_dpids[:index])
+            backup = self._backup_path(dpid, dst_dpid, frozenset((dpid, neighbor)), upstream)
+            if not backup or len(backup) < 2:
+                continue
+            failover[dpid] = (out_port, self.switch_links[dpid][backup[1]])
+            # Desde el primer switch de la ruta primaria aguas abajo siguen valiendo sus flujos
+            downstream = set(path_dpids[index + 1:])
+            for hop_index in range(1, len(backup) - 1):
+                hop_dpid = backup[hop_index]
+                if hop_dpid in downstream:
+                    break
+                backup_hops.append((hop_dpid, self.switch_links[hop_dpid][backup[hop_index + 1]]))
+        return failover, backup_hops
+
+    def _new_group_id(self):
+
+        group_id = self._next_group_id
+        self._next_group_id += 1
+        return group_id
+
+    def _send_group_mod(self, datapath, command, group_type, group_id, buckets=(), batch=None):
+        """
+        Envía (o encola en el lote) un GroupMod. buckets: [(watch_port, puerto_salida)], un
+        OFPActionOutput por bucket.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        of_buckets = [
+            parser.OFPBucket(watch_port=watch_port, watch_group=ofproto.OFPG_ANY,
+                             actions=[parser.OFPActionOutput(port)])
+            for watch_port, port in buckets
+        ]
+        mod = parser.OFPGroupMod(datapath, command, group_type, group_id, of_buckets)
+        self._send_or_queue(datapath, mod, batch)
+        command_name = {ofproto.OFPGC_ADD: 'add', ofproto.OFPGC_MODIFY: 'modify',
+                        ofproto.OFPGC_DELETE: 'delete'}.get(command, str(command))
+        self.metrics.inc('controller_group_mods_total', (('dpid', str(datapath.id)), ('comando', command_name)))
+
+    @staticmethod
+    def _failover_buckets(primary_port, backup_port):
+
+        return [(primary_port, primary_port), (backup_port, backup_port)]
+
+    @staticmethod
+    def _replication_buckets(ofproto, ports):
+        # En grupos ALL el puerto vigilado no se usa
+        return [(ofproto.OFPP_ANY, port) for port in ports]
+
+    def _install_failover_group(self, datapath, group_id, primary_port, backup_port, batch=None):
+
+        ofproto = datapath.ofproto
+        self._send_group_mod(datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_FF, group_id,
+                             self._failover_buckets(primary_port, backup_port), batch=batch)
+
+    def _delete_failover_groups(self, route, batch=None):
+
+        for dpid, (group_id, _, _) in route.get('groups', {}).items():
+            datapath = self.datapaths.get(dpid)
+            if not datapath:
+                continue
+            ofproto = datapath.ofproto
+            self._send_group_mod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_FF, group_id, batch=batch)
+
+    def _bind_port_group(self, dpid, multicast_group_addr, out_ports):
+        """
+        Asocia el grupo IP al grupo de tabla ALL de sus puertos de salida en el switch, sin enviar
+        mensajes. Devuelve (entrada, puertos_anteriores, creada). Los puertos anteriores siguen
+        referenciados hasta que se llame a _release_port_group.
+        """
+        ports = tuple(sorted(set(out_ports)))
+        table = self.multicast_port_groups[dpid]
+        old_ports = self.multicast_group_bindings.get((dpid, multicast_group_addr))
+        if old_ports == ports and ports in table:
+            return table[ports], None, False
+
+        created = False
+        entry = table.get(ports)
+        if entry is None:
+            old_entry = table.get(old_ports) if old_ports is not None else None
+            if old_entry is not None and old_entry['groups'] == {multicast_group_addr}:
+                # Grupo de tabla exclusivo de este grupo IP: se reutiliza cambiando sus buckets
+                entry = table.pop(old_ports)
+                old_ports = None
+            else:
+                entry = {'group_id': self._new_group_id(), 'groups': set()}
+                created = True
+            table[ports] = entry
+        entry['groups'].add(multicast_group_addr)
+        self.multicast_group_bindings[(dpid, multicast_group_addr)] = ports
+        return entry, (old_ports if old_ports != ports else None), created
+
+    def _release_port_group(self, dpid, ports, multicast_group_addr, batch=None, send=True):
+        """
+        Quita la referencia del grupo IP al grupo de tabla; el último en salir lo elimina del switch.
+        """
+        table = self.multicast_port_groups.get(dpid, {})
+        entry = table.get(ports)
+        if entry is None:
+            return
+        entry['groups'].discard(multicast_group_addr)
+        if entry['groups']:
+            return
+        del table[ports]
+        datapath = self.datapaths.get(dpid)
+        if send and datapath:
+            ofproto = datapath.ofproto
+            self._send_group_mod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, entry['group_id'], batch=batch)
+
+    def _install_multicast_replication(self, datapath, multicast_group_addr, out_ports, batch=None):
+        """
+        Apunta la regla del grupo IP a un grupo OFPGT_ALL con un bucket por puerto de salida.
+        Un cambio de puertos en un grupo de tabla exclusivo es un único GroupMod MODIFY; si otro
+        grupo IP ya sale por los mismos puertos se comparte su grupo de tabla. Devuelve False si
+        el switch ya estaba en el estado deseado y no se envió nada.
+        """
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        previous = self.multicast_group_bindings.get((dpid, multicast_group_addr))
+        entry, old_ports, created = self._bind_port_group(dpid, multicast_group_addr, out_ports)
+        ports = self.multicast_group_bindings[(dpid, multicast_group_addr)]
+        flow_present = self._multicast_flow_present(dpid, multicast_group_addr)
+
+        if created:
+            self._send_group_mod(datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_ALL, entry['group_id'],
+                                 self._replication_buckets(ofproto, ports), batch=batch)
+        elif previous is not None and previous != ports and old_ports is None:
+            # Se reutilizó el grupo de tabla exclusivo: solo cambian los buckets
+            self._send_group_mod(datapath, ofproto.OFPGC_MODIFY, ofproto.OFPGT_ALL, entry['group_id'],
+                                 self._replication_buckets(ofproto, ports), batch=batch)
+            if flow_present:
+                return True
+        elif previous == ports and flow_present:
+            return False
+
+        match = self._multicast_group_match(parser, multicast_group_addr)
+        self.add_flow(datapath, priority=MULTICAST_FLOW_PRIORITY, match=match,
+                      actions=[parser.OFPActionGroup(entry['group_id'])],
+                      idle_timeout=300, hard_timeout=0, batch=batch)
+        if old_ports is not None:
+            # La regla ya apunta al grupo nuevo; el anterior puede desaparecer
+            self._release_port_group(dpid, old_ports, multicast_group_addr, batch=batch)
+        return True
+
+    def _remove_multicast_replication(self, dpid, multicast_group_addr, batch=None):
+        """
+        Elimina la regla del grupo IP en el switch y libera su grupo de tabla.
+        Devuelve False si el switch no está conectado.
+        """
+        ports = self.multicast_group_bindings.pop((dpid, multicast_group_addr), None)
+        datapath = self.datapaths.get(dpid)
+        if datapath:
+            match = self._multicast_group_match(datapath.ofproto_parser, multicast_group_addr)
+            self.remove_flow_by_match(datapath, match, priority=MULTICAST_FLOW_PRIORITY, batch=batch)
+        if ports is not None:
+            self._release_port_group(dpid, ports, multicast_group_addr, batch=batch)
+        return datapath is not None
+
+    @staticmethod
+    def _unicast_hop_actions(parser, route, dpid, out_port):
+
+        group = route.get('groups', {}).get(dpid)
+        if group:
+            return [parser.OFPActionGroup(group[0])]
+        return [parser.OFPActionOutput(out_port)]
+
+    def _install_unicast_route(self, src_mac, dst_mac, path, batch, log_prefix=""):
+        """
+        Añade al lote los flujos de una ruta unicast (saltos devueltos por el backend), con grupos
+        fast-failover si están habilitados, y la registra en el estado deseado y el índice de enlaces.
+        """
+        hops = []
+        for salto in path:
+            cur_dpid = salto.get("dpid")
+            out_port = salto.get("out_port")
+
+            if cur_dpid not in self.datapaths:
+                self.logger.error(f"{log_prefix}Datapath faltante para el switch {cur_dpid}, omitiendo instalación de flujo")
+                continue
+
+            if not isinstance(out_port, int) or out_port <= 0:
+                self.logger.error(f"{log_prefix}Puerto de salida inválido ({out_port}) en la ruta para {cur_dpid}")
+                continue
+            hops.append((cur_dpid, out_port))
+
+        if not hops:
+            return
+
+        route = {'hops': hops, 'backup_hops': [], 'groups': {}, 'expires_at': time.time() + 60}
+        if FAST_FAILOVER_ENABLED:
+            failover, backup_hops = self._plan_failover(hops)
+            route['backup_hops'] = [(d, p) for d, p in backup_hops if d in self.datapaths]
+            for dpid, (primary_port, backup_port) in failover.items():
+                route['groups'][dpid] = (self._new_group_id(), primary_port, backup_port)
+                self._install_failover_group(self.datapaths[dpid], *route['groups'][dpid], batch=batch)
+
+        for cur_dpid, out_port in hops:
+            cur_dp = self.datapaths[cur_dpid]
+            parser = cur_dp.ofproto_parser
+            match = parser.OFPMatch(
+                eth_type=ether_types.ETH_TYPE_IP,
+                eth_src=src_mac,
+                eth_dst=dst_mac
+            )
+            actions = self._unicast_hop_actions(parser, route, cur_dpid, out_port)
+            self.add_flow(cur_dp, priority=UNICAST_FLOW_PRIORITY, match=match, actions=actions,
+                          idle_timeout=60, hard_timeout=60, batch=batch)
+            self.logger.info(f"{log_prefix}Flujo instalado en switch {cur_dpid} para {src_mac}->{dst_mac} a través del puerto {out_port}")
+
+        for cur_dpid, out_port in route['backup_hops']:
+            cur_dp = self.datapaths[cur_dpid]
+            parser = cur_dp.ofproto_parser
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, eth_src=src_mac, eth_dst=dst_mac)
+            self.add_flow(cur_dp, priority=UNICAST_BACKUP_PRIORITY, match=match,
+                          actions=[parser.OFPActionOutput(out_port)],
+                          idle_timeout=60, hard_timeout=60, batch=batch)
+        if route['groups']:
+            self.logger.info(f"{log_prefix}Fast-failover para {src_mac}->{dst_mac}: "
+                             f"{ {d: g[1:] for d, g in route['groups'].items()} }")
+
+        old_route = self.unicast_routes.get((src_mac, dst_mac))
+        self.unicast_routes[(src_mac, dst_mac)] = route
+        if old_route:
+            # Los flujos nuevos ya apuntan a los grupos nuevos; los anteriores sobran
+            self._delete_failover_groups(old_route, batch=batch)
+        self._index_links(('unicast', (src_mac, dst_mac)), self._links_of_hops(hops))
+
+    def _drop_unicast_route(self, key, batch=None):
+
+        route = self.unicast_routes.pop(key, None)
+        if route:
+            self._delete_failover_groups(route, batch=batch)
+        self._index_links(('unicast', key), set())
+        return route
+
+    def _install_unicast_paths_batched(self, datapath, msg, in_port, src_mac, dst_mac,
+                                       path, url, dst_switch_port_to_host, batch):
+        """
+        Añade al lote los flujos de la ruta de ida, solicita e instala la ruta inversa y
+        retiene el primer paquete hasta que todas las reglas estén confirmadas.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+
+        # Instalar flujos ida
+        self.logger.debug(f"Ruta encontrada (ida): {path}")
+        self._install_unicast_route(src_mac, dst_mac, path, batch)
+
+        # Solicitar ruta inversa (dst→src)
+        try:
+            reverse_payload = {"src_mac": dst_mac, "dst_mac": src_mac,
+                               "excluded_links": self._excluded_links_payload()}
+            reverse_response = self._backend_request(url, reverse_payload, timeout=3)
+            if reverse_response.status_code == 200:
+                reverse_data = reverse_response.json()
+                reverse_path = reverse_data.get("path", [])
+            else:
+                self.logger.error(f"Fallo al obtener ruta inversa: {reverse_response.status_code} {reverse_response.text}")
+                return
+        except requests.RequestException as e:
+            self.logger.error(f"Error en la solicitud HTTP al servidor de rutas (inverso): {e}")
+            return
+
+        self.logger.info("Detalles de la ruta calculada (inversa):")
+        for idx, salto in enumerate(reverse_path):
+            self.logger.info(f"  Salto {idx}: Switch={salto.get('dpid')}, out_port={salto.get('out_port')}, in_port={salto.get('in_port')}")
+
+        # Instalar flujos inversos
+        self._install_unicast_route(dst_mac, src_mac, reverse_path, batch, log_prefix="[RETORNO] ")
+
+        # Reenviar el primer paquete (ida) para que el flujo empiece a tomar efecto
+        initial_out_port = path[0].get("out_port") if len(path) > 1 else dst_switch_port_to_host
+        if isinstance(initial_out_port, int) and initial_out_port > 0:
+            data = None
+            if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+                data = msg.data
+            self._send_packet_out(datapath, msg.buffer_id, in_port,
+                                  [parser.OFPActionOutput(initial_out_port)], data, batch=batch)
+            self.logger.debug(f"Paquete inicial enviado desde switch {dpid} puerto {initial_out_port}")
+        else:
+            self.logger.error(f"Fallo al enviar paquete inicial: puerto inválido ({initial_out_port})")
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        """
+        Mantiene el índice de flujos instalados sincronizado con las expiraciones y borrados del switch.
+        """
+        msg = ev.msg
+        dpid = msg.datapath.id
+        ofproto = msg.datapath.ofproto
+        key = self._flow_key(msg.priority, msg.match)
+
+        entry = self.installed_flows.get(dpid, {}).get(key)
+        if not entry or entry['cookie'] != msg.cookie:
+            # Notificación de una versión anterior del flujo ya reemplazada
+            return
+        del self.installed_flows[dpid][key]
+
+        reasons = {
+            ofproto.OFPRR_IDLE_TIMEOUT: 'idle_timeout',
+            ofproto.OFPRR_HARD_TIMEOUT: 'hard_timeout',
+            ofproto.OFPRR_DELETE: 'delete',
+            ofproto.OFPRR_GROUP_DELETE: 'group_delete'
+        }
+        reason = reasons.get(msg.reason, str(msg.reason))
+        self.logger.debug(f"[FLOW-REMOVED] switch={dpid} prioridad={msg.priority} match={msg.match} motivo={reason}")
+
+        group_ip = msg.match.get('ipv4_dst')
+        if msg.priority == MULTICAST_FLOW_PRIORITY and group_ip:
+            installed_at = self.multicast_flow_installed_at.get(group_ip)
+            if installed_at is not None:
+                installed_at.discard(dpid)
+                if not installed_at:
+                    self.multicast_flow_installed_at.pop(group_ip, None)
+            # El árbol en caché ya no refleja el plano de datos: forzar recálculo en el próximo evento
+            self._last_installed_tree.pop(group_ip, None)
+            ports = self.multicast_group_bindings.pop((dpid, group_ip), None)
+            if ports is not None:
+                self._release_port_group(dpid, ports, group_ip)
+            self.logger.info(f"[FLOW-REMOVED] Flujo multicast de {group_ip} eliminado en {dpid} ({reason}).")
+        elif msg.priority == NEGATIVE_CACHE_PRIORITY and group_ip:
+            self.multicast_negative_cache.get(group_ip, {}).pop(dpid, None)
+        elif msg.priority == UNICAST_FLOW_PRIORITY and 'eth_src' in msg.match and 'eth_dst' in msg.match:
+            # Los saltos de una ruta expiran a la vez; la ruta deja de formar parte del estado deseado
+            self._drop_unicast_route((msg.match['eth_src'], msg.match['eth_dst']))
+
+    def _request_flow_stats(self, datapath):
+
+        parser = datapath.ofproto_parser
+        self._flow_stats_parts[datapath.id] = []
+        datapath.send_msg(parser.OFPFlowStatsRequest(datapath))
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+
+        msg = ev.msg
+        dpid = msg.datapath.id
+        parts = self._flow_stats_parts.setdefault(dpid, [])
+        parts.extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        stats = self._flow_stats_parts.pop(dpid)
+        self._reconcile_started_at.pop(dpid, None)
+        self._reconcile_flow_table(msg.datapath, stats)
+
+    def _table_miss_spec(self, datapath):
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+        return dict(priority=0, match=parser.OFPMatch(), actions=actions,
+                    meter_id=self._controller_meter_id(datapath.id))
+
+    def _igmp_to_controller_spec(self, datapath):
+        """
+        IGMP al controlador sin pasar por el medidor de la regla table-miss.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ip_proto=inet.IPPROTO_IGMP)
+        return dict(priority=IGMP_TO_CONTROLLER_PRIORITY, match=match, actions=actions)
+
+    def _intended_flows(self, datapath):
+        """
+        Estado deseado del switch según el controlador: {clave: especificación para add_flow}.
+        Incluye table-miss, IGMP al controlador, difusión, árboles multicast, rutas unicast vigentes y la caché negativa.
+        """
+        dpid = datapath.id
+        parser = datapath.ofproto_parser
+        now = time.time()
+        specs = [self._table_miss_spec(datapath), self._igmp_to_controller_spec(datapath)]
+        specs.extend(self._broadcast_flow_specs(datapath))
+
+        for group, tree in self._last_installed_tree.items():
+            out_ports = tree.get(dpid)
+            if out_ports:
+                entry, _, _ = self._bind_port_group(dpid, group, out_ports)
+                specs.append(dict(priority=MULTICAST_FLOW_PRIORITY,
+                                  match=self._multicast_group_match(parser, group),
+                                  actions=[parser.OFPActionGroup(entry['group_id'])],
+                                  idle_timeout=300))
+
+        for (src_mac, dst_mac), route in self.unicast_routes.items():
+            remaining = int(route['expires_at'] - now)
+            if remaining <= 0:
+                continue
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, eth_src=src_mac, eth_dst=dst_mac)
+            for hop_dpid, out_port in route['hops']:
+                if hop_dpid != dpid:
+                    continue
+                specs.append(dict(priority=UNICAST_FLOW_PRIORITY, match=match,
+                                  actions=self._unicast_hop_actions(parser, route, hop_dpid, out_port),
+                                  idle_timeout=60, hard_timeout=remaining))
+            for hop_dpid, out_port in route.get('backup_hops', []):
+                if hop_dpid == dpid:
+                    specs.append(dict(priority=UNICAST_BACKUP_PRIORITY, match=match,
+                                      actions=[parser.OFPActionOutput(out_port)],
+                                      idle_timeout=60, hard_timeout=remaining))
+
+        for group, cached in self.multicast_negative_cache.items():
+            remaining = int(cached.get(dpid, 0) - now)
+            if remaining > 0:
+                specs.append(dict(priority=NEGATIVE_CACHE_PRIORITY,
+                                  match=self._multicast_group_match(parser, group),
+                                  actions=[], hard_timeout=remaining))
+
+        for rule in self.rules.values():
+            if rule['dpid'] == dpid and rule['estado'] in RULE_INSTALLABLE_STATES:
+                specs.append(dict(priority=rule['priority'], match=parser.OFPMatch(**rule['match']),
+                                  actions=self._rule_of_actions(datapath, rule['actions'])))
+
+        return {self._flow_key(spec['priority'], spec['match']): spec for spec in specs}
+
+    def _request_group_desc(self, datapath):
+
+        parser = datapath.ofproto_parser
+        self._group_desc_parts[datapath.id] = []
+        self._flow_stats_parts.pop(datapath.id, None)
+        self._reconcile_started_at[datapath.id] = time.monotonic()
+        datapath.send_msg(parser.OFPGroupDescStatsRequest(datapath, 0))
+
+    def _retry_stalled_reconciliations(self):
+        """
+        Repite la reconciliación de los switches cuya respuesta GroupDesc o FlowStats no llegó
+        (mensaje perdido o error del switch) dentro de RECONCILE_TIMEOUT.
+        """
+        while True:
+            time.sleep(RECONCILE_TIMEOUT / 2)
+            now = time.monotonic()
+            for dpid, started_at in list(self._reconcile_started_at.items()):
+                datapath = self.datapaths.get(dpid)
+                if datapath is None:
+                    self._reconcile_started_at.pop(dpid, None)
+                elif now - started_at > RECONCILE_TIMEOUT:
+                    self.logger.warning(f"[RECONCILIACION] Switch {dpid} sin respuesta GroupDesc/FlowStats "
+                                        f"tras {RECONCILE_TIMEOUT}s. Reintentando.")
+                    self._request_group_desc(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply, MAIN_DISPATCHER)
+    def _group_desc_reply_handler(self, ev):
+
+        msg = ev.msg
+        dpid = msg.datapath.id
+        parts = self._group_desc_parts.setdefault(dpid, [])
+        parts.extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        stats = self._group_desc_parts.pop(dpid)
+        self._reconcile_group_table(msg.datapath, stats)
+        # Los flujos referencian grupos: se reconcilian cuando la tabla de grupos ya es la deseada
+        self._request_flow_stats(msg.datapath)
+
+    def _intended_groups(self, datapath):
+        """
+        Grupos deseados en el switch: {group_id: (tipo, [(watch_port, puerto_salida)])}.
+        Ajusta antes las asociaciones multicast a los árboles vigentes (sin enviar mensajes).
+        """
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        for (bound_dpid, group), ports in list(self.multicast_group_bindings.items()):
+            if bound_dpid == dpid and not self._last_installed_tree.get(group, {}).get(dpid):
+                del self.multicast_group_bindings[(bound_dpid, group)]
+                self._release_port_group(dpid, ports, group, send=False)
+        for group, tree in self._last_installed_tree.items():
+            if tree.get(dpid):
+                _, old_ports, _ = self._bind_port_group(dpid, group, tree[dpid])
+                if old_ports is not None:
+                    self._release_port_group(dpid, old_ports, group, send=False)
+
+        groups = {
+            entry['group_id']: (ofproto.OFPGT_ALL, self._replication_buckets(ofproto, ports))
+            for ports, entry in self.multicast_port_groups.get(dpid, {}).items()
+        }
+        for route in self.unicast_routes.values():
+            group = route.get('groups', {}).get(dpid)
+            if group:
+                group_id, primary_port, backup_port = group
+                groups[group_id] = (ofproto.OFPGT_FF, self._failover_buckets(primary_port, backup_port))
+        return groups
+
+    @staticmethod
+    def _normalize_group(datapath, group_type, buckets):
+        """
+        Forma comparable de un grupo. El puerto vigilado solo cuenta en fast-failover.
+        """
+        ofproto = datapath.ofproto
+        return (group_type, tuple(
+            (watch_port if group_type == ofproto.OFPGT_FF else None, tuple(ports))
+            for watch_port, ports in buckets
+        ))
+
+    def _reconcile_group_table(self, datapath, stats):
+        """
+        Compara la tabla de grupos del switch con la deseada: añade los que faltan, corrige
+        los que difieren y elimina los huérfanos.
+        """
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        intended = self._intended_groups(datapath)
+        actual = {stat.group_id: stat for stat in stats}
+        # Evitar reutilizar identificadores de grupos creados por una instancia anterior
+        if actual:
+            self._next_group_id = max(self._next_group_id, max(actual) + 1)
+
+        batch = FlowModBatch(f"grupos {dpid}")
+        missing = mismatched = orphans = 0
+        unclaimed = self._unclaimed_failover_groups[dpid] = {}
+        for group_id, stat in actual.items():
+            spec = intended.get(group_id)
+            if spec is None and stat.type == ofproto.OFPGT_FF and len(stat.buckets) == 2:
+                # Lo decide la reconciliación de flujos, que llega justo después
+                unclaimed[group_id] = tuple(bucket.watch_port for bucket in stat.buckets)
+                continue
+            if spec is None:
+                self._send_group_mod(datapath, ofproto.OFPGC_DELETE, stat.type, group_id, batch=batch)
+                orphans += 1
+                continue
+            present = self._normalize_group(datapath, stat.type, [
+                (bucket.watch_port,
+                 [a.port for a in bucket.actions if isinstance(a, parser.OFPActionOutput)])
+                for bucket in stat.buckets
+            ])
+            expected = self._normalize_group(datapath, spec[0], [(w, [p]) for w, p in spec[1]])
+            if present != expected:
+                self._send_group_mod(datapath, ofproto.OFPGC_MODIFY, spec[0], group_id, spec[1], batch=batch)
+                mismatched += 1
+
+        for group_id, (group_type, buckets) in intended.items():
+            if group_id not in actual:
+                self._send_group_mod(datapath, ofproto.OFPGC_ADD, group_type, group_id, buckets, batch=batch)
+                missing += 1
+
+        self._commit_batch(batch)
+        self.logger.info(f"[RECONCILIACIÓN] Switch {dpid}: {len(actual)} grupos presentes, {len(intended)} deseados; "
+                         f"{missing} faltantes, {mismatched} corregidos, {orphans} huérfanos eliminados, "
+                         f"{len(unclaimed)} fast-failover pendientes de adopción.")
+
+    def _reconcile_flow_table(self, datapath, stats):
+        """
+        Compara la tabla real del switch con el estado deseado: adopta los flujos correctos,
+        reinstala solo los que faltan o difieren y elimina los huérfanos.
+        """
+        dpid = datapath.id
+        now = time.time()
+        intended = self._intended_flows(datapath)
+        actual = {}
+        for stat in stats:
+            actual[self._flow_key(stat.priority, stat.match)] = stat
+            # Evitar reutilizar cookies de flujos instalados por una instancia anterior
+            if stat.cookie >= self._next_cookie:
+                self._next_cookie = stat.cookie + 1
+
+        self.installed_flows[dpid] = {}
+        batch = FlowModBatch(f"reconciliación {dpid}")
+        missing = mismatched = orphans = 0
+
+        adopted = 0
+        for key, stat in actual.items():
+            spec = intended.get(key)
+            if spec is None:
+                spec = self._adopt_unicast_flow(datapath, stat, now)
+                if spec is not None:
+                    intended[key] = spec
+                    adopted += 1
+            if spec is None:
+                self.remove_flow_by_match(datapath, stat.match, priority=stat.priority, batch=batch)
+                orphans += 1
+                continue
+            expected = self._normalize_instructions(
+                datapath, self._build_instructions(datapath, spec['actions'], spec.get('meter_id')))
+            if self._normalize_instructions(datapath, stat.instructions) != expected:
+                self.add_flow(datapath, batch=batch, **spec)
+                mismatched += 1
+                continue
+            self.installed_flows[dpid][key] = {
+                'cookie': stat.cookie,
+                'installed_at': now - stat.duration_sec,
+                'idle_timeout': stat.idle_timeout,
+                'hard_timeout': stat.hard_timeout
+            }
+
+        for key, spec in intended.items():
+            if key not in actual:
+                self.add_flow(datapath, batch=batch, **spec)
+                missing += 1
+
+        for group, tree in self._last_installed_tree.items():
+            if dpid in tree:
+                self.multicast_flow_installed_at[group].add(dpid)
+
+        # Grupos fast-failover que ningún flujo adoptado referencia: huérfanos
+        ofproto = datapath.ofproto
+        for group_id in self._unclaimed_failover_groups.pop(dpid, {}):
+            self._send_group_mod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_FF, group_id, batch=batch)
+            orphans += 1
+
+        self._commit_batch(batch)
+        # Las reglas del gestor SDN de este switch quedan como se instalaron al reconciliar
+        self._installed_rules = {rid: v for rid, v in self._installed_rules.items() if v[0] != dpid}
+        self._installed_rules.update(self._desired_rules(dpid))
+        self.logger.info(f"[RECONCILIACIÓN] Switch {dpid}: {len(actual)} flujos presentes, {len(intended)} deseados; "
+                         f"{missing} faltantes, {mismatched} corregidos, {adopted} adoptados, {orphans} huérfanos eliminados.")
+
+    def _adopt_unicast_flow(self, datapath, stat, now):
+        """
+        Incorpora al estado deseado un salto unicast que sigue en el switch pero que el controlador
+        no conoce (instalado después de la última instantánea). Se conserva hasta su hard_timeout.
+        Devuelve la especificación deseada del flujo, o None si no se adopta.
+        """
+        parser = datapath.ofproto_parser
+        if stat.priority not in (UNICAST_FLOW_PRIORITY, UNICAST_BACKUP_PRIORITY):
+            return None
+        if 'eth_src' not in stat.match or 'eth_dst' not in stat.match:
+            return None
+        remaining = stat.hard_timeout - stat.duration_sec
+        if stat.hard_timeout <= 0 or remaining <= 0:
+            return None
+        actions = [action
+                   for inst in stat.instructions if isinstance(inst, parser.OFPInstructionActions)
+                   for action in inst.actions]
+        if len(actions) != 1:
+            return None
+        action = actions[0]
+        unclaimed = self._unclaimed_failover_groups.get(datapath.id, {})
+        if isinstance(action, parser.OFPActionOutput):
+            out_port, group = action.port, None
+        elif isinstance(action, parser.OFPActionGroup) and stat.priority == UNICAST_FLOW_PRIORITY \
+                and action.group_id in unclaimed:
+            # El salto sale por el grupo fast-failover que sigue en el switch: se adoptan ambos
+            primary_port, backup_port = unclaimed.pop(action.group_id)
+            out_port, group = primary_port, (action.group_id, primary_port, backup_port)
+        else:
+            return None
+
+        key = (stat.match['eth_src'], stat.match['eth_dst'])
+        route = self.unicast_routes.setdefault(
+            key, {'hops': [], 'backup_hops': [], 'groups': {}, 'expires_at': now + remaining})
+        hop = (datapath.id, out_port)
+        hops = route['hops'] if stat.priority == UNICAST_FLOW_PRIORITY else route['backup_hops']
+        if hop not in hops:
+            hops.append(hop)
+        if group:
+            route['groups'][datapath.id] = group
+        self._index_links(('unicast', key), self._links_of_hops(route['hops']))
+        return dict(priority=stat.priority, match=stat.match, actions=[action],
+                    idle_timeout=60, hard_timeout=remaining)
+
+    # ------------------------------------------------------------------
+    # Compilador de reglas del gestor SDN (tabla reglas)
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _compile_rule(row):
+        """
+        Traduce una fila de reglas a {'dpid', 'priority', 'match', 'actions'} con los campos en la
+        forma en que OFPMatch los devuelve. Lanza ValueError si la regla no se puede expresar en
+        OpenFlow 1.3 (campos sin sus prerrequisitos, acción desconocida).
+        """
+        match = {}
+        if row['eth_type']:
+            match['eth_type'] = int(row['eth_type'])
+        if row['in_port']:
+            match['in_port'] = int(row['in_port'])
+        if row['ip_proto']:
+            if match.get('eth_type') not in (ether_types.ETH_TYPE_IP, ether_types.ETH_TYPE_IPV6):
+                raise ValueError("ip_proto requiere eth_type IPv4 (0x0800) o IPv6 (0x86dd)")
+            match['ip_proto'] = int(row['ip_proto'])
+        for field in RULE_IP_FIELDS:
+            if row[field]:
+                if match.get('eth_type') != ether_types.ETH_TYPE_IP:
+                    raise ValueError(f"{field} requiere eth_type IPv4 (0x0800)")
+                network = ipaddress.IPv4Network(str(row[field]), strict=False)
+                if network.prefixlen == 32:
+                    match[field] = str(network.network_address)
+                else:
+                    match[field] = (str(network.network_address), str(network.netmask))
+        l4_fields = RULE_L4_FIELDS.get(match.get('ip_proto'))
+        for column, index in (('tcp_src', 0), ('tcp_dst', 1)):
+            if row[column]:
+                if not l4_fields:
+                    raise ValueError("los puertos de transporte requieren ip_proto 6 (TCP) o 17 (UDP)")
+                match[l4_fields[index]] = int(row[column])
+
+        raw_actions = row['actions'] or []
+        if isinstance(raw_actions, str):
+            raw_actions = json.loads(raw_actions)
+        actions = []
+        for action in raw_actions:
+            kind = str(action.get('type', '')).upper()
+            if kind == 'OUTPUT':
+                actions.append(('output', int(action['port'])))
+            elif kind == 'NORMAL':
+                actions.append(('output', 'normal'))
+            elif kind != 'DROP':
+                raise ValueError(f"acción desconocida: {kind or action}")
+
+        return {'dpid': int(row['dpid']), 'priority': int(row['priority']),
+                'match': match, 'actions': tuple(actions)}
+
+    @staticmethod
+    def _rule_of_actions(datapath, actions):
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        return [parser.OFPActionOutput(ofproto.OFPP_NORMAL if port == 'normal' else port) for _, port in actions]
+
+    @staticmethod
+    def _rule_network(value):
+
+        if isinstance(value, tuple):
+            return ipaddress.IPv4Network(f"{value[0]}/{value[1]}")
+        return ipaddress.IPv4Network(value)
+
+    def _rule_ip_covers(self, general, specific):
+        """
+        Indica si los campos IPv4 del match general abarcan los del específico.
+        """
+        for field in RULE_IP_FIELDS:
+            if field not in general:
+                continue
+            if field not in specific:
+                return False
+            if not self._rule_network(specific[field]).subnet_of(self._rule_network(general[field])):
+                return False
+        return True
+
+    def _analyze_rules(self, dpid):
+        """
+        Clasifica las reglas válidas de un switch:
+          - duplicada: mismo match y prioridad que una regla de rule_id menor (no se instala).
+          - conflicto: mismo match y prioridad que un flujo propio del controlador (no se instala).
+          - sombreada: otra regla de mayor prioridad abarca todo su match (nunca coincidirá).
+          - ambigua: otra regla de igual prioridad abarca su match (orden indefinido en OpenFlow).
+        Las reglas se indexan por sus campos exactos (sin IPv4); para cada regla solo se consultan
+        los subconjuntos de sus campos (como mucho 2^5 entradas), no todas las parejas de reglas.
+        """
+        rules = {rid: rule for rid, rule in self.rules.items()
+                 if rule['dpid'] == dpid and rule['estado'] != 'invalida'}
+        own_keys = {self._flow_key(v[1], dict(v[2])) for v in self._installed_rules.values() if v[0] == dpid}
+        controller_keys = set(self.installed_flows.get(dpid, {})) - own_keys
+
+        by_key = {}
+        by_exact = collections.defaultdict(list)
+        for rid in sorted(rules):
+            rule = rules[rid]
+            rule['estado'], rule['motivo'] = 'activa', None
+            key = self._flow_key(rule['priority'], rule['match'])
+            if key in by_key:
+                rule['estado'], rule['motivo'] = 'duplicada', f"mismo match y prioridad que la regla {by_key[key]}"
+                continue
+            if key in controller_keys:
+                rule['estado'], rule['motivo'] = 'conflicto', "mismo match y prioridad que un flujo del controlador"
+                continue
+            by_key[key] = rid
+            by_exact[frozenset((f, v) for f, v in rule['match'].items() if f not in RULE_IP_FIELDS)].append(rid)
+
+        for rid, rule in rules.items():
+            if rule['estado'] != 'activa':
+                continue
+            exact = [(f, v) for f, v in rule['match'].items() if f not in RULE_IP_FIELDS]
+            covering = None
+            for size in range(len(exact) + 1):
+                for subset in itertools.combinations(exact, size):
+                    for other_id in by_exact.get(frozenset(subset), ()):
+                        other = rules[other_id]
+                        if other_id == rid or other['priority'] < rule['priority']:
+                            continue
+                        if not self._rule_ip_covers(other['match'], rule['match']):
+                            continue
+                        if covering is None or other['priority'] > rules[covering]['priority']:
+                            covering = other_id
+            if covering is None:
+                continue
+            if rules[covering]['priority'] > rule['priority']:
+                rule['estado'], rule['motivo'] = 'sombreada', f"la regla {covering} (prioridad mayor) abarca su match"
+            else:
+                rule['estado'], rule['motivo'] = 'ambigua', f"la regla {covering} tiene la misma prioridad y abarca su match"
+
+        for rid, rule in sorted(rules.items()):
+            if rule['estado'] != 'activa':
+                self.logger.warning(f"[REGLAS] Regla {rid} en switch {dpid}: {rule['estado']} ({rule['motivo']}).")
+
+    def _desired_rules(self, dpid):
+        """
+        {rule_id: (dpid, prioridad, campos del match, acciones)} de las reglas instalables del switch.
+        """
+        return {
+            rid: (dpid, rule['priority'], tuple(sorted(rule['match'].items())), rule['actions'])
+            for rid, rule in self.rules.items()
+            if rule['dpid'] == dpid and rule['estado'] in RULE_INSTALLABLE_STATES
+        }
+
+    def _push_rules(self, dpids):
+        """
+        Lleva los switches al conjunto de reglas deseado enviando solo las diferencias por rule_id:
+        borrado estricto de las retiradas o movidas y ADD de las nuevas o cambiadas, en un lote
+        terminado en barrera por switch.
+        """
+        for dpid in dpids:
+            desired = self._desired_rules(dpid)
+            installed = {rid: v for rid, v in self._installed_rules.items() if v[0] == dpid}
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                # Se instalarán al reconciliar cuando el switch conecte
+                for rid in installed:
+                    self._installed_rules.pop(rid, None)
+                continue
+
+            parser = datapath.ofproto_parser
+            batch = FlowModBatch(f"reglas {dpid}")
+            removed = added = 0
+            # Primero los borrados: una regla nueva puede ocupar el match de una retirada
+            for rid, (_, priority, match_items, _) in installed.items():
+                target = desired.get(rid)
+                if target is None or target[1:3] != (priority, match_items):
+                    self.remove_flow_by_match(datapath, parser.OFPMatch(**dict(match_items)),
+                                              priority=priority, batch=batch)
+                    self._installed_rules.pop(rid, None)
+                    removed += 1
+            for rid, target in desired.items():
+                if self._installed_rules.get(rid) == target:
+                    continue
+                _, priority, match_items, actions = target
+                self.add_flow(datapath, priority=priority, match=parser.OFPMatch(**dict(match_items)),
+                              actions=self._rule_of_actions(datapath, actions), batch=batch)
+                self._installed_rules[rid] = target
+                added += 1
+
+            if batch.message_count():
+                self._commit_batch(batch)
+                self.logger.info(f"[REGLAS] Switch {dpid}: {added} reglas instaladas/actualizadas, {removed} retiradas.")
+
+    def _sync_rules(self, rows, rule_ids=None):
+        """
+        Aplica filas de la tabla reglas. Con rule_ids, solo esas reglas han cambiado (las que no
+        estén en rows se borraron); sin rule_ids, rows es la tabla completa.
+        """
+        seen = {row['rule_id'] for row in rows}
+        changed = set(rule_ids) if rule_ids is not None else set(self.rules) | seen
+        affected = set()
+
+        for rid in changed - seen:
+            old = self.rules.pop(rid, None)
+            if old:
+                affected.add(old['dpid'])
+        for row in rows:
+            rid = row['rule_id']
+            try:
+                rule = self._compile_rule(row)
+                rule['estado'], rule['motivo'] = 'activa', None
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                rule = {'dpid': int(row['dpid']), 'priority': row['priority'], 'match': {}, 'actions': (),
+                        'estado': 'invalida', 'motivo': str(e)}
+                self.logger.warning(f"[REGLAS] Regla {rid} inválida: {e}")
+            old = self.rules.get(rid)
+            if old and all(old[k] == rule[k] for k in ('dpid', 'priority', 'match', 'actions')) \
+                    and (old['estado'] == 'invalida') == (rule['estado'] == 'invalida'):
+                continue
+            if old:
+                affected.add(old['dpid'])
+            affected.add(rule['dpid'])
+            self.rules[rid] = rule
+
+        for dpid in affected:
+            self._analyze_rules(dpid)
+        self._push_rules(affected)
+
+    def _load_rules(self, conn, rule_ids=None):
+
+        with self.metrics.time('controller_db_seconds', (('operacion', 'reglas'),)):
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                query = ("SELECT dpid, rule_id, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, "
+                         "tcp_src, tcp_dst, in_port, actions FROM reglas")
+                if rule_ids is None:
+                    cur.execute(query + ";")
+                else:
+                    cur.execute(query + " WHERE rule_id = ANY(%s);", (list(rule_ids),))
+                rows = [dict(row) for row in cur.fetchall()]
+        self._sync_rules(rows, rule_ids)
+
+    def _rules_sync_loop(self):
+        """
+        Mantiene las reglas del gestor SDN al día: carga completa al arrancar y cada
+        RULES_SYNC_INTERVAL segundos, e incremental por rule_id con cada NOTIFY del backend.
+        """
+        conn = None
+        next_full_sync = 0
+        while True:
+            try:
+                if conn is None:
+                    conn = self._get_db_connection()
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(f"LISTEN {RULES_NOTIFY_CHANNEL};")
+                    next_full_sync = 0
+                if time.time() >= next_full_sync:
+                    self._load_rules(conn)
+                    next_full_sync = time.time() + RULES_SYNC_INTERVAL
+
+                timeout = max(0, next_full_sync - time.time())
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                rule_ids = set()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    try:
+                        rule_ids.add(int(payload))
+                    except ValueError:
+                        next_full_sync = 0
+                if rule_ids:
+                    self._load_rules(conn, rule_ids)
+            except Exception as e:
+                self.logger.error(f"[REGLAS] Error al sincronizar las reglas: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+                time.sleep(5)
+
     @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
     def _state_change_handler(self, ev):
         """
@@ -632,26 +2936,175 @@ class Controller(app_manager.RyuApp):
                 self.datapaths[datapath.id] = datapath
                 self.update_switch_status_in_db(datapath.id, 'conectado')
 
-                # Instala regla table-miss
-                ofproto = datapath.ofproto
-                parser = datapath.ofproto_parser
-                match = parser.OFPMatch()
-                actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                                ofproto.OFPCML_NO_BUFFER)]
-                self.add_flow(datapath, 0, match, actions)
+                # El medidor solo se instala (y las reglas hacia el controlador pasan a usarlo)
+                # cuando el switch confirma que admite medidores
+                if PACKET_IN_METERS_ENABLED:
+                    self._request_meter_features(datapath)
+
+                # La regla table-miss se instala ya, sin esperar a la reconciliación: si esta no
+                # terminara, el switch descartaría todo el tráfico sin regla (ARP, IGMP incluidos).
+                # Al reconciliar figura entre los flujos deseados y no se vuelve a enviar.
+                self.add_flow(datapath, **self._table_miss_spec(datapath))
+                self.add_flow(datapath, **self._igmp_to_controller_spec(datapath))
+
+                # La difusión y el resto de flujos deseados se instalan al reconciliar con las
+                # tablas reales del switch (solo lo que falte o difiera): primero los grupos y,
+                # al terminar, los flujos que los referencian.
+                self._request_group_desc(datapath)
+                # Conocer cuanto antes los miembros IGMP conectados a este switch
+                self._send_general_query(datapath)
 
         elif ev.state == DEAD_DISPATCHER:
             if datapath.id in self.datapaths:
                 self.logger.info("Switch desconectado: %016x", datapath.id)
                 del self.datapaths[datapath.id]
+                # Sin conexión no llegan FlowRemoved: el índice de este switch deja de ser fiable
+                self.installed_flows.pop(datapath.id, None)
+                self._drop_datapath_batches(datapath.id)
+                self._group_desc_parts.pop(datapath.id, None)
+                self._flow_stats_parts.pop(datapath.id, None)
+                self._reconcile_started_at.pop(datapath.id, None)
+                self.meter_capable.discard(datapath.id)
                 self.update_switch_status_in_db(datapath.id, 'desconectado')
         else:
             self.logger.warning(f"Evento de desconexión para DPID {datapath.id} no encontrado en datapaths.")
 
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        """
+        Detecta caídas y recuperaciones de enlaces switch-switch. Ambos extremos notifican
+        el mismo enlace; solo el primer aviso dispara el recálculo.
+        """
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        dpid = datapath.id
+        port_no = msg.desc.port_no
+
+        neighbor = self._port_neighbor(dpid, port_no)
+        if neighbor is None:
+            self.logger.debug(f"[PORT-STATUS] Cambio en puerto {port_no} de {dpid} sin enlace switch-switch asociado.")
+            return
+
+        link_down = (msg.reason == ofproto.OFPPR_DELETE
+                     or bool(msg.desc.state & ofproto.OFPPS_LINK_DOWN)
+                     or bool(msg.desc.config & ofproto.OFPPC_PORT_DOWN))
+        link = frozenset((dpid, neighbor))
+
+        with self.topology_lock:
+            if link_down and link not in self.down_links:
+                self.down_links.add(link)
+                self.logger.warning(f"[PORT-STATUS] Enlace {dpid}<->{neighbor} caído (puerto {port_no}).")
+                self._handle_link_down(link)
+            elif not link_down and link in self.down_links:
+                self.down_links.discard(link)
+                self.logger.info(f"[PORT-STATUS] Enlace {dpid}<->{neighbor} restablecido (puerto {port_no}).")
+                self._handle_link_up(link)
+
+    def _handle_link_down(self, link):
+        """
+        Recalcula solo los flujos que atraviesan el enlace caído según el índice de enlaces.
+        """
+        self._compute_broadcast_tree()
+        self._refresh_broadcast_flows()
+
+        affected = sorted(self.link_index.pop(link, set()), key=str)
+        for entry in affected:
+            self._indexed_links.get(entry, set()).discard(link)
+        self.logger.info(f"[PORT-STATUS] {len(affected)} rutas/árboles afectados por la caída de {sorted(link)}.")
+
+        for kind, key in affected:
+            if kind == 'unicast':
+                self._reroute_unicast(key)
+        groups = [key for kind, key in affected if kind == 'multicast' and key in self._last_installed_tree]
+        if groups:
+            self._recompute_multicast_groups(groups)
+
+    def _handle_link_up(self, link):
+        """
+        Restablece el árbol de difusión y reevalúa los árboles multicast para volver a los caminos
+        óptimos. Las rutas unicast desviadas expiran por su hard_timeout.
+        """
+        self._compute_broadcast_tree()
+        self._refresh_broadcast_flows()
+        if self._last_installed_tree:
+            self._recompute_multicast_groups(list(self._last_installed_tree.keys()))
+
+    def _refresh_broadcast_flows(self):
+        """
+        Reinstala las reglas del árbol de difusión y elimina las de puertos que salieron del árbol.
+        """
+        batch = FlowModBatch("árbol de difusión")
+        for dpid, datapath in self.datapaths.items():
+            specs = self._broadcast_flow_specs(datapath)
+            wanted = {self._flow_key(spec['priority'], spec['match']) for spec in specs}
+            stale = [key for key in self.installed_flows.get(dpid, {})
+                     if key[0] == BROADCAST_TREE_PRIORITY and key not in wanted]
+            for priority, items in stale:
+                match = datapath.ofproto_parser.OFPMatch(**dict(items))
+                self.remove_flow_by_match(datapath, match, priority=priority, batch=batch)
+            self._install_broadcast_flows(datapath, batch=batch)
+        self._commit_batch(batch)
+
+    def _reroute_unicast(self, key):
+        """
+        Solicita al backend una ruta que evite los enlaces caídos y reemplaza la ruta unicast.
+        Si no hay alternativa, se retiran sus flujos para que el tráfico vuelva al controlador.
+        """
+        src_mac, dst_mac = key
+        old_route = self.unicast_routes.get(key)
+        if not old_route:
+            return
+
+        path = []
+        try:
+            url = 'http://192.168.18.151:5000/dijkstra/calculate_path'
+            payload = {"src_mac": src_mac, "dst_mac": dst_mac,
+                       "excluded_links": self._excluded_links_payload()}
+            response = self._backend_request(url, payload, timeout=3)
+            if response.status_code == 200:
+                path = response.json().get("path", [])
+            else:
+                self.logger.error(f"[REROUTE] Fallo al obtener ruta alternativa {src_mac}->{dst_mac}: "
+                                  f"{response.status_code} {response.text}")
+        except requests.RequestException as e:
+            self.logger.error(f"[REROUTE] Error en la solicitud HTTP al servidor de rutas: {e}")
+
+        batch = FlowModBatch(f"reenrutamiento {src_mac}->{dst_mac}")
+        try:
+            new_dpids = {salto.get("dpid") for salto in path}
+            for dpid, _ in old_route['hops'] + old_route.get('backup_hops', []):
+                datapath = self.datapaths.get(dpid)
+                if datapath and dpid not in new_dpids:
+                    match = datapath.ofproto_parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                                             eth_src=src_mac, eth_dst=dst_mac)
+                    self.remove_flow_by_match(datapath, match, batch=batch)
+
+            if path:
+                self._install_unicast_route(src_mac, dst_mac, path, batch, log_prefix="[REROUTE] ")
+            else:
+                self.logger.warning(f"[REROUTE] Sin ruta alternativa para {src_mac}->{dst_mac}; flujos retirados.")
+                self._drop_unicast_route(key, batch=batch)
+        finally:
+            self._commit_batch(batch)
     
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
 
+        start = time.monotonic()
+        kind = 'error'
+        try:
+            kind = self._process_packet_in(ev)
+        finally:
+            labels = (('tipo', kind),)
+            self.metrics.observe('controller_packet_in_handler_seconds', time.monotonic() - start, labels)
+            self.metrics.inc('controller_packet_in_total', (('dpid', str(ev.msg.datapath.id)),) + labels)
+
+    def _process_packet_in(self, ev):
+        """
+        Procesa un packet-in y devuelve su tipo (arp, igmp, multicast, difusion, unicast, ...) para las métricas.
+        """
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
@@ -659,11 +3112,15 @@ class Controller(app_manager.RyuApp):
         dpid = datapath.id
         in_port = msg.match['in_port']
 
+        # Limitar packet-ins por switch antes de parsear el paquete (ARP/IGMP en su propia cubeta)
+        if not self._allow_packet_in(dpid, control=self._is_control_packet(msg.data)):
+            return 'limitado'
+
         # Parsear paquete
         pkt = packet.Packet(msg.data)
         eth = pkt.get_protocol(ethernet.ethernet)
         if not eth:
-            return
+            return 'invalido'
 
         self.logger.debug(f"DEBUG: PacketIn recibido en switch={dpid} in_port={in_port} eth_type={eth.ethertype:04x}")
 
@@ -672,10 +3129,10 @@ class Controller(app_manager.RyuApp):
 
         # Ignorar LLDP e IPv6
         if eth.ethertype == ether_types.ETH_TYPE_LLDP:
-            return
+            return 'lldp'
         if eth.ethertype == ether_types.ETH_TYPE_IPV6:
             self.logger.debug(f"Ignorando paquete IPv6 en el switch {dpid}")
-            return
+            return 'ipv6'
 
         dst_mac = eth.dst
         src_mac = eth.src
@@ -704,7 +3161,7 @@ class Controller(app_manager.RyuApp):
                             # Responder ARP proxy
                             self._send_arp_reply(datapath, src_mac, arp_pkt.src_ip,
                                                  mac_host, target_ip, in_port)
-                            return
+                            return 'arp'
                 # Si fuera ARP_REPLY, permitir que se procese como unicast normal
 
         # Manejo de IGMP (suscripción/desuscripción)
@@ -712,7 +3169,7 @@ class Controller(app_manager.RyuApp):
             if isinstance(protocol, igmp.igmp):
                 self.logger.info(f"Paquete IGMP recibido en switch {dpid}, puerto {in_port}: {protocol}")
                 self._handle_igmp_packet(datapath, msg, dpid, in_port, protocol)
-                return
+                return 'igmp'
 
         first_octet_dst_int = int(dst_mac.split(':')[0], 16)
         is_dst_multicast = ((first_octet_dst_int & 1) == 1)
@@ -723,17 +3180,29 @@ class Controller(app_manager.RyuApp):
 
                 members = self.multicast_group_members.get(group_ip)
                 if not members:
-                    return
+                    self._install_negative_cache_rule(dpid, group_ip)
+                    return 'multicast'
 
-                if dpid in self.multicast_flow_installed_at.get(group_ip, set()):
-                    return
+                if self._multicast_flow_present(dpid, group_ip):
+                    return 'multicast'
 
                 self.logger.info(f"Tráfico IP Multicast {group_ip} de {dpid} en {in_port} llegó al controlador. Re-evaluando e instalando flujos.")
                 self._handle_multicast_ip_traffic(datapath, msg, dpid, in_port, group_ip)
-                return
+                return 'multicast'
             else:
-                out_port = ofproto.OFPP_FLOOD
-                self.logger.info(f"Inundando paquete broadcast/multicast no IP en switch={dpid} dst={dst_mac}")
+                out_ports = self._broadcast_out_ports(dpid, in_port)
+                if not out_ports:
+                    self.logger.debug(f"Difusión no IP en switch={dpid} recibida fuera del árbol (puerto {in_port}). Descartando.")
+                    return 'difusion'
+                self.logger.info(f"Difundiendo paquete broadcast/multicast no IP por el árbol en switch={dpid} dst={dst_mac} -> {out_ports}")
+                actions = [parser.OFPActionOutput(p) for p in out_ports]
+
+                # El resto del tráfico hacia esta MAC de grupo se resuelve en el plano de datos
+                if dst_mac != BROADCAST_MAC:
+                    match = parser.OFPMatch(in_port=in_port, eth_dst=dst_mac)
+                    self.add_flow(datapath, BROADCAST_TREE_PRIORITY, match, actions,
+                                  idle_timeout=NON_IP_MULTICAST_IDLE_TIMEOUT)
+
                 data = None
                 if msg.buffer_id == ofproto.OFP_NO_BUFFER:
                     data = msg.data
@@ -741,12 +3210,12 @@ class Controller(app_manager.RyuApp):
                     datapath=datapath,
                     buffer_id=msg.buffer_id,
                     in_port=in_port,
-                    actions=[parser.OFPActionOutput(out_port)],
+                    actions=actions,
                     data=data
                 )
                 datapath.send_msg(out)
-                self.logger.debug(f"Paquete enviado desde switch {dpid} puerto {out_port}")
-                return
+                self.logger.debug(f"Paquete enviado desde switch {dpid} puertos {out_ports}")
+                return 'difusion'
 
 
         # Unicast IP
@@ -765,23 +3234,17 @@ class Controller(app_manager.RyuApp):
                 eth_dst=dst_mac
             )
             actions = [parser.OFPActionOutput(out_port)]
-            
-            self.add_flow(datapath, priority=100, match=match, actions=actions,
-                          buffer_id=msg.buffer_id, idle_timeout=60, hard_timeout=60)
+
+            batch = FlowModBatch(f"unicast {src_mac}->{dst_mac} (directo)")
+            self._install_unicast_route(src_mac, dst_mac, [{"dpid": dpid, "out_port": out_port}], batch)
 
             data = None
             if msg.buffer_id == ofproto.OFP_NO_BUFFER:
                 data = msg.data
-            out = parser.OFPPacketOut(
-                datapath=datapath,
-                buffer_id=msg.buffer_id,
-                in_port=in_port,
-                actions=actions,
-                data=data
-            )
-            datapath.send_msg(out)
+            self._send_packet_out(datapath, msg.buffer_id, in_port, actions, data, batch=batch)
+            self._commit_batch(batch)
             self.logger.debug(f"Paquete enviado desde switch {dpid} puerto {out_port} (ruta directa).")
-            return
+            return 'unicast'
 
         if dst_mac in self.host_to_switch_map:
             dst_host_info = self.host_to_switch_map[dst_mac]
@@ -792,17 +3255,18 @@ class Controller(app_manager.RyuApp):
 
             try:
                 url = 'http://192.168.18.151:5000/dijkstra/calculate_path'
-                payload = {"src_mac": src_mac, "dst_mac": dst_mac}
-                response = requests.post(url, json=payload, timeout=3)
+                payload = {"src_mac": src_mac, "dst_mac": dst_mac,
+                           "excluded_links": self._excluded_links_payload()}
+                response = self._backend_request(url, payload, timeout=3)
                 if response.status_code == 200:
                     data = response.json()
                     path = data.get("path", [])
                 else:
                     self.logger.error(f"Fallo al obtener ruta: {response.status_code} {response.text}")
-                    return
+                    return 'unicast'
             except requests.RequestException as e:
                 self.logger.error(f"Error en la solicitud HTTP al servidor de rutas: {e}")
-                return
+                return 'unicast'
 
             self.logger.info("Detalles de la ruta calculada (ida):")
             for idx, salto in enumerate(path):
@@ -810,97 +3274,17 @@ class Controller(app_manager.RyuApp):
 
             if not path:
                 self.logger.warning(f"No hay ruta desde {dpid} a {dst_switch_dpid} para {src_mac} -> {dst_mac}, descartando paquete")
-                return
-
-            # Instalar flujos ida
-            self.logger.debug(f"Ruta encontrada (ida): {path}")
-            for salto in path:
-                cur_dpid = salto.get("dpid")
-                out_port = salto.get("out_port")
-
-                cur_dp = self.datapaths.get(cur_dpid)
-                if not cur_dp:
-                    self.logger.error(f"Datapath faltante para el switch {cur_dpid}, omitiendo instalación de flujo")
-                    continue
+                return 'unicast'
 
-                if not isinstance(out_port, int) or out_port <= 0:
-                    self.logger.error(f"Puerto de salida inválido ({out_port}) en la ruta directa para {cur_dpid}")
-                    continue
-
-                match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    eth_src=src_mac,
-                    eth_dst=dst_mac
-                )
-                actions = [parser.OFPActionOutput(out_port)]
-
-                buffer_id_use = msg.buffer_id if cur_dpid == dpid and msg.buffer_id != ofproto.OFP_NO_BUFFER else ofproto.OFP_NO_BUFFER
-                self.add_flow(cur_dp, priority=100, match=match, actions=actions,
-                              buffer_id=buffer_id_use, idle_timeout=60, hard_timeout=60)
-                self.logger.info(f"Flujo instalado en switch {cur_dpid} para {src_mac}->{dst_mac} a través del puerto {out_port}")
-
-            # Solicitar ruta inversa (dst→src)
+            # Las reglas de ida y vuelta y el primer paquete se envían en un único lote
+            batch = FlowModBatch(f"unicast {src_mac}<->{dst_mac}")
             try:
-                reverse_payload = {"src_mac": dst_mac, "dst_mac": src_mac}
-                reverse_response = requests.post(url, json=reverse_payload, timeout=3)
-                if reverse_response.status_code == 200:
-                    reverse_data = reverse_response.json()
-                    reverse_path = reverse_data.get("path", [])
-                else:
-                    self.logger.error(f"Fallo al obtener ruta inversa: {reverse_response.status_code} {reverse_response.text}")
-                    return
-            except requests.RequestException as e:
-                self.logger.error(f"Error en la solicitud HTTP al servidor de rutas (inverso): {e}")
-                return
-
-            self.logger.info("Detalles de la ruta calculada (inversa):")
-            for idx, salto in enumerate(reverse_path):
-                self.logger.info(f"  Salto {idx}: Switch={salto.get('dpid')}, out_port={salto.get('out_port')}, in_port={salto.get('in_port')}")
-
-            # Instalar flujos inversos
-            for salto in reverse_path:
-                cur_dpid = salto.get("dpid")
-                out_port = salto.get("out_port")
-
-                cur_dp = self.datapaths.get(cur_dpid)
-                if not cur_dp:
-                    self.logger.error(f"Datapath faltante para el switch {cur_dpid} en la ruta inversa, omitiendo")
-                    continue
-
-                if not isinstance(out_port, int) or out_port <= 0:
-                    self.logger.error(f"Puerto de salida inválido ({out_port}) en ruta inversa para {cur_dpid}")
-                    continue
-
-                reverse_match = parser.OFPMatch(
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    eth_src=dst_mac,
-                    eth_dst=src_mac
-                )
-                reverse_actions = [parser.OFPActionOutput(out_port)]
-
-                self.add_flow(cur_dp, priority=100, match=reverse_match, actions=reverse_actions,
-                              idle_timeout=60, hard_timeout=60)
-                self.logger.info(f"[RETORNO] Flujo instalado en switch {cur_dpid} para {dst_mac}->{src_mac} por puerto {out_port}")
-
-            # Reenviar el primer paquete (ida) para que el flujo empiece a tomar efecto
-            initial_out_port = path[0].get("out_port") if len(path) > 1 else dst_switch_port_to_host
-            if isinstance(initial_out_port, int) and initial_out_port > 0:
-                data = None
-                if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-                    data = msg.data
-                out = parser.OFPPacketOut(
-                    datapath=datapath,
-                    buffer_id=msg.buffer_id,
-                    in_port=in_port,
-                    actions=[parser.OFPActionOutput(initial_out_port)],
-                    data=data
-                )
-                datapath.send_msg(out)
-                self.logger.debug(f"Paquete inicial enviado desde switch {dpid} puerto {initial_out_port}")
-            else:
-                self.logger.error(f"Fallo al enviar paquete inicial: puerto inválido ({initial_out_port})")
-            return
+                self._install_unicast_paths_batched(datapath, msg, in_port, src_mac, dst_mac,
+                                                    path, url, dst_switch_port_to_host, batch)
+            finally:
+                self._commit_batch(batch)
+            return 'unicast'
 
         # Si el paquete no fue manejado en ninguna de las ramas anteriores, lo descartamos
         self.logger.debug(f"Paquete no manejado: src={src_mac}, dst={dst_mac}, eth_type={eth.ethertype} en dpid={dpid}, in_port={in_port}. Descartando.")
-        return
\ No newline at end of file
+        return 'no_manejado'
\ No newline at end of file
@@ -5,7 +5,11 @@ import psycopg2
 import sys
 
 class GeantTopo(Topo):
-    def build(self):
+    def build(self, stp=False):
+
+        # El controlador instala un árbol de difusión sin lazos; STP en OVS solo es
+        # necesario con controladores que inunden con OFPP_FLOOD (retrasa el arranque).
+        stp = str(stp).lower() in ('1', 'true', 'yes')
 
         switches = {}
         hosts = {}
@@ -35,12 +39,12 @@ class GeantTopo(Topo):
             
             for id_switch, ciudad in switch_list:
                 dpid_str = "{:016x}".format(id_switch)
-                sw = self.addSwitch(f's{id_switch}', dpid=dpid_str, cls=OVSKernelSwitch, stp=True)
+                sw = self.addSwitch(f's{id_switch}', dpid=dpid_str, cls=OVSKernelSwitch, stp=stp)
                 switches[id_switch] = sw
                 id_to_nombre[id_switch] = ciudad
                 nombre_to_id[ciudad] = id_switch
                 nombre_to_switch_obj[ciudad] = sw
-                print(f"Switch creado: s{id_switch} ({ciudad}) con DPID {dpid_str}, STP habilitado")
+                print(f"Switch creado: s{id_switch} ({ciudad}) con DPID {dpid_str}, STP {'habilitado' if stp else 'deshabilitado'}")
 
             #  Obtener hosts con IP y switch asociado
             cur.execute("SELECT nombre, switch_asociado, ipv4, mac FROM hosts;")
@@ -135,4 +139,4 @@ class GeantTopo(Topo):
                 conn.close()
             print("Conexión a la base de datos cerrada.")
 
-topos = {'geant': (lambda: GeantTopo())}
\ No newline at end of file
+topos = {'geant': (lambda stp=False: GeantTopo(stp=stp))}
\ No newline at end of file